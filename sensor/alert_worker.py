@@ -41,8 +41,8 @@ _buzzer_pwm = None
 
 def _gpio_init():
     global _led, _buzzer_pwm
-    if not GPIO_ENABLE:
-        return
+    if not GPIO_ENABLE or _led is not None:
+        return   # ทำครั้งเดียวต่อ process (worker เรียก run_once ซ้ำ ๆ)
     try:
         from gpiozero import LED, PWMOutputDevice
         _led = LED(ALERT_LED_PIN)
@@ -100,6 +100,17 @@ DB_PATH = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
 TOKENS_PATH = os.getenv("PUSH_TOKENS", "/var/lib/tempmon/push_tokens.json")
 DEVICE_ID = os.getenv("DEVICE_ID", "pi5-001")
 
+try:
+    from sensor.devices import device_ids
+except Exception:
+    def device_ids():
+        return [DEVICE_ID]
+
+try:
+    from sensor import partitions, latest_shm
+except Exception:
+    import partitions, latest_shm  # รันจากในโฟลเดอร์ sensor/
+
 # =========================================================
 # Alert rules (ปรับตามต้องการ)
 # =========================================================
@@ -132,21 +143,31 @@ def ensure_tables(cur):
     )""")
     cur.execute("""
     CREATE TABLE IF NOT EXISTS alert_state (
-      metric TEXT PRIMARY KEY,
+      device_id TEXT NOT NULL DEFAULT '',
+      metric TEXT NOT NULL,
       active INTEGER NOT NULL DEFAULT 0,
-      last_sent_ms INTEGER NOT NULL DEFAULT 0
+      last_sent_ms INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (device_id, metric)
     )""")
-
-def get_latest(cur):
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(alert_state)")}
+    if "device_id" not in cols:
+        # ตารางเก่า (PK = metric) -> ย้ายไป schema ต่อเครื่อง
+        cur.execute("ALTER TABLE alert_state RENAME TO alert_state_legacy")
+        ensure_tables(cur)
+        cur.execute("""INSERT INTO alert_state(device_id, metric, active, last_sent_ms)
+                       SELECT ?, metric, active, last_sent_ms FROM alert_state_legacy""", (DEVICE_ID,))
+        cur.execute("DROP TABLE alert_state_legacy")
+
+def get_latest(cur, device_id=DEVICE_ID):
     """
-    readings schema: ts_ms, temp, level, cycles
+    readings schema: device_id, ts_ms, temp, level, cycles
+    ค่าจาก collector ใน shared memory ก่อน (ไม่แตะ SQLite) ไม่มี/เก่าเกิน -> SQLite
     """
-    row = cur.execute("""
-        SELECT ts_ms, temp, level, cycles
-        FROM readings
-        ORDER BY ts_ms DESC
-        LIMIT 1
-    """).fetchone()
+    snap = latest_shm.read(device_id)
+    if snap is not None:
+        return {k: snap[k] for k in ("ts_ms", "temp", "current", "level", "cycles")}
+
+    row = partitions.latest(cur, device_id)
 
     if not row:
         return None
@@ -202,41 +223,33 @@ def expo_push_send(tokens, title, body):
 # =========================================================
 # Main
 # =========================================================
-def main():
-    _gpio_init()
-    now_ms = lambda: int(time.time() * 1000)
-
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    ensure_tables(cur)
-    con.commit()
-
-    latest = get_latest(cur)
-    if not latest:
-        _led_off()
-        _buzzer_off()
-        con.close()
-        return
+def _emit(notify, fn, *args):
+    # notify=None: ส่งทันที (แบบเดิม) / list: เก็บไว้ส่งหลัง commit (ไม่ถือ write lock ระหว่างรอเน็ต)
+    if notify is None:
+        fn(*args)
+    else:
+        notify.append((fn, args))
 
-    tokens = push_tokens()
+def check_device(cur, device_id, latest, tokens, notify=None, log: bool = True) -> bool:
+    """ตรวจทุก rule ของเครื่องเดียว คืน True ถ้ายังมี alert ระดับ high ค้างอยู่"""
+    now_ms = lambda: int(time.time() * 1000)
     any_high_active_after = False
 
-    print(f"[worker] device={DEVICE_ID} db={DB_PATH} cooldown={COOLDOWN_SEC}s telegram={TELEGRAM_ENABLE}", flush=True)
-
     for rule in RULES:
         metric = rule["metric"]
         v = latest.get(metric)
         is_alert = op_eval(rule["op"], v, rule["threshold"])
 
         st = cur.execute(
-            "SELECT active, last_sent_ms FROM alert_state WHERE metric=?",
-            (metric,)
+            "SELECT active, last_sent_ms FROM alert_state WHERE device_id=? AND metric=?",
+            (device_id, metric)
         ).fetchone()
 
         active = bool(st[0]) if st else False
         last_sent_ms = st[1] if st else 0
 
-        print(f"[check] {metric} v={v} op={rule['op']} th={rule['threshold']} active={active} last_sent_ms={last_sent_ms}", flush=True)
+        if log:
+            print(f"[check] {metric} v={v} op={rule['op']} th={rule['threshold']} active={active} last_sent_ms={last_sent_ms}", flush=True)
 
         # =========================
         # ALERT OPEN
@@ -248,39 +261,39 @@ def main():
                     (ts_ms, metric, value, threshold, severity, state, message, device_id)
                     VALUES (?,?,?,?,?,?,?,?)""",
                     (latest["ts_ms"], metric, v, rule["threshold"],
-                     rule["sev"], "open", f'{rule["msg"]}: {float(v):.2f}', DEVICE_ID))
+                     rule["sev"], "open", f'{rule["msg"]}: {float(v):.2f}', device_id))
 
                 # set state active=1 (คง last_sent_ms เดิมไว้)
-                cur.execute("""INSERT INTO alert_state(metric,active,last_sent_ms)
-                               VALUES(?,?,?)
-                               ON CONFLICT(metric) DO UPDATE SET active=excluded.active,
+                cur.execute("""INSERT INTO alert_state(device_id,metric,active,last_sent_ms)
+                               VALUES(?,?,?,?)
+                               ON CONFLICT(device_id,metric) DO UPDATE SET active=excluded.active,
                                                                last_sent_ms=alert_state.last_sent_ms""",
-                            (metric, 1, last_sent_ms))
+                            (device_id, metric, 1, last_sent_ms))
 
                 # ✅ ส่ง Telegram แค่ครั้งเดียวตอน OPEN
-                telegram_send_safe(
-                    f"🚨 ALERT OPEN: {DEVICE_ID}\n"
+                _emit(notify, telegram_send_safe,
+                    f"🚨 ALERT OPEN: {device_id}\n"
                     f"{rule['msg']}\n"
                     f"{metric}: {float(v):.2f} ({rule['op']}{rule['threshold']})"
                 )
 
                 # Expo push (ถ้ามี token)
-                expo_push_send(
+                _emit(notify, expo_push_send,
                     tokens,
-                    f'{DEVICE_ID} • {rule["msg"]}',
+                    f'{device_id} • {rule["msg"]}',
                     f'{metric}: {float(v):.2f} ({rule["op"]}{rule["threshold"]})'
                 )
 
                 # อัปเดต last_sent_ms (ไว้กันอนาคต/รายงาน)
                 cur.execute(
-                    "UPDATE alert_state SET last_sent_ms=? WHERE metric=?",
-                    (now_ms(), metric)
+                    "UPDATE alert_state SET last_sent_ms=? WHERE device_id=? AND metric=?",
+                    (now_ms(), device_id, metric)
                 )
 
                 # local alarm
                 if rule["sev"] == LOCAL_ALARM_SEV:
-                    _led_on()
-                    _alarm_nice()
+                    _emit(notify, _led_on)
+                    _emit(notify, _alarm_nice)
 
         # =========================
         # ALERT CLEARED
@@ -295,29 +308,72 @@ def main():
                         VALUES (?,?,?,?,?,?,?,?)""",
                         (latest["ts_ms"], metric, v, rule["clear"],
                          rule["sev"], "cleared",
-                         f'{rule["msg"]} resolved: {float(v):.2f}', DEVICE_ID))
+                         f'{rule["msg"]} resolved: {float(v):.2f}', device_id))
 
                     # ✅ ส่ง Telegram แค่ครั้งเดียวตอน CLEARED
-                    telegram_send_safe(
-                        f"✅ CLEARED: {DEVICE_ID}\n"
+                    _emit(notify, telegram_send_safe,
+                        f"✅ CLEARED: {device_id}\n"
                         f"{rule['msg']} resolved\n"
                         f"{metric}: {float(v):.2f} (clear={rule['clear']})"
                     )
 
                     # set inactive
-                    cur.execute("UPDATE alert_state SET active=0 WHERE metric=?", (metric,))
+                    cur.execute("UPDATE alert_state SET active=0 WHERE device_id=? AND metric=?",
+                                (device_id, metric))
 
         if rule["sev"] == "high" and is_alert:
             any_high_active_after = True
 
+    return any_high_active_after
+
+
+def evaluate(con, latest_by_device, tokens=None, log: bool = True) -> bool:
+    """
+    ตรวจ rule ของหลายเครื่องจากค่าที่มีอยู่แล้วในมือ {device_id: {"ts_ms", "temp", "level", "cycles"}}
+    ใช้ได้ทั้ง run_once (ค่าจาก SQLite) และ supervisor (ค่าจาก collector ในหน่วยความจำ)
+    state เขียนลง SQLite แล้ว commit ก่อน จากนั้นค่อยส่ง Telegram / push / เสียง
+    """
+    _gpio_init()
+    cur = con.cursor()
+    tokens = push_tokens() if tokens is None else tokens
+    notify = []
+    any_high_active_after = False
+
+    for device_id, latest in latest_by_device.items():
+        if not latest:
+            continue
+        if log:
+            print(f"[worker] device={device_id} db={DB_PATH} cooldown={COOLDOWN_SEC}s telegram={TELEGRAM_ENABLE}", flush=True)
+        if check_device(cur, device_id, latest, tokens, notify=notify, log=log):
+            any_high_active_after = True
+
     con.commit()
-    con.close()
+    for fn, args in notify:
+        fn(*args)
 
     if any_high_active_after:
         _led_on()
     else:
         _led_off()
     _buzzer_off()
+    return any_high_active_after
+
+
+def run_once(con) -> bool:
+    """ตรวจทุกเครื่องหนึ่งรอบ (cron หรือ worker ที่ถือ connection ไว้) คืน True ถ้ายังมี high ค้าง"""
+    cur = con.cursor()
+    ensure_tables(cur)
+    con.commit()
+    # ทุกเครื่องใน gateway (ไม่ตั้ง GATEWAY_CONFIG = DEVICE_ID เดียว)
+    return evaluate(con, {d: get_latest(cur, d) for d in device_ids()})
+
+
+def main():
+    con = sqlite3.connect(DB_PATH)
+    try:
+        run_once(con)
+    finally:
+        con.close()
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,5 @@
 # sensor/alerts.py
-import os, time, json, sqlite3, requests
+import os, time, json, sqlite3
 from pathlib import Path
 from typing import List, Dict
 
@@ -55,6 +55,7 @@ def send_push(title: str, body: str, data: Dict = None):
     tokens = load_expo_tokens()
     if not tokens: return
     msgs = [{"to": t, "sound": "default", "title": title, "body": body, "data": data or {}} for t in tokens]
+    import requests
     try:
         requests.post(EXPO_PUSH_URL, json=msgs, timeout=6)
     except Exception:
@@ -62,6 +63,7 @@ def send_push(title: str, body: str, data: Dict = None):
 
 # -------- polling latest --------
 def fetch_latest() -> Dict:
+    import requests
     r = requests.get(API_LATEST, timeout=3)
     j = r.json()
     # expected shape from your API:
@@ -69,43 +71,53 @@ def fetch_latest() -> Dict:
     if not j.get("ok"): raise RuntimeError("bad latest")
     return j
 
+class Checker:
+    """
+    debounce ต่อ metric: นับรอบที่เกินติดกัน (เรียก check() วินาทีละครั้ง)
+    main() ป้อนจาก /api/latest; sensor/supervisor.py ป้อนค่าจาก collector ตรง ๆ
+    """
+
+    def __init__(self, device_id: str = DEVICE_ID):
+        self.device_id = device_id
+        self.bad_temp = self.bad_curr = self.bad_oil = 0
+
+    def check(self, lt: Dict):
+        t  = float(lt.get("temp")   or 0.0)
+        a  = float(lt.get("current")or 0.0)
+        oil= float(lt.get("level")  or 0.0)
+
+        # temp
+        self.bad_temp = self.bad_temp + 1 if t > MAX_TEMP else 0
+        if self.bad_temp >= DEB_TEMP:
+            insert_alert("HIGH_TEMP", f"Temp {t:.1f}°C > {MAX_TEMP}°C", "crit", t, MAX_TEMP)
+            send_push("HIGH TEMP", f"{self.device_id}: {t:.1f}°C (> {MAX_TEMP}°C)",
+                      {"type":"HIGH_TEMP","device":self.device_id,"value":t})
+            self.bad_temp = 0
+
+        # current
+        self.bad_curr = self.bad_curr + 1 if a > MAX_CURR else 0
+        if self.bad_curr >= DEB_CURR:
+            insert_alert("OVER_CURRENT", f"Current {a:.2f}A > {MAX_CURR}A", "warn", a, MAX_CURR)
+            send_push("Over Current", f"{self.device_id}: {a:.2f}A (> {MAX_CURR}A)",
+                      {"type":"OVER_CURRENT","device":self.device_id,"value":a})
+            self.bad_curr = 0
+
+        # oil
+        self.bad_oil = self.bad_oil + 1 if oil < MIN_OIL else 0
+        if self.bad_oil >= DEB_OIL:
+            insert_alert("LOW_OIL", f"Oil {oil:.1f}cm < {MIN_OIL}cm", "warn", oil, MIN_OIL)
+            send_push("Low Oil", f"{self.device_id}: {oil:.1f}cm (< {MIN_OIL}cm)",
+                      {"type":"LOW_OIL","device":self.device_id,"value":oil})
+            self.bad_oil = 0
+
 def main():
     print("[alerts] starting…")
     ensure_db()
-
-    bad_temp = bad_curr = bad_oil = 0
+    checker = Checker()
 
     while True:
         try:
-            lt = fetch_latest()
-            t  = float(lt.get("temp")   or 0.0)
-            a  = float(lt.get("current")or 0.0)
-            oil= float(lt.get("level")  or 0.0)
-
-            # temp
-            bad_temp = bad_temp + 1 if t > MAX_TEMP else 0
-            if bad_temp >= DEB_TEMP:
-                insert_alert("HIGH_TEMP", f"Temp {t:.1f}°C > {MAX_TEMP}°C", "crit", t, MAX_TEMP)
-                send_push("HIGH TEMP", f"{DEVICE_ID}: {t:.1f}°C (> {MAX_TEMP}°C)", 
-                          {"type":"HIGH_TEMP","device":DEVICE_ID,"value":t})
-                bad_temp = 0
-
-            # current
-            bad_curr = bad_curr + 1 if a > MAX_CURR else 0
-            if bad_curr >= DEB_CURR:
-                insert_alert("OVER_CURRENT", f"Current {a:.2f}A > {MAX_CURR}A", "warn", a, MAX_CURR)
-                send_push("Over Current", f"{DEVICE_ID}: {a:.2f}A (> {MAX_CURR}A)",
-                          {"type":"OVER_CURRENT","device":DEVICE_ID,"value":a})
-                bad_curr = 0
-
-            # oil
-            bad_oil = bad_oil + 1 if oil < MIN_OIL else 0
-            if bad_oil >= DEB_OIL:
-                insert_alert("LOW_OIL", f"Oil {oil:.1f}cm < {MIN_OIL}cm", "warn", oil, MIN_OIL)
-                send_push("Low Oil", f"{DEVICE_ID}: {oil:.1f}cm (< {MIN_OIL}cm)",
-                          {"type":"LOW_OIL","device":DEVICE_ID,"value":oil})
-                bad_oil = 0
-
+            checker.check(fetch_latest())
         except Exception as e:
             # เงียบไว้—ไม่อยาก spam log; จะลองใหม่รอบถัดไป
             pass
@@ -0,0 +1,479 @@
+# sensor/archive.py
+"""
+Compressed archive of raw readings (cold storage).
+
+Closed hours that the minute aggregator has already summarised are packed
+into one blob per (device_id, hour) in `readings_archive`:
+
+  ts      delta-of-delta, variable-width bit buckets (Gorilla style)
+  temp    XOR of consecutive float64 values + presence bit per sample
+  level   same as temp
+  cycles  run-length (delta, run) pairs as zigzag varints
+
+The collector writes on a fixed grid, so most timestamps cost 1 bit and a
+steady temperature a few bits — roughly 10x smaller than the row tables.
+Raw day partitions are dropped by cleanup_old_data.py after
+RETENTION_DAYS, but only once every hour in them is archived (it archives
+whatever this job has not reached yet first); the archive keeps
+ARCHIVE_RETENTION_DAYS. /api/history/raw reads through read_range().
+
+Read back with iter_blocks() / read_range(); read_range() merges archived
+hours with rows that are still only in the live partitions.
+
+Run (cron, e.g. every 10 min):  python -m sensor.archive
+"""
+import os
+import time
+import struct
+import sqlite3
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from sensor.local_db import connect, ensure_readings_table, ensure_minutes_table
+from sensor import partitions
+from sensor.devices import device_ids
+
+DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+ARCHIVE_MAX_HOURS = int(os.getenv("ARCHIVE_MAX_HOURS", "168"))   # ต่อเครื่องต่อรอบ
+
+HOUR_MS = 3_600_000
+CODEC_VERSION = 1
+
+Row = Tuple[int, Optional[float], Optional[float], Optional[int]]
+
+
+# =========================================================
+# bit stream
+# =========================================================
+class BitWriter:
+    def __init__(self):
+        self.buf = bytearray()
+        self._acc = 0
+        self._n = 0
+
+    def write(self, value: int, nbits: int):
+        if nbits <= 0:
+            return
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._n += nbits
+        while self._n >= 8:
+            self._n -= 8
+            self.buf.append((self._acc >> self._n) & 0xFF)
+        self._acc &= (1 << self._n) - 1
+
+    def getvalue(self) -> bytes:
+        if self._n:
+            return bytes(self.buf) + bytes([(self._acc << (8 - self._n)) & 0xFF])
+        return bytes(self.buf)
+
+
+class BitReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0   # bit position
+
+    def read(self, nbits: int) -> int:
+        if nbits <= 0:
+            return 0
+        first = self.pos >> 3
+        last = (self.pos + nbits + 7) >> 3
+        chunk = int.from_bytes(self.data[first:last], "big")
+        shift = (last - first) * 8 - (self.pos & 7) - nbits
+        self.pos += nbits
+        return (chunk >> shift) & ((1 << nbits) - 1)
+
+
+def _signed(v: int, nbits: int) -> int:
+    return v - (1 << nbits) if v & (1 << (nbits - 1)) else v
+
+
+# =========================================================
+# varint (cycles + section lengths)
+# =========================================================
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def _unzigzag(z: int) -> int:
+    return (z >> 1) ^ -(z & 1)
+
+
+def _put_varint(out: bytearray, v: int):
+    while v >= 0x80:
+        out.append((v & 0x7F) | 0x80)
+        v >>= 7
+    out.append(v)
+
+
+def _get_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    v = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        v |= (b & 0x7F) << shift
+        if b < 0x80:
+            return v, pos
+        shift += 7
+
+
+# =========================================================
+# columns
+# =========================================================
+# (prefix bits, prefix len, payload bits) สำหรับ delta-of-delta
+_DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+
+def encode_ts(ts: Sequence[int]) -> bytes:
+    w = BitWriter()
+    if not ts:
+        return b""
+    w.write(ts[0], 64)
+    prev, prev_delta = ts[0], 0
+    for t in ts[1:]:
+        delta = t - prev
+        dod = delta - prev_delta
+        if dod == 0:
+            w.write(0, 1)
+        else:
+            for prefix, plen, bits in _DOD_BUCKETS:
+                if -(1 << (bits - 1)) <= dod < (1 << (bits - 1)):
+                    w.write(prefix, plen)
+                    w.write(dod, bits)
+                    break
+            else:
+                w.write(0b1111, 4)
+                w.write(dod, 64)
+        prev, prev_delta = t, delta
+    return w.getvalue()
+
+
+def decode_ts(data: bytes, n: int) -> List[int]:
+    if n == 0:
+        return []
+    r = BitReader(data)
+    out = [_signed(r.read(64), 64)]
+    prev_delta = 0
+    for _ in range(n - 1):
+        if r.read(1) == 0:
+            dod = 0
+        elif r.read(1) == 0:
+            dod = _signed(r.read(7), 7)
+        elif r.read(1) == 0:
+            dod = _signed(r.read(9), 9)
+        elif r.read(1) == 0:
+            dod = _signed(r.read(12), 12)
+        else:
+            dod = _signed(r.read(64), 64)
+        prev_delta += dod
+        out.append(out[-1] + prev_delta)
+    return out
+
+
+def _f2i(x: float) -> int:
+    return struct.unpack(">Q", struct.pack(">d", x))[0]
+
+
+def _i2f(v: int) -> float:
+    return struct.unpack(">d", struct.pack(">Q", v))[0]
+
+
+def encode_floats(values: Sequence[Optional[float]]) -> bytes:
+    """1 บิตบอกว่ามีค่าไหม ตามด้วย XOR กับค่าก่อนหน้า (ข้าม None)"""
+    w = BitWriter()
+    prev = None
+    lead, trail = 65, 0   # หน้าต่างของค่าก่อนหน้า (65 = ยังไม่มี)
+    for v in values:
+        if v is None:
+            w.write(0, 1)
+            continue
+        w.write(1, 1)
+        bits = _f2i(float(v))
+        if prev is None:
+            w.write(bits, 64)
+            prev = bits
+            continue
+        x = bits ^ prev
+        prev = bits
+        if x == 0:
+            w.write(0, 1)
+            continue
+        w.write(1, 1)
+        lz = min(64 - x.bit_length(), 31)
+        tz = (x & -x).bit_length() - 1
+        if lead <= lz and trail <= tz:
+            # ใช้หน้าต่างเดิม
+            w.write(0, 1)
+            w.write(x >> trail, 64 - lead - trail)
+        else:
+            w.write(1, 1)
+            sig = 64 - lz - tz
+            w.write(lz, 5)
+            w.write(sig - 1, 6)
+            w.write(x >> tz, sig)
+            lead, trail = lz, tz
+    return w.getvalue()
+
+
+def decode_floats(data: bytes, n: int) -> List[Optional[float]]:
+    r = BitReader(data)
+    out: List[Optional[float]] = []
+    prev = None
+    lead = trail = 0
+    for _ in range(n):
+        if r.read(1) == 0:
+            out.append(None)
+            continue
+        if prev is None:
+            prev = r.read(64)
+        elif r.read(1) == 1:
+            if r.read(1) == 1:
+                lead = r.read(5)
+                sig = r.read(6) + 1
+                trail = 64 - lead - sig
+            prev ^= r.read(64 - lead - trail) << trail
+        out.append(_i2f(prev))
+    return out
+
+
+def encode_cycles(values: Sequence[Optional[int]]) -> bytes:
+    """คู่ (tag, run): tag 0 = None, ไม่งั้น zigzag(delta)+1 จากค่าล่าสุดที่ไม่ใช่ None"""
+    out = bytearray()
+    prev = 0
+    tag, run = None, 0
+    for v in values:
+        if v is None:
+            t = 0
+        else:
+            t = _zigzag(int(v) - prev) + 1
+            prev = int(v)
+        # ค่าคงที่ (delta 0) หรือเพิ่มทีละเท่าเดิม -> รวมเป็น run เดียว
+        if t == tag:
+            run += 1
+            continue
+        if tag is not None:
+            _put_varint(out, tag)
+            _put_varint(out, run)
+        tag, run = t, 1
+    if tag is not None:
+        _put_varint(out, tag)
+        _put_varint(out, run)
+    return bytes(out)
+
+
+def decode_cycles(data: bytes, n: int) -> List[Optional[int]]:
+    out: List[Optional[int]] = []
+    prev = 0
+    pos = 0
+    while len(out) < n:
+        tag, pos = _get_varint(data, pos)
+        run, pos = _get_varint(data, pos)
+        for _ in range(run):
+            if tag == 0:
+                out.append(None)
+            else:
+                prev += _unzigzag(tag - 1)
+                out.append(prev)
+    return out
+
+
+# =========================================================
+# block = header + 4 length-prefixed columns
+# =========================================================
+def encode_block(rows: Sequence[Row]) -> bytes:
+    """rows: (ts_ms, temp, level, cycles) เรียงตาม ts_ms"""
+    cols = (
+        encode_ts([int(r[0]) for r in rows]),
+        encode_floats([r[1] for r in rows]),
+        encode_floats([r[2] for r in rows]),
+        encode_cycles([r[3] for r in rows]),
+    )
+    out = bytearray([CODEC_VERSION])
+    _put_varint(out, len(rows))
+    for c in cols:
+        _put_varint(out, len(c))
+        out += c
+    return bytes(out)
+
+
+def decode_block(blob: bytes) -> List[Row]:
+    if not blob:
+        return []
+    if blob[0] != CODEC_VERSION:
+        raise ValueError(f"unknown archive codec version {blob[0]}")
+    n, pos = _get_varint(blob, 1)
+    cols = []
+    for _ in range(4):
+        size, pos = _get_varint(blob, pos)
+        cols.append(blob[pos:pos + size])
+        pos += size
+    ts = decode_ts(cols[0], n)
+    temp = decode_floats(cols[1], n)
+    level = decode_floats(cols[2], n)
+    cycles = decode_cycles(cols[3], n)
+    return list(zip(ts, temp, level, cycles))
+
+
+# =========================================================
+# storage
+# =========================================================
+def ensure_archive_table(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS readings_archive(
+      device_id TEXT NOT NULL,
+      hour_start_ms INTEGER NOT NULL,
+      n INTEGER NOT NULL,
+      ts_first INTEGER NOT NULL,
+      ts_last INTEGER NOT NULL,
+      raw_bytes INTEGER NOT NULL,
+      blob BLOB NOT NULL,
+      PRIMARY KEY (device_id, hour_start_ms)
+    )""")
+
+
+def row_bytes(device_id: str) -> int:
+    # ขนาดโดยประมาณของหนึ่งแถวใน partition: id + ts + 2 REAL + cycles + uploaded + device_id
+    return 8 + 8 + 8 + 8 + 4 + 1 + len(device_id)
+
+
+def archive_hour(cur, device_id: str, hour_start_ms: int) -> Optional[Tuple[int, int]]:
+    """แพ็คชั่วโมงนั้นลง readings_archive คืน (จำนวนแถว, ขนาด blob) หรือ None ถ้าไม่มีข้อมูล"""
+    rows = partitions.query_range(cur, device_id, hour_start_ms, hour_start_ms + HOUR_MS)
+    if not rows:
+        return None
+    blob = encode_block(rows)
+    raw_bytes = len(rows) * row_bytes(device_id)
+    cur.execute(
+        """
+        INSERT OR REPLACE INTO readings_archive(device_id, hour_start_ms, n, ts_first, ts_last, raw_bytes, blob)
+        VALUES(?,?,?,?,?,?,?)
+        """,
+        (device_id, hour_start_ms, len(rows), rows[0][0], rows[-1][0], raw_bytes, sqlite3.Binary(blob)),
+    )
+    return len(rows), len(blob)
+
+
+def pending_hours(cur, device_id: str, now_ms: int) -> List[int]:
+    """ชั่วโมงที่ปิดแล้ว + สรุปเป็น minutes แล้ว + ยังไม่อยู่ใน archive"""
+    last = cur.execute(
+        "SELECT MAX(ts_minute) FROM minutes WHERE device_id=?", (device_id,)
+    ).fetchone()[0]
+    if last is None:
+        return []
+    # ชั่วโมงต้องจบก่อนทั้ง "ตอนนี้" และ "นาทีสุดท้ายที่ aggregator ทำเสร็จ"
+    limit = min((now_ms // HOUR_MS) * HOUR_MS, ((int(last) + 60000) // HOUR_MS) * HOUR_MS)
+
+    done = {h for (h,) in cur.execute(
+        "SELECT hour_start_ms FROM readings_archive WHERE device_id=?", (device_id,))}
+    hours = set()
+    for _, name in partitions.list_partitions(cur):
+        for (h,) in cur.execute(
+            f"SELECT DISTINCT ts_ms / {HOUR_MS} FROM {name} WHERE device_id=? AND ts_ms < ?",
+            (device_id, limit),
+        ):
+            hours.add(int(h) * HOUR_MS)
+    return sorted(hours - done)
+
+
+def archive_partition(cur, name: str) -> int:
+    """
+    แพ็คทุก (เครื่อง, ชั่วโมง) ใน partition ที่ยังไม่อยู่ใน archive ครบ (จำนวนแถวไม่ตรง)
+    ใช้ก่อน DROP partition ตาม retention — ไม่รอ minutes เพราะ raw กำลังจะหายไป
+    คืนจำนวน block ที่เขียน
+    """
+    ensure_archive_table(cur)
+    n = 0
+    for did, h, cnt in cur.execute(
+        f"SELECT device_id, ts_ms / {HOUR_MS}, COUNT(*) FROM {name} GROUP BY device_id, ts_ms / {HOUR_MS}"
+    ).fetchall():
+        row = cur.execute("SELECT n FROM readings_archive WHERE device_id=? AND hour_start_ms=?",
+                          (did, int(h) * HOUR_MS)).fetchone()
+        if row is None or row[0] != cnt:
+            archive_hour(cur, did, int(h) * HOUR_MS)
+            n += 1
+    return n
+
+
+def partition_archived(cur, name: str) -> bool:
+    """ทุกแถวของ partition อยู่ใน archive แล้ว (จำนวนต่อ (เครื่อง, ชั่วโมง) ตรงกัน)"""
+    ensure_archive_table(cur)
+    missing = cur.execute(f"""
+        SELECT 1 FROM (
+          SELECT device_id, ts_ms / {HOUR_MS} AS h, COUNT(*) AS cnt FROM {name} GROUP BY device_id, h
+        ) p
+        LEFT JOIN readings_archive a ON a.device_id = p.device_id AND a.hour_start_ms = p.h * {HOUR_MS}
+        WHERE a.n IS NOT p.cnt
+        LIMIT 1
+    """).fetchone()
+    return missing is None
+
+
+def iter_blocks(cur, device_id: str, start_ms: int, end_ms: int) -> Iterator[Tuple[int, List[Row]]]:
+    """(hour_start_ms, rows) ของทุก block ที่ทับช่วง [start_ms, end_ms)"""
+    q = cur.execute(
+        """
+        SELECT hour_start_ms, blob FROM readings_archive
+        WHERE device_id=? AND hour_start_ms < ? AND hour_start_ms + ? > ?
+        ORDER BY hour_start_ms
+        """,
+        (device_id, end_ms, HOUR_MS, start_ms),
+    ).fetchall()
+    for hour, blob in q:
+        yield hour, [r for r in decode_block(bytes(blob)) if start_ms <= r[0] < end_ms]
+
+
+def read_range(cur, device_id: str, start_ms: int, end_ms: int) -> Iterator[Row]:
+    """
+    (ts_ms, temp, level, cycles) เรียงตามเวลา: ชั่วโมงที่อยู่ใน archive อ่านจาก blob,
+    ช่วงที่เหลืออ่านจาก partition รายวัน
+    """
+    t = start_ms
+    for hour, rows in iter_blocks(cur, device_id, start_ms, end_ms):
+        if t < hour:
+            yield from partitions.query_range(cur, device_id, t, hour)
+        yield from rows
+        t = max(t, hour + HOUR_MS)
+    if t < end_ms:
+        yield from partitions.query_range(cur, device_id, t, end_ms)
+
+
+def drop_archive_before(cur, cutoff_ms: int) -> int:
+    cur.execute("DELETE FROM readings_archive WHERE hour_start_ms + ? <= ?", (HOUR_MS, cutoff_ms))
+    return cur.rowcount
+
+
+# =========================================================
+# MAIN
+# =========================================================
+def main():
+    conn = connect(DB)
+    cur = conn.cursor()
+    ensure_readings_table(cur)
+    ensure_minutes_table(cur)
+    ensure_archive_table(cur)
+    conn.commit()
+
+    now_ms = int(time.time() * 1000)
+    for did in device_ids():
+        n_rows = n_bytes = raw = 0
+        hours = pending_hours(cur, did, now_ms)[:ARCHIVE_MAX_HOURS]
+        for h in hours:
+            res = archive_hour(cur, did, h)
+            if res:
+                n_rows += res[0]
+                n_bytes += res[1]
+                raw += res[0] * row_bytes(did)
+            conn.commit()   # ทีละชั่วโมง ไม่ถือ lock นาน
+        if hours:
+            ratio = raw / n_bytes if n_bytes else 0
+            print(f"[archive] device={did} hours={len(hours)} rows={n_rows} "
+                  f"bytes={n_bytes} (~{ratio:.1f}x)", flush=True)
+
+    removed = drop_archive_before(cur, now_ms - ARCHIVE_RETENTION_DAYS * 86_400_000)
+    conn.commit()
+    if removed:
+        print(f"[archive] ลบ block ที่เก่ากว่า {ARCHIVE_RETENTION_DAYS} วัน: {removed}", flush=True)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
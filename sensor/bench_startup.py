@@ -0,0 +1,139 @@
+# sensor/bench_startup.py
+"""
+Start-up cost of the periodic jobs: cron one-shot vs. the persistent worker.
+
+For every job module it measures, in fresh interpreters,
+
+  import    wall time of `python -c "import sensor.<job>"` minus a bare
+            `python -c pass`, and which cloud SDKs that import pulled in
+            (firebase_admin, google.cloud.firestore, google.api_core, grpc)
+  cold run  `python -m sensor.<job>` against BENCH_DB (local-only jobs)
+
+and, in this process, the warm run: run_once() on an open connection,
+which is what sensor/worker.py pays per tick.
+
+Importing a job must not load a cloud SDK — with BENCH_STRICT=1 the
+script exits 1 if one does, so it can guard a deploy.
+
+  BENCH_DB       scratch database (seeded with an hour of readings)
+  BENCH_REPEAT   runs per measurement (median is reported)
+
+Run:  python -m sensor.bench_startup
+"""
+import io
+import os
+import sys
+import contextlib
+import time
+import subprocess
+import statistics
+from typing import Dict, List, Optional, Tuple
+
+BENCH_DB = os.getenv("BENCH_DB", "/tmp/tempmon-bench.sqlite")   # อย่าชี้ไปที่ DB จริง
+BENCH_REPEAT = int(os.getenv("BENCH_REPEAT", "5"))
+BENCH_STRICT = os.getenv("BENCH_STRICT", "0") == "1"
+
+# ทุก job (และ subprocess) ใช้ DB ทดลอง ไม่ส่ง Telegram / ไม่แตะ GPIO
+os.environ.update(DB=BENCH_DB, BUDGET_DB=BENCH_DB, TELEGRAM_ENABLE="0", GPIO_ENABLE="0")
+
+JOBS = ("minute_aggregator", "minute_uploader", "uploader_30m", "alert_worker",
+        "cleanup", "cleanup_old_data", "worker")
+LOCAL_JOBS = ("minute_aggregator", "alert_worker", "cleanup_old_data")   # รันได้โดยไม่มี Firestore
+HEAVY = ("firebase_admin", "google.cloud.firestore", "google.api_core", "grpc")
+
+_PROBE = ("import sys, sensor.{job}; "
+          "print(','.join(m for m in {heavy!r} if m in sys.modules))")
+
+
+def _run(args: List[str]) -> Tuple[float, str]:
+    t0 = time.perf_counter()
+    p = subprocess.run([sys.executable] + args, capture_output=True, text=True, env=os.environ)
+    ms = (time.perf_counter() - t0) * 1000.0
+    if p.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed: {p.stderr.strip()[-300:]}")
+    return ms, p.stdout
+
+
+def _median(fn, n: int = BENCH_REPEAT) -> float:
+    return statistics.median(fn() for _ in range(max(1, n)))
+
+
+def seed(db: str = BENCH_DB, minutes: int = 60, rate_hz: float = 1.0):
+    """readings ย้อนหลัง `minutes` นาทีของเครื่อง DEVICE_ID (ให้ aggregator/alerts มีงานจริง)"""
+    from sensor.local_db import connect, ensure_readings_table, ensure_minutes_table
+    from sensor import partitions
+    con = connect(db)
+    cur = con.cursor()
+    ensure_readings_table(cur)
+    ensure_minutes_table(cur)
+    device = os.getenv("DEVICE_ID", "pi5-001")
+    now_ms = int(time.time() * 1000)
+    step = int(1000 / rate_hz)
+    start = now_ms - minutes * 60000
+    last = cur.execute("SELECT MAX(ts_ms) FROM readings WHERE device_id=?", (device,)).fetchone()[0]
+    if last is None or last < now_ms - 120000:
+        partitions.insert_rows(cur, [
+            (device, ts, 30.0 + (ts // 1000) % 7 * 0.1, 35.0, (ts - start) // 3000)
+            for ts in range(max(start, (last or 0) + step), now_ms, step)
+        ])
+    con.commit()
+    con.close()
+
+
+def cold_import(job: str) -> Dict:
+    base = _median(lambda: _run(["-c", "pass"])[0])
+    probe = _PROBE.format(job=job, heavy=HEAVY)
+    loaded = _run(["-c", probe])[1].strip()
+    ms = _median(lambda: _run(["-c", probe])[0])
+    return {"import_ms": round(max(0.0, ms - base), 1), "python_ms": round(base, 1),
+            "sdk": [m for m in loaded.split(",") if m]}
+
+
+def cold_run(job: str) -> Optional[float]:
+    if job not in LOCAL_JOBS:
+        return None
+    return round(_median(lambda: _run(["-m", f"sensor.{job}"])[0]), 1)
+
+
+def warm_run(job: str) -> Optional[float]:
+    if job not in LOCAL_JOBS:
+        return None
+    import importlib
+    from sensor.local_db import connect
+    mod = importlib.import_module(f"sensor.{job}")
+    con = connect(BENCH_DB, isolation_level=None if job == "cleanup_old_data" else "")
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):   # log ของ job ไม่ต้องปนตาราง
+            mod.run_once(con)   # รอบแรกสร้างตาราง/แคช — ไม่นับ
+
+            def once():
+                t0 = time.perf_counter()
+                mod.run_once(con)
+                return (time.perf_counter() - t0) * 1000.0
+            return round(_median(once), 2)
+    finally:
+        con.close()
+
+
+def main():
+    seed()
+    print(f"[bench] python={sys.version.split()[0]} db={BENCH_DB} repeat={BENCH_REPEAT}", flush=True)
+    print(f"{'job':<18}{'import ms':>10}{'cold run ms':>13}{'warm run ms':>13}  sdk at import", flush=True)
+    offenders = []
+    for job in JOBS:
+        imp = cold_import(job)
+        cold = cold_run(job)
+        warm = warm_run(job)
+        if imp["sdk"]:
+            offenders.append(job)
+        print(f"{job:<18}{imp['import_ms']:>10}{'-' if cold is None else cold:>13}"
+              f"{'-' if warm is None else warm:>13}  {','.join(imp['sdk']) or '-'}", flush=True)
+    print(f"[bench] interpreter start-up alone: {imp['python_ms']}ms per one-shot", flush=True)
+    if offenders:
+        print(f"[bench] cloud SDK imported at module import: {offenders}", flush=True)
+        if BENCH_STRICT:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
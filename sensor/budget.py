@@ -0,0 +1,214 @@
+# sensor/budget.py
+"""
+Shared daily Firestore budget (reads / writes / deletes).
+
+Every process that talks to Firestore (collectors, uploaders, cleanup, the
+Django views) asks here before an operation and the spend is recorded in
+SQLite table `budget_spend`, so all workers see one counter per day.
+
+  budget_spend  day, op, cls -> used, denied
+
+The day follows the Firestore quota reset (midnight America/Los_Angeles,
+BUDGET_TZ). Traffic classes in priority order:
+
+  alerts > latest > minutes > backfill > cleanup
+
+A class may spend until the *total* spend of that op reaches its share of
+the daily limit (BUDGET_SHARES), so the last 5-20% of the day's quota is
+always left for alerts and latest values. Bulk classes (BUDGET_PACED) are
+also paced like a token bucket that refills over the day: by 15:00 they
+may have used at most ~62% (+ BUDGET_BURST) of their share, so they can't
+drain the quota by mid-afternoon.
+
+If the budget DB can't be opened the check fails open (prints once).
+
+  BUDGET_WRITES / BUDGET_READS / BUDGET_DELETES   daily limits (free tier)
+  BUDGET_ENFORCE=0                                count only, never deny
+"""
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    from backports.zoneinfo import ZoneInfo  # type: ignore
+
+BUDGET_DB = os.getenv("BUDGET_DB", os.getenv("DB", "/var/lib/tempmon/data.sqlite"))
+BUDGET_TZ = os.getenv("BUDGET_TZ", "America/Los_Angeles")   # โควต้า Firestore รีเซ็ตเที่ยงคืนเวลานี้
+BUDGET_ENFORCE = os.getenv("BUDGET_ENFORCE", "1") == "1"
+BUDGET_BURST = float(os.getenv("BUDGET_BURST", "0.1"))      # ใช้ล่วงหน้าได้กี่ส่วนของวัน (คลาสที่ pace)
+
+LIMITS = {
+    "write": int(os.getenv("BUDGET_WRITES", "20000")),
+    "read": int(os.getenv("BUDGET_READS", "50000")),
+    "delete": int(os.getenv("BUDGET_DELETES", "20000")),
+}
+
+CLASSES = ("alerts", "latest", "minutes", "backfill", "cleanup")   # สำคัญมาก -> น้อย
+
+
+def _parse_shares(s: str) -> Dict[str, float]:
+    out = {}
+    for part in s.split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip()] = float(v)
+    return out
+
+
+SHARES = _parse_shares(os.getenv(
+    "BUDGET_SHARES", "alerts=1.0,latest=0.95,minutes=0.8,backfill=0.6,cleanup=0.4"))
+PACED = {c.strip() for c in os.getenv("BUDGET_PACED", "minutes,backfill,cleanup").split(",") if c.strip()}
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, op: str, cls: str, n: int):
+        super().__init__(f"{op} budget for '{cls}' exhausted (n={n})")
+        self.op, self.cls, self.n = op, cls, n
+
+
+def ensure_budget_table(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS budget_spend(
+      day TEXT NOT NULL,
+      op TEXT NOT NULL,
+      cls TEXT NOT NULL,
+      used INTEGER NOT NULL DEFAULT 0,
+      denied INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (day, op, cls)
+    )""")
+
+
+# ---------- connection (หนึ่งต่อ thread) ----------
+_local = threading.local()
+_warned = False
+
+
+def _conn() -> Optional[sqlite3.Connection]:
+    global _warned
+    con = getattr(_local, "con", None)
+    if con is not None:
+        return con
+    try:
+        con = sqlite3.connect(BUDGET_DB, timeout=5, isolation_level=None)
+        ensure_budget_table(con.cursor())
+    except Exception as e:
+        if not _warned:
+            print(f"[budget] cannot open {BUDGET_DB}: {e} (not enforcing)", flush=True)
+            _warned = True
+        return None
+    _local.con = con
+    return con
+
+
+# ---------- day / ceilings ----------
+def day_key(now: Optional[float] = None) -> Tuple[str, float]:
+    """(YYYY-MM-DD ตาม BUDGET_TZ, ส่วนของวันที่ผ่านไปแล้ว 0..1)"""
+    dt = datetime.fromtimestamp(time.time() if now is None else now, tz=timezone.utc)
+    local = dt.astimezone(ZoneInfo(BUDGET_TZ))
+    frac = (local.hour * 3600 + local.minute * 60 + local.second) / 86400.0
+    return local.strftime("%Y-%m-%d"), frac
+
+
+def ceiling(op: str, cls: str, frac: float) -> int:
+    """ยอดใช้รวม (ทุกคลาส) ของ op ที่คลาสนี้ยังใช้ต่อได้"""
+    c = SHARES.get(cls, SHARES.get("cleanup", 0.4)) * LIMITS[op]
+    if cls in PACED:
+        c *= min(1.0, frac + BUDGET_BURST)
+    return int(c)
+
+
+def _used(cur, day: str, op: str) -> int:
+    return cur.execute(
+        "SELECT COALESCE(SUM(used), 0) FROM budget_spend WHERE day=? AND op=?", (day, op)
+    ).fetchone()[0]
+
+
+def _bump(cur, day: str, op: str, cls: str, used: int, denied: int):
+    cur.execute(
+        """
+        INSERT INTO budget_spend(day, op, cls, used, denied) VALUES(?,?,?,?,?)
+        ON CONFLICT(day, op, cls) DO UPDATE SET used = used + excluded.used,
+                                                denied = denied + excluded.denied
+        """,
+        (day, op, cls, used, denied),
+    )
+
+
+# ---------- API ----------
+def try_spend(op: str, cls: str, n: int = 1, now: Optional[float] = None) -> bool:
+    """จองโควต้า n หน่วย; False = เกินส่วนของคลาสนี้ (ไม่ควรยิง Firestore)"""
+    if n <= 0:
+        return True
+    con = _conn()
+    if con is None:
+        return True
+    day, frac = day_key(now)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        cur = con.cursor()
+        ok = not BUDGET_ENFORCE or _used(cur, day, op) + n <= ceiling(op, cls, frac)
+        _bump(cur, day, op, cls, n if ok else 0, 0 if ok else n)
+        con.execute("COMMIT")
+        return ok
+    except Exception as e:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        print(f"[budget][err] {e}", flush=True)
+        return True
+
+
+def guard(op: str, cls: str, n: int = 1):
+    if not try_spend(op, cls, n):
+        raise BudgetExceeded(op, cls, n)
+
+
+def charge(op: str, cls: str, n: int, now: Optional[float] = None):
+    """บันทึกยอดที่ใช้ไปแล้ว (เช่น จำนวน doc ที่ query อ่านได้จริง) โดยไม่ตรวจ"""
+    con = _conn()
+    if con is None or n <= 0:
+        return
+    try:
+        _bump(con.cursor(), day_key(now)[0], op, cls, n, 0)
+    except Exception as e:
+        print(f"[budget][err] {e}", flush=True)
+
+
+def allowed(op: str, cls: str, n: int = 1, now: Optional[float] = None) -> bool:
+    """ตรวจอย่างเดียว ไม่จอง (ใช้ก่อน query ที่ยังไม่รู้ว่าจะอ่านกี่ doc)"""
+    con = _conn()
+    if con is None or not BUDGET_ENFORCE:
+        return True
+    day, frac = day_key(now)
+    return _used(con.cursor(), day, op) + n <= ceiling(op, cls, frac)
+
+
+def spend(now: Optional[float] = None) -> Dict:
+    """ยอดใช้วันนี้ต่อ op / คลาส สำหรับ /api/budget"""
+    day, frac = day_key(now)
+    out = {"day": day, "tz": BUDGET_TZ, "day_elapsed": round(frac, 3), "enforce": BUDGET_ENFORCE, "ops": {}}
+    con = _conn()
+    rows = []
+    if con is not None:
+        rows = con.execute("SELECT op, cls, used, denied FROM budget_spend WHERE day=?", (day,)).fetchall()
+    for op, limit in LIMITS.items():
+        per = {c: {"used": 0, "denied": 0, "ceiling": ceiling(op, c, frac)} for c in CLASSES}
+        for r_op, cls, used, denied in rows:
+            if r_op == op:
+                d = per.setdefault(cls, {"used": 0, "denied": 0, "ceiling": ceiling(op, cls, frac)})
+                d["used"], d["denied"] = used, denied
+        used = sum(d["used"] for d in per.values())
+        out["ops"][op] = {"limit": limit, "used": used, "remaining": max(0, limit - used), "classes": per}
+    return out
+
+
+def prune(keep_days: int = 30) -> int:
+    con = _conn()
+    if con is None:
+        return 0
+    cutoff = datetime.fromtimestamp(time.time() - keep_days * 86400, tz=ZoneInfo(BUDGET_TZ)).strftime("%Y-%m-%d")
+    return con.execute("DELETE FROM budget_spend WHERE day < ?", (cutoff,)).rowcount
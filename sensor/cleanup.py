@@ -2,17 +2,7 @@
 import os, time
 from datetime import datetime, timezone, timedelta
 
-# ใช้ Firestore client ตัวเดียวกับโปรเจกต์
-try:
-    from tempmon.firebase_admin_init import get_fs
-except Exception:
-    # เผื่อ import ไม่ได้ ใช้ admin SDK ตรง ๆ
-    from firebase_admin import initialize_app, firestore
-    initialize_app()
-    def get_fs():  # type: ignore
-        return firestore.client()
-
-from google.api_core.exceptions import ResourceExhausted
+from sensor import budget, outbox
 
 DEVICE_ID       = os.getenv("DEVICE_ID", "pi5-001")  # ตั้งเป็น "ALL" เพื่อลบทุก device
 RETENTION_DAYS  = int(os.getenv("RETENTION_DAYS", "7"))
@@ -20,42 +10,64 @@ MAX_DELETE      = int(os.getenv("MAX_DELETE", "4000"))  # limit การลบ
 BATCH_SIZE      = 400                                   # อย่าเกิน 500/แบตช์
 DRY_RUN         = os.getenv("DRY_RUN", "0") == "1"      # 1 = แค่ลอง ไม่ลบจริง
 
+def get_fs():
+    # ใช้ Firestore client ตัวเดียวกับโปรเจกต์ (import ตอนรันจริง ไม่ใช่ตอน import โมดูล)
+    try:
+        from tempmon.firebase_admin_init import get_fs as _get_fs
+    except Exception:
+        # เผื่อ import ไม่ได้ ใช้ admin SDK ตรง ๆ
+        import firebase_admin
+        from firebase_admin import firestore
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app()
+        return firestore.client()
+    return _get_fs()
+
 def _delete_query(q, db):
-    batch = db.batch()
+    """
+    ลบทีละหน้า (BATCH_SIZE) โดยหักงบ read/delete คลาส cleanup ก่อนทุกหน้า
+    งบหมด = หยุดรันนี้ (cleanup สำคัญน้อยสุด ปล่อยโควต้าให้ latest/minutes)
+    """
     n = 0
-    backoff = 1
-    for doc in q.stream():
+    while n < MAX_DELETE:
+        page = min(BATCH_SIZE, MAX_DELETE - n)
+        if not budget.allowed("read", "cleanup", page):
+            print("[cleanup] read budget reached; stop", flush=True)
+            break
+        # DRY_RUN: นับอย่างเดียว (หน้าเดียว เพราะไม่ได้ลบ query จะได้ชุดเดิมซ้ำ)
+        docs = list(q.limit(MAX_DELETE if DRY_RUN else page).stream())
+        budget.charge("read", "cleanup", max(1, len(docs)))
         if DRY_RUN:
-            n += 1
-            if n >= MAX_DELETE: break
-            continue
-
-        batch.delete(doc.reference)
-        n += 1
-
-        if n % BATCH_SIZE == 0:
-            while True:
-                try:
-                    batch.commit()
-                    batch = db.batch()
-                    backoff = 1
-                    break
-                except ResourceExhausted:
-                    time.sleep(backoff)
-                    backoff = min(backoff * 2, 60)
-
-        if n >= MAX_DELETE:
+            return len(docs)
+        if not docs:
+            break
+        if not budget.try_spend("delete", "cleanup", len(docs)):
+            print("[cleanup] delete budget reached; stop", flush=True)
             break
 
-    if not DRY_RUN:
-        try:
-            batch.commit()
-        except ResourceExhausted:
-            time.sleep(2); batch.commit()
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        backoff = 1
+        for _ in range(6):
+            try:
+                batch.commit()
+                break
+            except outbox.ResourceExhausted:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+        else:
+            print("[cleanup] quota exhausted; stop", flush=True)
+            break
+        n += len(docs)
+        if len(docs) < page:
+            break
     return n
 
-def main():
-    db = get_fs()
+def run_once(db=None) -> int:
+    """ลบ readings เก่าบน Firestore หนึ่งรอบ (worker ส่ง client ที่อุ่นอยู่แล้วมาได้) คืนจำนวนที่ลบ"""
+    if db is None:
+        db = get_fs()
     cutoff = datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)
     print(f"[cleanup] cutoff < {cutoff.isoformat()} | DEVICE_ID={DEVICE_ID} | DRY_RUN={DRY_RUN}")
 
@@ -80,6 +92,10 @@ def main():
             break
 
     print(f"[cleanup] DONE total_deleted={deleted_total} (dry_run={DRY_RUN})")
+    return deleted_total
+
+def main():
+    run_once()
 
 if __name__ == "__main__":
     main()
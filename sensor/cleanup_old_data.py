@@ -1,14 +1,52 @@
-import sqlite3
+# sensor/cleanup_old_data.py
+# ลบ raw readings ที่เก่ากว่า RETENTION_DAYS วัน
+# readings แยกเป็นตารางรายวัน -> ลบทั้งวันด้วย DROP TABLE (ไม่ต้อง DELETE ทีละแถว)
+# ก่อนลบ: แพ็คชั่วโมงที่ยังไม่อยู่ใน readings_archive (sensor/archive.py) — ไม่มีแถวไหนหายถาวร
+import os
 
-conn = sqlite3.connect("sensor.db")  
-cursor = conn.cursor()
+from sensor.local_db import connect
+from sensor import archive, budget, partitions
 
-cursor.execute("""
-DELETE FROM sensor_data
-WHERE datetime(created_at) < datetime('now', '-7 days')
-""")
+DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "7"))
 
-conn.commit()
-conn.close()
 
-print("ลบข้อมูลที่เก่ากว่า 7 วันเรียบร้อย")
+def run_once(conn) -> list:
+    """DROP partition ที่เก่าเกิน + คืนหน้าว่าง + ล้างงบเก่า (conn ต้องเป็น isolation_level=None)"""
+    cur = conn.cursor()
+
+    dropped, kept = [], []
+    for _, name in partitions.expired(cur, partitions.retention_cutoff(RETENTION_DAYS)):
+        # ทีละวัน: archive + DROP ใน transaction เดียว (ล้มกลางทาง = วันนั้นยังอยู่ครบ)
+        cur.execute("BEGIN")
+        try:
+            archive.archive_partition(cur, name)
+            if archive.partition_archived(cur, name):
+                dropped += partitions.drop(cur, [name])
+            else:
+                kept.append(name)
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+    if kept:
+        print(f"[cleanup_old_data] ยังไม่ลบ (archive ไม่ครบ): {kept}", flush=True)
+
+    # คืนหน้าว่างให้ระบบไฟล์ (มีผลเมื่อ DB สร้างด้วย auto_vacuum=INCREMENTAL)
+    cur.execute("PRAGMA incremental_vacuum").fetchall()
+    budget.prune()
+
+    print(f"ลบข้อมูลที่เก่ากว่า {RETENTION_DAYS} วันเรียบร้อย ({len(dropped)} partition: {dropped})")
+    return dropped
+
+
+def main():
+    conn = connect(DB, isolation_level=None)
+    try:
+        run_once(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,11 @@ from typing import List, Optional, Tuple, Dict
 from datetime import datetime, timezone, timedelta
 
 from firebase_admin import firestore
-from sensor.firebase_admin_init import get_fs, get_active
+from sensor.firebase_admin_init import get_fs_named, get_active, report
+from sensor.scheduler import DeadlineScheduler
+from sensor import budget
+from sensor.latest_state import LatestState
+from sensor import latest_shm
 
 try:
     from google.api_core.exceptions import ResourceExhausted
@@ -19,7 +23,7 @@ LATEST_EVERY    = int(os.getenv("LATEST_EVERY",    "10"))    # อัปเด
 READING_EVERY   = int(os.getenv("READING_EVERY",   "20"))    # เพิ่ม readings ทุก N รอบ
 RETENTION_DAYS  = int(os.getenv("RETENTION_DAYS",  "7"))
 DEMO            = int(os.getenv("DEMO", "1"))                # ตั้ง 1 เพื่อจำลองก่อน
-LOCAL_LAST_JSON = os.getenv("LOCAL_LAST_JSON", "/tmp/last_temp.json")
+LOCAL_LAST_JSON = os.getenv("LOCAL_LAST_JSON", "")   # ตั้ง path = เขียนไฟล์ JSON แบบเดิมด้วย (ตัวอ่านรุ่นเก่า)
 
 # -------- Sensor readers --------
 def read_temp_c() -> Optional[float]:
@@ -68,39 +72,27 @@ def read_cycles() -> Optional[float]:
         return None
 
 # -------- Writers --------
-def write_latest(fs, device_id: str, t: Optional[float], a: Optional[float],
-                 lvl_cm: Optional[float], lvl_pct: Optional[float], cyc: Optional[float]):
-    latest = (fs.collection("devices").document(device_id)
-                .collection("series").document("latest"))
-    payload = {}
-    if t is not None:
-        payload["temp"]    = {"value": t, "unit": "°C", "createdAt": firestore.SERVER_TIMESTAMP}
-    if a is not None:
-        payload["current"] = {"value": a, "unit": "A",  "createdAt": firestore.SERVER_TIMESTAMP}
-    if lvl_cm is not None or lvl_pct is not None:
-        payload["level"]   = {"value": lvl_cm, "unit": "cm", "percent": lvl_pct,
-                              "createdAt": firestore.SERVER_TIMESTAMP}
-    if cyc is not None:
-        payload["cycles"]  = {"value": cyc, "unit": "cpm", "createdAt": firestore.SERVER_TIMESTAMP}
-    if payload:
-        latest.set(payload, merge=True)
+def doc_id(ts: float, seconds: bool = True) -> str:
+    """doc id จากเวลา (UTC): YYYYMMDDHHmmss / YYYYMMDDHHmm -> retry ซ้ำได้ และ range ตาม id ได้"""
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y%m%d%H%M%S" if seconds else "%Y%m%d%H%M")
 
 def append_readings(fs, device_id: str, t: Optional[float], a: Optional[float],
-                    lvl_cm: Optional[float], lvl_pct: Optional[float], cyc: Optional[float]):
+                    lvl_cm: Optional[float], lvl_pct: Optional[float], cyc: Optional[float],
+                    tick_ts: float):
     ts = firestore.SERVER_TIMESTAMP
     exp = datetime.now(timezone.utc) + timedelta(days=RETENTION_DAYS)
+    rid = doc_id(tick_ts)
+    def readings(metric):
+        return (fs.collection("devices").document(device_id).collection("series").document(metric)
+                  .collection("readings").document(rid))
     if t is not None:
-        fs.collection("devices").document(device_id).collection("series").document("temp")\
-          .collection("readings").add({"temp_c": t, "createdAt": ts, "expiresAt": exp})
+        readings("temp").set({"temp_c": t, "createdAt": ts, "expiresAt": exp}, merge=True)
     if a is not None:
-        fs.collection("devices").document(device_id).collection("series").document("current")\
-          .collection("readings").add({"value": a, "createdAt": ts, "expiresAt": exp})
+        readings("current").set({"value": a, "createdAt": ts, "expiresAt": exp}, merge=True)
     if lvl_cm is not None or lvl_pct is not None:
-        fs.collection("devices").document(device_id).collection("series").document("level")\
-          .collection("readings").add({"value": lvl_cm, "percent": lvl_pct, "createdAt": ts, "expiresAt": exp})
+        readings("level").set({"value": lvl_cm, "percent": lvl_pct, "createdAt": ts, "expiresAt": exp}, merge=True)
     if cyc is not None:
-        fs.collection("devices").document(device_id).collection("series").document("cycles")\
-          .collection("readings").add({"value": cyc, "createdAt": ts, "expiresAt": exp})
+        readings("cycles").set({"value": cyc, "createdAt": ts, "expiresAt": exp}, merge=True)
 
 @dataclass
 class MinuteBuf:
@@ -124,13 +116,13 @@ def write_minutes(fs, device_id: str, buf: MinuteBuf):
     l_avg,l_min,l_max = stat(buf.levels)
     y_avg,y_min,y_max = stat(buf.cycles)
     minutes = fs.collection("sensors").document(device_id).collection("minutes")
-    minutes.add({
+    minutes.document(doc_id(buf.start_ts, seconds=False)).set({
         "createdAt": firestore.SERVER_TIMESTAMP,
         "avg": t_avg, "min": t_min, "max": t_max,
         "avg_current": c_avg, "min_current": c_min, "max_current": c_max,
         "avg_level": l_avg, "min_level": l_min, "max_level": l_max,
         "avg_cycles": y_avg, "min_cycles": y_min, "max_cycles": y_max,
-    })
+    }, merge=True)
 
 # -------- Main loop --------
 def main():
@@ -138,24 +130,40 @@ def main():
           f"loop={INTERVAL_SEC}s latest_every={LATEST_EVERY} reading_every={READING_EVERY} "
           f"ttl={RETENTION_DAYS}d DEMO={DEMO}", flush=True)
 
-    next_latest  = 0.0
-    next_reading = 0.0
-    cur_minute   = int(time.time() // 60)
-    minbuf = MinuteBuf()
-    backoff = 1.0
-
-    while True:
-        fs = get_fs()  # อ่าน active ทุกลูป → ปุ่มสลับเห็นผลทันที
-        now = time.time()
-        now_dt = datetime.now(timezone.utc)
+    # ค่าล่าสุดที่ task sample อ่านได้ ใช้ร่วมกันทุก task
+    st = {
+        "fs": None, "project": None, "t": None, "a": None, "lvl_cm": None, "lvl_pct": None, "cyc": None,
+        "minbuf": MinuteBuf(), "latest_hold_until": 0.0, "backoff": 1.0,
+    }
+    state = LatestState(DEVICE_ID)   # devices/{id}.latest เขียนเฉพาะ metric ที่เปลี่ยนเกินเดดแบนด์
+    try:
+        shm = latest_shm.Publisher()     # ค่าล่าสุดใน /dev/shm ให้ views / alert_worker อ่านโดยไม่แตะดิสก์
+    except Exception as e:
+        print(f"[collector] latest_shm disabled: {e}", flush=True)
+        shm = None
+
+    def sample(tick_ts):
+        # อ่าน active ทุกรอบ (แคชตาม mtime) → ปุ่มสลับ / failover เห็นผลทันที
+        project, st["fs"] = get_fs_named()
+        if project != st["project"]:
+            state.sent.clear()   # project ใหม่ยังไม่มี latest ของเรา -> เขียนครบทุก metric
+            st["project"] = project
+        now_dt = datetime.fromtimestamp(tick_ts, tz=timezone.utc)
 
         # 1) read 4 metrics
         t = read_temp_c()
         a = read_current_a()
         lvl_cm, lvl_pct = read_level_cm_pct()
         cyc = read_cycles()
-
-        # cache local (เพื่อหน้าเว็บ fallback)
+        st.update(t=t, a=a, lvl_cm=lvl_cm, lvl_pct=lvl_pct, cyc=cyc)
+        st["minbuf"].add(t, a, lvl_cm, cyc)
+
+        # ค่าล่าสุดแบบ local (หน้าเว็บ / alert_worker) — shared memory ไม่มี I/O ดิสก์
+        if shm is not None:
+            shm.publish(DEVICE_ID, int(tick_ts * 1000), temp=t, current=a,
+                        level=lvl_cm, level_pct=lvl_pct, cycles=cyc)
+        if not LOCAL_LAST_JSON:
+            return
         try:
             with open(LOCAL_LAST_JSON, "w") as f:
                 json.dump({
@@ -166,43 +174,72 @@ def main():
         except Exception:
             pass
 
-        # 2) latest
-        if now >= next_latest and fs is not None:
-            try:
-                write_latest(fs, DEVICE_ID, t, a, lvl_cm, lvl_pct, cyc)
-                print(f"[latest->{get_active()}] t={t} a={a} lvl={lvl_cm}cm/{lvl_pct}% y={cyc}", flush=True)
-                next_latest = now + LATEST_EVERY*INTERVAL_SEC
-                backoff = 1.0
-            except ResourceExhausted:
-                print("[latest] quota exhausted, backing off", flush=True)
-                time.sleep(backoff); backoff = min(backoff*2, 300)
-            except Exception as e:
-                print(f"[latest][err] {e}", flush=True)
-
+    def latest(tick_ts):
+        # 2) latest (ถ้าโดน quota ให้พักตาม backoff โดยไม่บล็อก task อื่น)
+        fs = st["fs"]
+        if fs is None or time.time() < st["latest_hold_until"]:
+            return
+        t, a, lvl_cm, lvl_pct, cyc = st["t"], st["a"], st["lvl_cm"], st["lvl_pct"], st["cyc"]
+        try:
+            changed = state.publish(fs, {"temp": t, "current": a, "level": lvl_cm, "cycles": cyc},
+                                    extra={"level": {"percent": lvl_pct}}, now=tick_ts)
+            if changed:
+                report(st["project"])
+                print(f"[latest->{st['project']}] {','.join(changed)} t={t} a={a} lvl={lvl_cm}cm/{lvl_pct}% y={cyc}", flush=True)
+            st["backoff"] = 1.0
+        except ResourceExhausted as e:
+            report(st["project"], e)
+            print("[latest] quota exhausted, backing off", flush=True)
+            st["latest_hold_until"] = time.time() + st["backoff"]
+            st["backoff"] = min(st["backoff"]*2, 300)
+        except Exception as e:
+            report(st["project"], e)
+            print(f"[latest][err] {e}", flush=True)
+
+    def readings(tick_ts):
         # 3) readings (จุดเดี่ยว)
-        if now >= next_reading and fs is not None:
-            try:
-                append_readings(fs, DEVICE_ID, t, a, lvl_cm, lvl_pct, cyc)
-                print(f"[readings->{get_active()}] appended", flush=True)
-                next_reading = now + READING_EVERY*INTERVAL_SEC
-            except ResourceExhausted:
-                print("[readings] quota exhausted, skip", flush=True)
-            except Exception as e:
-                print(f"[readings][err] {e}", flush=True)
-
+        fs = st["fs"]
+        if fs is None:
+            return
+        n = (sum(v is not None for v in (st["t"], st["a"], st["cyc"]))
+             + (st["lvl_cm"] is not None or st["lvl_pct"] is not None))
+        if not budget.try_spend("write", "minutes", n):
+            print("[readings] daily budget reached, skip", flush=True)
+            return
+        try:
+            append_readings(fs, DEVICE_ID, st["t"], st["a"], st["lvl_cm"], st["lvl_pct"], st["cyc"], tick_ts)
+            report(st["project"])
+            print(f"[readings->{st['project']}] appended", flush=True)
+        except ResourceExhausted as e:
+            report(st["project"], e)
+            print("[readings] quota exhausted, skip", flush=True)
+        except Exception as e:
+            report(st["project"], e)
+            print(f"[readings][err] {e}", flush=True)
+
+    def minutes(tick_ts):
         # 4) minutes aggregate (ทุกต้นนาที)
-        m = int(now // 60)
-        minbuf.add(t, a, lvl_cm, cyc)
-        if m != cur_minute and fs is not None:
-            try:
-                write_minutes(fs, DEVICE_ID, minbuf)
-                print(f"[minutes->{get_active()}] wrote agg", flush=True)
-            except Exception as e:
-                print(f"[minutes][err] {e}", flush=True)
-            minbuf = MinuteBuf()
-            cur_minute = m
-
-        time.sleep(INTERVAL_SEC)
+        fs = st["fs"]
+        buf, st["minbuf"] = st["minbuf"], MinuteBuf()
+        if fs is None:
+            return
+        if not budget.try_spend("write", "minutes"):
+            print("[minutes] daily budget reached, skip", flush=True)
+            return
+        try:
+            write_minutes(fs, DEVICE_ID, buf)
+            report(st["project"])
+            print(f"[minutes->{st['project']}] wrote agg", flush=True)
+        except Exception as e:
+            report(st["project"], e)
+            print(f"[minutes][err] {e}", flush=True)
+
+    sched = DeadlineScheduler("collector")
+    sched.every("sample", INTERVAL_SEC, sample)
+    sched.every("latest", LATEST_EVERY*INTERVAL_SEC, latest)
+    sched.every("readings", READING_EVERY*INTERVAL_SEC, readings)
+    sched.every("minutes", 60, minutes)
+    sched.run()
 
 if __name__ == "__main__":
     main()
@@ -2,9 +2,11 @@
 """
 Collector แบบประหยัดโควต้า:
 - loop อ่านค่าทุก INTERVAL_SEC (ดีฟอลต์ 1s) แต่ "เขียนลง Firestore" ให้น้อยที่สุด
-- อัปเดต 'latest' เป็นครั้งคราว (ควบคุมด้วย LATEST_MIN_SEC และ LATEST_DELTA)
+- อัปเดต 'latest' (devices/{DEVICE_ID}.latest, sensor/latest_state.py) เป็นครั้งคราว
+  เฉพาะ metric ที่เปลี่ยนเกิน LATEST_DELTA รวมเป็น write เดียว ไม่ถี่กว่า LATEST_MIN_SEC
 - สรุปเป็นช่วงยาว ROLLUP_MINUTES (เช่น 30 นาที) แล้วค่อยเขียนหนึ่งแถวลง
-  devices/{DEVICE_ID}/series/{metric}/readings โดยใช้ฟิลด์ *_avg/*_min/*_max
+  devices/{DEVICE_ID}/series/{metric}/readings/{YYYYMMDDHHmm ต้นช่วง} โดยใช้ฟิลด์ *_avg/*_min/*_max
+  (set merge + id คงที่ -> retry ซ้ำได้ ไม่เกิดจุดซ้ำ, อ่านช่วงเวลาด้วย range ของ doc id)
 - รองรับ get_fs() ที่อาจคืน "client ตัวเดียว" หรือ "(client, active_name)"
 """
 
@@ -12,7 +14,10 @@ import os, time, math, random
 from datetime import datetime, timezone, timedelta
 
 # ---- Firestore init (ของโปรเจ็กต์คุณ) ----
-from sensor.firebase_admin_init import get_fs, get_active  # อย่า unpack!
+from sensor.firebase_admin_init import get_fs, get_active, project_of, report  # อย่า unpack!
+from sensor.scheduler import DeadlineScheduler
+from sensor import budget
+from sensor.latest_state import LatestState
 
 try:
     from google.api_core.exceptions import ResourceExhausted
@@ -44,10 +49,10 @@ def _get_fs_and_name():
             fs = fs[0]
     except Exception:
         pass
-    # ถ้ายังไม่รู้ชื่อ active ให้ถามจาก get_active()
+    # ถ้ายังไม่รู้ชื่อ active ให้ถามจาก client (อาจ failover ไปอีก project) / get_active()
     if not active_name:
         try:
-            active_name = get_active()
+            active_name = project_of(fs) or get_active()
         except Exception:
             active_name = "primary"
     return fs, active_name
@@ -67,18 +72,20 @@ def read_real():
     # ชั่วคราวใช้ DEMO ถ้าอยากลองจริง ค่อยสลับมาที่ฟังก์ชันนี้
     return read_demo()
 
-# ---- เขียน 'latest' (อัปเดตเอกสารเดียว) ----
-def write_latest(fs, metric, payload):
-    fs.collection("devices").document(DEVICE_ID).collection("latest").document(metric).set(payload)
-
 # ---- เขียนหนึ่งแถวสรุปลง readings ----
-def add_reading(fs, metric, payload):
+def window_id(ts: float) -> str:
+    """doc id ของช่วง rollup = เวลาเริ่มช่วง (UTC) YYYYMMDDHHmm -> เรียงตาม id = เรียงตามเวลา"""
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y%m%d%H%M")
+
+def add_reading(fs, metric, payload, doc_id):
+    # id คงที่ + merge -> เขียนซ้ำ (retry) ได้ ไม่เกิดจุดซ้ำ
     fs.collection("devices") \
       .document(DEVICE_ID) \
       .collection("series") \
       .document(metric) \
       .collection("readings") \
-      .add(payload)
+      .document(doc_id) \
+      .set(payload, merge=True)
 
 def main():
     fs, active_name = _get_fs_and_name()
@@ -91,11 +98,14 @@ def main():
     )
 
     # state สำหรับ latest
-    last_latest_ts = 0.0
-    last_temp_for_delta = None
-    last_cur_for_delta = None
-    last_lvl_for_delta = None
-    last_cyc_for_delta = None
+    state = LatestState(
+        DEVICE_ID,
+        deadbands={"temp": LATEST_DELTA, "current": LATEST_DELTA / 2.0, "level": LATEST_DELTA, "cycles": 1},
+        min_interval=LATEST_MIN_SEC,
+    )
+
+    # ค่าล่าสุดจาก task sample
+    cur = {"temp_c": None, "cur_a": None, "lvl_cm": None, "lvl_percent": None, "cyc": None}
 
     # state สำหรับการสรุปเป็นช่วง
     rollup_start = time.time()
@@ -119,57 +129,13 @@ def main():
         for k in agg:
             agg[k] = {"sum":0.0, "min":None, "max":None, "n":0, **({"p_sum":0.0} if k=="level" else {})}
 
-    while True:
-        now = datetime.now(timezone.utc)
-        ts = time.time()
-
+    def sample(tick_ts):
         # ---- อ่านค่าเซนเซอร์ ----
         if DEMO:
             temp_c, cur_a, lvl_cm, lvl_percent, cyc = read_demo()
         else:
             temp_c, cur_a, lvl_cm, lvl_percent, cyc = read_real()
-
-        # ---- อัปเดต latest (ถ้าเปลี่ยนมากพอ + ผ่าน min interval) ----
-        try_write_latest = (ts - last_latest_ts) >= LATEST_MIN_SEC
-        if try_write_latest:
-            do_temp = (last_temp_for_delta is None) or (abs(temp_c - last_temp_for_delta) >= LATEST_DELTA)
-            do_cur  = (last_cur_for_delta  is None) or (abs(cur_a  - last_cur_for_delta ) >= (LATEST_DELTA/2.0))
-            do_lvl  = (last_lvl_for_delta  is None) or (abs(lvl_cm - last_lvl_for_delta ) >= (LATEST_DELTA))
-            do_cyc  = (last_cyc_for_delta  is None) or (abs(cyc   - last_cyc_for_delta ) >= 1)
-
-            try:
-                if do_temp:
-                    write_latest(fs, "temp", {
-                        "value": temp_c, "unit": "°C", "temp_f": round(temp_c*9/5+32,2),
-                        "createdAt": now, "expiresAt": now + timedelta(days=RETENTION_DAYS),
-                    })
-                    last_temp_for_delta = temp_c
-                if do_cur:
-                    write_latest(fs, "current", {
-                        "value": cur_a, "unit": "A",
-                        "createdAt": now, "expiresAt": now + timedelta(days=RETENTION_DAYS),
-                    })
-                    last_cur_for_delta = cur_a
-                if do_lvl:
-                    write_latest(fs, "level", {
-                        "value": lvl_cm, "unit": "cm", "percent": lvl_percent,
-                        "createdAt": now, "expiresAt": now + timedelta(days=RETENTION_DAYS),
-                    })
-                    last_lvl_for_delta = lvl_cm
-                if do_cyc:
-                    write_latest(fs, "cycles", {
-                        "value": cyc, "unit": "cpm",
-                        "createdAt": now, "expiresAt": now + timedelta(days=RETENTION_DAYS),
-                    })
-                    last_cyc_for_delta = cyc
-
-                if do_temp or do_cur or do_lvl or do_cyc:
-                    last_latest_ts = ts
-                    print(f"[latest->{active_name}] t={temp_c} a={cur_a} lvl={lvl_cm}cm/{lvl_percent}% y={cyc}", flush=True)
-            except ResourceExhausted:
-                print("[efficient] latest: quota exhausted – skip", flush=True)
-            except Exception as e:
-                print(f"[efficient] latest error: {e}", flush=True)
+        cur.update(temp_c=temp_c, cur_a=cur_a, lvl_cm=lvl_cm, lvl_percent=lvl_percent, cyc=cyc)
 
         # ---- สะสมสำหรับการสรุปช่วง ----
         _acc("temp", temp_c)
@@ -177,77 +143,141 @@ def main():
         _acc("level", lvl_cm, extra_percent=lvl_percent)
         _acc("cycles", float(cyc))
 
-        # ---- ครบช่วง rollup (เช่น 30 นาที) หรือครบ WRITE_MINUTES ให้เขียน readings ----
-        wrote_any = False
-        def _avg(x, field="sum"):
-            return (x[field] / x["n"]) if x["n"] else None
-
+    def refresh_fs():
+        # get_fs() แคช toggle ตาม mtime + circuit breaker -> เรียกทุก tick ได้ สลับ project อัตโนมัติ
+        nonlocal fs, active_name
+        new_fs, name = _get_fs_and_name()
+        if name != active_name:
+            print(f"[efficient] firestore project -> {name}", flush=True)
+            state.sent.clear()   # project ใหม่ต้องได้ latest ครบทุก metric
+        fs, active_name = new_fs, name
+
+    def latest(tick_ts):
+        if cur["temp_c"] is None:
+            return
+        refresh_fs()
+        temp_c, cur_a, lvl_cm, lvl_percent, cyc = (
+            cur["temp_c"], cur["cur_a"], cur["lvl_cm"], cur["lvl_percent"], cur["cyc"])
+
+        # ---- อัปเดต latest: metric ที่เปลี่ยนเกินเดดแบนด์รวมเป็น write เดียว (ไม่เปลี่ยน = ไม่เขียน) ----
+        try:
+            changed = state.publish(
+                fs, {"temp": temp_c, "current": cur_a, "level": lvl_cm, "cycles": cyc},
+                extra={"level": {"percent": lvl_percent}}, now=tick_ts,
+            )
+            if changed:
+                report(active_name)
+                print(f"[latest->{active_name}] {','.join(changed)} t={temp_c} a={cur_a} "
+                      f"lvl={lvl_cm}cm/{lvl_percent}% y={cyc}", flush=True)
+        except ResourceExhausted as e:
+            report(active_name, e)
+            print("[efficient] latest: quota exhausted – skip", flush=True)
+        except Exception as e:
+            report(active_name, e)
+            print(f"[efficient] latest error: {e}", flush=True)
+
+    # doc ที่ยังเขียนไม่สำเร็จ: (metric, doc_id) -> payload  (ลองใหม่ได้เรื่อย ๆ เพราะ id คงที่)
+    unsent = {}
+
+    def flush(tick_ts=None):
+        if not unsent:
+            return
+        refresh_fs()
+        if not budget.try_spend("write", "minutes", len(unsent)):
+            print(f"[efficient] readings: daily budget reached – {len(unsent)} doc(s) waiting", flush=True)
+            return
         try:
-            minutes_passed = (ts - rollup_start) / 60.0
-            should_rollup = minutes_passed >= max(1, ROLLUP_MINUTES)
-            should_write_minutely = (WRITE_MINUTES > 0) and (minutes_passed >= WRITE_MINUTES)
-
-            if should_rollup or should_write_minutely:
-                # temp
-                if agg["temp"]["n"]:
-                    add_reading(fs, "temp", {
-                        "temp_c_avg": round(_avg(agg["temp"]), 2),
-                        "temp_c_min": round(agg["temp"]["min"], 2),
-                        "temp_c_max": round(agg["temp"]["max"], 2),
-                        "createdAt": now,
-                        "expiresAt": now + timedelta(days=RETENTION_DAYS),
-                    }); wrote_any = True
-
-                # current
-                if agg["current"]["n"]:
-                    add_reading(fs, "current", {
-                        "value_avg": round(_avg(agg["current"]), 2),
-                        "value_min": round(agg["current"]["min"], 2),
-                        "value_max": round(agg["current"]["max"], 2),
-                        "unit": "A",
-                        "createdAt": now,
-                        "expiresAt": now + timedelta(days=RETENTION_DAYS),
-                    }); wrote_any = True
-
-                # level (เก็บ cm และ percent เฉลี่ยใน percent)
-                if agg["level"]["n"]:
-                    add_reading(fs, "level", {
-                        "value_avg": round(_avg(agg["level"]), 2),
-                        "value_min": round(agg["level"]["min"], 2),
-                        "value_max": round(agg["level"]["max"], 2),
-                        "unit": "cm",
-                        "percent": round(_avg(agg["level"], "p_sum"), 1),
-                        "createdAt": now,
-                        "expiresAt": now + timedelta(days=RETENTION_DAYS),
-                    }); wrote_any = True
-
-                # cycles
-                if agg["cycles"]["n"]:
-                    add_reading(fs, "cycles", {
-                        "value_avg": round(_avg(agg["cycles"]), 2),
-                        "value_min": round(agg["cycles"]["min"], 2),
-                        "value_max": round(agg["cycles"]["max"], 2),
-                        "unit": "cpm",
-                        "createdAt": now,
-                        "expiresAt": now + timedelta(days=RETENTION_DAYS),
-                    }); wrote_any = True
-
-                if wrote_any:
-                    print(f"[readings->{active_name}] rollup {int(minutes_passed)}m", flush=True)
-
-                # รีเซ็ตหน้าต่างสะสม ถ้าทำ rollup หรือ write_minutely
-                rollup_start = ts
-                _reset_agg()
-
-        except ResourceExhausted:
-            print("[efficient] readings: quota exhausted – skip window", flush=True)
-            # ยังรีเซ็ตหน้าต่างสะสมเพื่อไม่ให้กองพะเนิน
-            rollup_start = ts
-            _reset_agg()
+            for key in list(unsent):
+                add_reading(fs, key[0], unsent[key], key[1])
+                del unsent[key]
+            report(active_name)
+        except ResourceExhausted as e:
+            report(active_name, e)
+            print(f"[efficient] readings: quota exhausted – {len(unsent)} doc(s) retry later", flush=True)
         except Exception as e:
+            report(active_name, e)
             print(f"[efficient] readings error: {e}", flush=True)
 
-        time.sleep(INTERVAL_SEC)
+    def rollup(tick_ts):
+        nonlocal rollup_start
+        now = datetime.fromtimestamp(tick_ts, tz=timezone.utc)
+        ts = tick_ts
+        doc_id = window_id(rollup_start)
+        exp = now + timedelta(days=RETENTION_DAYS)
+
+        def _avg(x, field="sum"):
+            return (x[field] / x["n"]) if x["n"] else None
+
+        minutes_passed = (ts - rollup_start) / 60.0
+        docs = {}
+
+        # temp
+        if agg["temp"]["n"]:
+            docs["temp"] = {
+                "temp_c_avg": round(_avg(agg["temp"]), 2),
+                "temp_c_min": round(agg["temp"]["min"], 2),
+                "temp_c_max": round(agg["temp"]["max"], 2),
+            }
+
+        # current
+        if agg["current"]["n"]:
+            docs["current"] = {
+                "value_avg": round(_avg(agg["current"]), 2),
+                "value_min": round(agg["current"]["min"], 2),
+                "value_max": round(agg["current"]["max"], 2),
+                "unit": "A",
+            }
+
+        # level (เก็บ cm และ percent เฉลี่ยใน percent)
+        if agg["level"]["n"]:
+            docs["level"] = {
+                "value_avg": round(_avg(agg["level"]), 2),
+                "value_min": round(agg["level"]["min"], 2),
+                "value_max": round(agg["level"]["max"], 2),
+                "unit": "cm",
+                "percent": round(_avg(agg["level"], "p_sum"), 1),
+            }
+
+        # cycles
+        if agg["cycles"]["n"]:
+            docs["cycles"] = {
+                "value_avg": round(_avg(agg["cycles"]), 2),
+                "value_min": round(agg["cycles"]["min"], 2),
+                "value_max": round(agg["cycles"]["max"], 2),
+                "unit": "cpm",
+            }
+
+        for metric, payload in docs.items():
+            payload.update({
+                "windowStart": datetime.fromtimestamp(rollup_start, tz=timezone.utc),
+                "createdAt": now,
+                "expiresAt": exp,
+            })
+            unsent[(metric, doc_id)] = payload
+        # กันค้างพะเนินตอนเน็ต/โควต้าหายนาน ๆ: เก็บแค่ช่วงล่าสุด
+        for key in sorted(unsent, key=lambda k: k[1])[:-4 * 48]:
+            del unsent[key]
+
+        # รีเซ็ตหน้าต่างสะสม ถ้าทำ rollup หรือ write_minutely
+        rollup_start = ts
+        _reset_agg()
+
+        n_before = len(unsent)
+        flush()
+        if docs and len(unsent) < n_before:
+            print(f"[readings->{active_name}] rollup {int(round(minutes_passed))}m id={doc_id}", flush=True)
+
+    # rollup ทุก ROLLUP_MINUTES หรือ WRITE_MINUTES (อันที่สั้นกว่า) — ลงตรงต้นช่วงบนนาฬิกา
+    rollup_min = max(1, ROLLUP_MINUTES)
+    if WRITE_MINUTES > 0:
+        rollup_min = min(rollup_min, WRITE_MINUTES)
+
+    sched = DeadlineScheduler("collector_efficient")
+    sched.every("sample", INTERVAL_SEC, sample)
+    sched.every("latest", INTERVAL_SEC, latest)
+    sched.every("rollup", rollup_min * 60, rollup)
+    sched.every("retry", 30, flush)
+    sched.run()
 
 if __name__ == "__main__":
     main()
@@ -1,212 +1,255 @@
 # /home/pi/projects/max6675/sensor/collector_local.py
 
-import os, time, sqlite3, math
-from sensor.jsn_sr04t import JSNSR04T, distance_to_percent
-from sensor.max6675_reader import Max6675
+import os, time, math, signal
+from typing import Dict, List, Optional
+
+from sensor.local_db import connect, ensure_readings_table
+from sensor.devices import load_devices
+from sensor.readings_writer import ReadingsWriter, WRITE_BATCH_ROWS, WRITE_BATCH_MS
+from sensor.samplers import SampleStore, Sampler
+from sensor.scheduler import DeadlineScheduler
+from sensor import latest_shm
 
 # =====================
 # ENV / CONFIG
 # =====================
 DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
-DEVICE_ID = os.getenv("DEVICE_ID", "pi5-001")
 DEMO = os.getenv("DEMO", "1") == "1"
 
-INTERVAL_SEC = float(os.getenv("INTERVAL_SEC", "1.0"))
+INTERVAL_SEC = float(os.getenv("INTERVAL_SEC", "1.0"))   # รอบ snapshot ลง DB
 
-# --- MAX6675 (SPI) ---
-MAX6675_BUS = int(os.getenv("MAX6675_BUS", "0"))
-MAX6675_DEV = int(os.getenv("MAX6675_DEV", "0"))  # CE0=0, CE1=1
+# แต่ละ sensor มี thread อ่านของตัวเอง (ตัวช้าไม่ถ่วงตัวอื่น)
+TEMP_PERIOD_SEC  = float(os.getenv("TEMP_PERIOD_SEC", "0.25"))   # MAX6675 แปลงค่า ~220ms
+LEVEL_PERIOD_SEC = float(os.getenv("LEVEL_PERIOD_SEC", "1.0"))
 
 # --- JSN-SR04T (Ultrasonic) ---
-JSN_TRIG = int(os.getenv("JSN_TRIG", "23"))
-JSN_ECHO = int(os.getenv("JSN_ECHO", "24"))
-
-LEVEL_FULL_CM  = float(os.getenv("LEVEL_FULL_CM", "15"))   # ระยะตอน “เต็ม”
-LEVEL_EMPTY_CM = float(os.getenv("LEVEL_EMPTY_CM", "80"))  # ระยะตอน “ว่าง”
-
 JSN_SAMPLES = int(os.getenv("JSN_SAMPLES", "7"))
 JSN_MIN_CM  = float(os.getenv("JSN_MIN_CM", "5"))
 JSN_MAX_CM  = float(os.getenv("JSN_MAX_CM", "200"))
+JSN_STABLE_CM = float(os.getenv("JSN_STABLE_CM", "1"))  # 3 ค่าติดกันห่างค่ากลางไม่เกินนี้ -> หยุดยิง (0 = ยิงครบ JSN_SAMPLES)
 
-# --- Proximity (PC817 output -> Pi GPIO) ---
-PROX_PIN = int(os.getenv("PROX_PIN", "16"))               # GPIO16 (physical 36)
-PROX_DEBOUNCE_SEC = float(os.getenv("PROX_DEBOUNCE", "0.08"))
-PROX_ACTIVE_LOW = os.getenv("PROX_ACTIVE_LOW", "1") == "1"
+# ขา/CE/การ calibrate ถังของแต่ละเครื่อง อยู่ใน sensor/devices.py
+# (GATEWAY_CONFIG = หลายเครื่อง, ไม่ตั้ง = เครื่องเดียวจาก DEVICE_ID, MAX6675_DEV, JSN_TRIG, ...)
 # active_low=True: ไม่จ่อ=1, จ่อโลหะ=0
 
-# =====================
-# INIT DB
-# =====================
-os.makedirs(os.path.dirname(DB), exist_ok=True)
-
-conn = sqlite3.connect(DB, isolation_level=None)
-c = conn.cursor()
-
-# ✅ schema ใหม่: ไม่มี current แล้ว
-c.execute("""
-CREATE TABLE IF NOT EXISTS readings(
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  ts_ms INTEGER NOT NULL,
-  temp REAL,
-  level REAL,
-  cycles INTEGER,
-  uploaded INTEGER NOT NULL DEFAULT 0
-)
-""")
-c.execute("CREATE INDEX IF NOT EXISTS idx_ts ON readings(ts_ms)")
-c.execute("PRAGMA journal_mode=WAL")
-
-# =====================
-# INIT SENSORS
-# =====================
-max6675 = None
-jsn = None
-
-# Proximity counter state
-_cycles_total = 0
-_last_prox = 1
-_last_edge_time = 0.0
-_prox_ready = False
-_h = None
-
-if not DEMO:
-    # MAX6675
-    try:
-        max6675 = Max6675(bus=MAX6675_BUS, device=MAX6675_DEV)
-    except Exception:
-        max6675 = None
-
-    # JSN-SR04T
-    try:
-        jsn = JSNSR04T(trig=JSN_TRIG, echo=JSN_ECHO)
-    except Exception:
-        jsn = None
-
-    # Proximity GPIO (lgpio)
-    try:
-        import lgpio
-        _h = lgpio.gpiochip_open(0)
-        lgpio.gpio_claim_input(_h, PROX_PIN)
-        _prox_ready = True
-    except Exception:
-        _prox_ready = False
-        _h = None
 
 # =====================
 # DEMO
 # =====================
-def read_demo():
-    t = time.time()
+def read_demo(phase: float = 0.0):
+    t = time.time() + phase
     return {
         "temp": 60 + 10 * math.sin(t / 60),
         "level": 40 + 5 * math.sin(t / 300),
         "cycles": int(t / 30),
     }
 
+
 # =====================
-# REAL READERS
+# ONE PRESS
 # =====================
-def read_temp_c():
-    if not max6675:
-        return None
-    try:
-        return float(max6675.read_c())
-    except Exception:
-        return None
-
-def read_level_percent():
-    """
-    อ่าน JSN แล้วแปลงเป็น % (0..100)
-    ถ้าอ่านไม่ได้ให้คืน None
-    """
-    if jsn is None:
-        return None
-    try:
-        dist = jsn.read_filtered_cm(
-            samples=JSN_SAMPLES,
-            min_cm=JSN_MIN_CM,
-            max_cm=JSN_MAX_CM
-        )
-        return float(distance_to_percent(dist, LEVEL_FULL_CM, LEVEL_EMPTY_CM))
-    except Exception:
-        return None
-
-def read_cycles_total():
-    """
-    นับ cycle จาก Proximity โดยจับขอบสัญญาณ
-    - ของมึง: ไม่จ่อ=1, จ่อ=0 (active_low)
-    - นับตอน not-detect -> detect (falling edge ถ้า active_low)
-    """
-    global _cycles_total, _last_prox, _last_edge_time
-
-    if not _prox_ready or _h is None:
-        return None
+class DeviceSensors:
+    """Sensors + sampler threads of one press (one entry of load_devices())."""
+
+    def __init__(self, cfg: Dict, store: SampleStore, pollers: Dict, index: int = 0):
+        self.cfg = cfg
+        self.device_id = cfg["device_id"]
+        self.store = store
+        self.poller = None
+        self.jsn = None
+        self.counter = None
+        self.phase = index * 17.0   # DEMO: ให้แต่ละเครื่องค่าไม่ซ้ำกัน
+
+        if not DEMO:
+            # MAX6675: หนึ่ง poller ต่อ SPI bus อ่านทุก CE บน bus นั้น (ล็อก bus ให้แล้ว)
+            self.poller = pollers.get(int(cfg["spi_bus"]))
+
+            # JSN-SR04T
+            try:
+                from sensor.jsn_sr04t import JSNSR04T
+                self.jsn = JSNSR04T(trig=cfg["jsn_trig"], echo=cfg["jsn_echo"])
+            except Exception:
+                self.jsn = None
+
+            # Proximity GPIO (lgpio edge alerts)
+            try:
+                from sensor.cycle_counter import EdgeCycleCounter
+                self.counter = EdgeCycleCounter(pin=cfg["prox_pin"], active_low=cfg["prox_active_low"],
+                                                debounce_sec=cfg["prox_debounce_sec"])
+            except Exception:
+                self.counter = None
 
+        if DEMO:
+            read_temp = lambda: read_demo(self.phase)["temp"]
+            read_level = lambda: read_demo(self.phase)["level"]
+        else:
+            read_temp, read_level = self.read_temp_c, self.read_level_percent
+        self.samplers = [
+            Sampler(self.key("temp"), read_temp, TEMP_PERIOD_SEC, store),
+            Sampler(self.key("level"), read_level, LEVEL_PERIOD_SEC, store),
+        ]
+
+    def key(self, metric: str) -> str:
+        return f"{self.device_id}.{metric}"
+
+    # ---------- real readers ----------
+    def read_temp_c(self) -> Optional[float]:
+        if not self.poller:
+            return None
+        r = self.poller.get(int(self.cfg["spi_ce"]))
+        return None if r.stale else r.temp_c
+
+    def read_level_percent(self) -> Optional[float]:
+        """
+        อ่าน JSN แล้วแปลงเป็น % (0..100)
+        ถ้าอ่านไม่ได้ให้คืน None
+        """
+        if self.jsn is None:
+            return None
+        try:
+            from sensor.jsn_sr04t import distance_to_percent
+            dist = self.jsn.read_filtered_cm(
+                samples=JSN_SAMPLES,
+                min_cm=JSN_MIN_CM,
+                max_cm=JSN_MAX_CM,
+                stable_cm=JSN_STABLE_CM,
+            )
+            return float(distance_to_percent(dist, self.cfg["level_full_cm"], self.cfg["level_empty_cm"]))
+        except Exception:
+            return None
+
+    def read_cycles_total(self) -> Optional[int]:
+        """
+        จำนวน cycle สะสมจาก Proximity (นับใน callback ตอน not-detect -> detect)
+        ถ้า GPIO ใช้ไม่ได้ให้คืน None
+        """
+        if DEMO:
+            return read_demo(self.phase)["cycles"]
+        if self.counter is None:
+            return None
+        return self.counter.count()
+
+    # ---------- snapshot ----------
+    def row(self, ts_ms: int) -> tuple:
+        temp, _ = self.store.latest(self.key("temp"))
+        level, _ = self.store.latest(self.key("level"))
+        # cycles นับใน callback อยู่แล้ว อ่านตัวนับตรงๆ (ไม่มีวัน stale)
+        return (self.device_id, ts_ms, temp, level, self.read_cycles_total())
+
+    def start(self):
+        for smp in self.samplers:
+            smp.start()
+
+    def close(self):
+        for smp in self.samplers:
+            smp.stop()
+        for smp in self.samplers:
+            smp.join(timeout=2.0)
+        for x in (self.jsn, self.counter):
+            try:
+                if x:
+                    x.close()
+            except Exception:
+                pass
+
+
+def open_pollers(devices: List[Dict]) -> Dict:
+    """หนึ่ง Max6675Poller ต่อ SPI bus ครอบคลุมทุก CE ที่ config ใช้"""
+    pollers = {}
+    if DEMO:
+        return pollers
+    by_bus: Dict[int, set] = {}
+    for d in devices:
+        by_bus.setdefault(int(d["spi_bus"]), set()).add(int(d["spi_ce"]))
+    for bus, ces in by_bus.items():
+        try:
+            from sensor.max6675 import Max6675Poller
+            p = Max6675Poller(bus=bus, ces=sorted(ces))
+            p.start()
+            pollers[bus] = p
+        except Exception:
+            pass
+    return pollers
+
+
+def open_shm() -> Optional[latest_shm.Publisher]:
     try:
-        import lgpio
-        v = lgpio.gpio_read(_h, PROX_PIN)
-    except Exception:
+        return latest_shm.Publisher()
+    except Exception as e:
+        print(f"[collector_local] latest_shm disabled: {e}", flush=True)
         return None
 
-    now = time.time()
 
-    if PROX_ACTIVE_LOW:
-        prev_detect = (_last_prox == 0)
-        now_detect = (v == 0)
-    else:
-        prev_detect = (_last_prox == 1)
-        now_detect = (v == 1)
+def publish_row(shm: Optional[latest_shm.Publisher], row: tuple):
+    """แถว (device_id, ts_ms, temp, level, cycles) -> shared memory (latest_local / alert_worker อ่าน)"""
+    if shm is not None:
+        did, ts_ms, temp, level, cycles = row
+        shm.publish(did, ts_ms, temp=temp, level=level, cycles=cycles)
 
-    if (not prev_detect) and now_detect:
-        if now - _last_edge_time >= PROX_DEBOUNCE_SEC:
-            _cycles_total += 1
-            _last_edge_time = now
 
-    _last_prox = v
-    return _cycles_total
+# systemd stop ส่ง SIGTERM -> แปลงเป็น SystemExit เพื่อให้ finally ได้ flush บัฟเฟอร์
+def _on_sigterm(signum, frame):
+    raise SystemExit(0)
 
-def read_real():
-    return {
-        "temp": read_temp_c(),
-        "level": read_level_percent(),
-        "cycles": read_cycles_total(),
-    }
 
 # =====================
 # MAIN LOOP
 # =====================
-try:
-    while True:
-        ts_ms = int(time.time() * 1000)
-
-        if DEMO:
-            m = read_demo()
-        else:
-            m = read_real()
+def main():
+    devices = load_devices()
 
-        # ✅ INSERT ใหม่: ไม่มี current
-        c.execute(
-            "INSERT INTO readings(ts_ms, temp, level, cycles, uploaded) VALUES(?,?,?,?,0)",
-            (ts_ms, m["temp"], m["level"], m["cycles"])
-        )
+    # isolation_level=None: ReadingsWriter คุม BEGIN/COMMIT เอง (group commit)
+    conn = connect(DB, isolation_level=None, check_same_thread=False)
+    c = conn.cursor()
+    ensure_readings_table(c)
+    # WAL + NORMAL: ไม่ fsync ทุก commit -> ลดการสึกของ SD card (DB ไม่เสีย แค่ commit ท้ายๆ อาจหายตอนไฟดับ)
+    c.execute("PRAGMA synchronous=NORMAL")
 
-        time.sleep(INTERVAL_SEC)
+    # ทุกเครื่องเขียนผ่าน writer ตัวเดียว -> ทุก tick เป็น transaction เดียว ไม่แย่ง SD card กัน
+    writer = ReadingsWriter(conn, max_rows=max(WRITE_BATCH_ROWS, len(devices)), max_ms=WRITE_BATCH_MS)
+    signal.signal(signal.SIGTERM, _on_sigterm)
 
-finally:
-    try:
-        if jsn:
-            jsn.close()
-    except Exception:
-        pass
+    store = SampleStore()
+    pollers = open_pollers(devices)
+    presses = [DeviceSensors(d, store, pollers, i) for i, d in enumerate(devices)]
+    shm = open_shm()
 
-    try:
-        if not DEMO and _prox_ready and _h is not None:
-            import lgpio
-            lgpio.gpiochip_close(_h)
-    except Exception:
-        pass
+    print(f"[collector_local] devices={[p.device_id for p in presses]} db={DB} "
+          f"interval={INTERVAL_SEC}s DEMO={DEMO}", flush=True)
 
     try:
-        conn.close()
-    except Exception:
-        pass
+        for p in presses:
+            p.start()
+
+        # snapshot ตาม deadline บนกริดเวลา -> ts_ms ลงตรงช่อง INTERVAL_SEC ทุกแถว
+        def snapshot(tick_ts):
+            ts_ms = int(round(tick_ts * 1000))
+            # ✅ INSERT ใหม่: ไม่มี current (เข้าคิว แล้ว commit เป็นก้อน)
+            for p in presses:
+                row = p.row(ts_ms)
+                writer.add(row)
+                publish_row(shm, row)
+
+        sched = DeadlineScheduler("collector_local")
+        sched.every("sample", INTERVAL_SEC, snapshot)
+        sched.run()
+
+    finally:
+        for p in presses:
+            p.close()
+        for poller in pollers.values():
+            poller.stop()
+
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,9 @@ import os, time, math
 from datetime import datetime, timezone, timedelta
 from sensor.firebase_admin_init import db
 from firebase_admin import firestore
+from sensor.scheduler import DeadlineScheduler
+from sensor import budget
+from sensor.latest_state import LatestState
 
 # ---------- ENV ----------
 DEVICE_ID       = os.getenv("DEVICE_ID", "pi5-001")
@@ -20,10 +23,14 @@ except Exception:
 
 def read_temp_c():
     if hw_get_temp_c:
+        # มี hw จริง: อ่านไม่ได้ = None (แบบ collector.py) ไม่ใช้ค่าจำลอง
         try:
-            return float(hw_get_temp_c())
+            v = hw_get_temp_c()
+            if v is None or v == 0.0 or v < -40 or v > 200:  # กันค่าพิกล
+                return None
+            return float(v)
         except Exception:
-            pass
+            return None
     base = 30.0
     wig  = math.sin(time.time()/40.0)*1.0
     return round(base + wig, 2)
@@ -51,61 +58,68 @@ def now_utc():
 def make_expires():
     return now_utc() + timedelta(days=RETENTION_DAYS)
 
-def push_latest(metric, payload):
-    db.collection("devices").document(DEVICE_ID).set({"latest": {metric: payload}}, merge=True)
-
-def push_history(metric, stats):
+def push_history(metric, stats, window_start):
+    # id = ต้นช่วง (YYYYMMDDHHmmss UTC) + merge -> ส่งซ้ำได้ไม่เกิดจุดซ้ำ
     coll = (db.collection("devices").document(DEVICE_ID)
             .collection("series").document(metric).collection("readings"))
     doc = {**stats, "createdAt": now_utc(), "expiresAt": make_expires()}
-    coll.add(doc)
+    coll.document(window_start.strftime("%Y%m%d%H%M%S")).set(doc, merge=True)
     return doc
 
 def main():
     print(f"[collector] DEVICE_ID={DEVICE_ID} interval={INTERVAL_SEC}s")
 
     buf = {"temp": [], "current": [], "level": [], "cycles": []}
-    rounds = 0
-
-    while True:
-        rounds += 1
-        t_c = read_temp_c()
-        amps = read_current_a()
-        lvl  = read_level_cm()
-        cpm  = read_cycles_per_min()
+    cur = {"temp": None, "current": None, "level": None, "cycles": None}
+    win = {"start": time.time()}   # ต้นช่วง history ปัจจุบัน (ใช้เป็น doc id)
+    state = LatestState(DEVICE_ID)   # devices/{id}.latest: write เดียวต่อรอบ เฉพาะที่เปลี่ยน
 
-        # อัปเดต latest
-        if rounds % LATEST_EVERY == 0:
-            push_latest("temp",    {"value": t_c, "unit": "°C",
-                                   "temp_f": round(t_c*9/5+32,2), "createdAt": now_utc()})
-            push_latest("current", {"value": amps, "unit": "A",  "createdAt": now_utc()})
-            push_latest("level",   {"value": lvl, "unit": "cm", "percent": level_percent(lvl),
-                                   "createdAt": now_utc()})
-            push_latest("cycles",  {"value": cpm, "unit": "cpm", "createdAt": now_utc()})
+    def sample(tick_ts):
+        cur["temp"] = read_temp_c()
+        cur["current"] = read_current_a()
+        cur["level"] = read_level_cm()
+        cur["cycles"] = read_cycles_per_min()
 
         # เก็บลง buffer
-        buf["temp"].append(t_c)
-        buf["current"].append(amps)
-        buf["level"].append(lvl)
-        buf["cycles"].append(float(cpm))
+        if cur["temp"] is not None:   # รอบที่อ่าน thermocouple ไม่ได้ไม่นับใน history
+            buf["temp"].append(cur["temp"])
+        buf["current"].append(cur["current"])
+        buf["level"].append(cur["level"])
+        buf["cycles"].append(float(cur["cycles"]))
 
+    def latest(tick_ts):
+        # อัปเดต latest
+        t_c, amps, lvl, cpm = cur["temp"], cur["current"], cur["level"], cur["cycles"]
+        if t_c is None:
+            return
+        changed = state.publish(db, {"temp": t_c, "current": amps, "level": lvl, "cycles": cpm},
+                                extra={"level": {"percent": level_percent(lvl)}}, now=tick_ts)
+        if changed:
+            print(f"[collector] latest {','.join(changed)} T={t_c}°C A={amps}A L={lvl}cm({level_percent(lvl)}%) C={cpm}cpm")
+
+    def history(tick_ts):
         # สรุป history
-        if rounds % HISTORY_EVERY == 0:
-            for m in ["temp", "current", "level", "cycles"]:
-                arr = buf[m]
-                if not arr: continue
-                mn, mx = min(arr), max(arr)
-                avg = round(sum(arr)/len(arr), 3)
-                stats = ({"temp_c_min": mn, "temp_c_avg": avg, "temp_c_max": mx}
-                         if m=="temp" else
-                         {"value_min": mn, "value_avg": avg, "value_max": mx})
-                push_history(m, stats)
-                buf[m].clear()
-
-        if rounds % LATEST_EVERY == 0:
-            print(f"[collector] T={t_c}°C A={amps}A L={lvl}cm({level_percent(lvl)}%) C={cpm}cpm")
-
-        time.sleep(INTERVAL_SEC)
+        n = sum(1 for m in buf if buf[m])
+        if n and not budget.try_spend("write", "minutes", n):
+            print("[collector] history: daily budget reached, keep buffer")
+            return
+        for m in ["temp", "current", "level", "cycles"]:
+            arr = buf[m]
+            if not arr: continue
+            mn, mx = min(arr), max(arr)
+            avg = round(sum(arr)/len(arr), 3)
+            stats = ({"temp_c_min": mn, "temp_c_avg": avg, "temp_c_max": mx}
+                     if m=="temp" else
+                     {"value_min": mn, "value_avg": avg, "value_max": mx})
+            push_history(m, stats, datetime.fromtimestamp(win["start"], tz=timezone.utc))
+            buf[m].clear()
+        win["start"] = tick_ts
+
+    sched = DeadlineScheduler("collector_multi")
+    sched.every("sample", INTERVAL_SEC, sample)
+    sched.every("latest", LATEST_EVERY * INTERVAL_SEC, latest)
+    sched.every("history", HISTORY_EVERY * INTERVAL_SEC, history)
+    sched.run()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
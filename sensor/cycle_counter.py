@@ -0,0 +1,93 @@
+# sensor/cycle_counter.py
+import time
+import threading
+from collections import deque
+from typing import List, Optional
+
+import lgpio
+
+
+class EdgeCycleCounter:
+    """
+    Press-cycle counter for the proximity sensor (PC817 output -> GPIO),
+    driven by lgpio edge alerts instead of polling.
+
+    The kernel timestamps every edge; the callback debounces on those
+    timestamps, so the count stays exact no matter how slow the Python side
+    is. Only the "detect" edge is claimed (falling when active_low).
+    """
+
+    def __init__(self, pin=16, chip=0, active_low=True, debounce_sec=0.08,
+                 keep=4096):
+        self.pin = int(pin)
+        self.active_low = bool(active_low)
+        self.debounce_ns = int(float(debounce_sec) * 1e9)
+
+        self._lock = threading.Lock()
+        self._count = 0
+        self._bounces = 0
+        self._last_tick: Optional[int] = None
+        self._tick_offset_ns: Optional[int] = None   # tick -> epoch ns
+        self._stamps = deque(maxlen=int(keep))        # epoch ms ของแต่ละ cycle
+
+        self.h = lgpio.gpiochip_open(int(chip))
+        edge = lgpio.FALLING_EDGE if self.active_low else lgpio.RISING_EDGE
+        lgpio.gpio_claim_alert(self.h, self.pin, edge)
+        try:
+            # ตัด glitch สั้นๆ ในระดับ kernel อีกชั้น (ถ้า lgpio รุ่นนี้รองรับ)
+            lgpio.gpio_set_debounce_micros(self.h, self.pin, min(self.debounce_ns // 1000, 5000))
+        except Exception:
+            pass
+        self._cb = lgpio.callback(self.h, self.pin, edge, self._on_edge)
+
+    # ---------- callback (lgpio thread) ----------
+    def _on_edge(self, chip, gpio, level, tick):
+        if level == lgpio.TIMEOUT:
+            return
+        now_ns = time.time_ns()
+        with self._lock:
+            # tick เป็น ns ของ kernel; หา offset ไปเวลา epoch ครั้งแรก (หรือเมื่อเพี้ยนเกิน 1s)
+            if self._tick_offset_ns is None or abs(now_ns - (tick + self._tick_offset_ns)) > 1_000_000_000:
+                self._tick_offset_ns = now_ns - tick
+
+            if self._last_tick is not None and tick - self._last_tick < self.debounce_ns:
+                self._bounces += 1
+                return
+            self._last_tick = tick
+            self._count += 1
+            self._stamps.append((tick + self._tick_offset_ns) // 1_000_000)
+
+    # ---------- API ----------
+    def count(self) -> int:
+        """จำนวน cycle สะสมตั้งแต่เปิดโปรแกรม"""
+        with self._lock:
+            return self._count
+
+    def timestamps(self, since_ms: Optional[int] = None) -> List[int]:
+        """เวลา (epoch ms) ของแต่ละ cycle ที่ยังอยู่ในหน่วยความจำ"""
+        with self._lock:
+            if since_ms is None:
+                return list(self._stamps)
+            return [t for t in self._stamps if t >= since_ms]
+
+    def rate_per_min(self, window_sec: float = 60.0) -> float:
+        since = int(time.time() * 1000 - window_sec * 1000)
+        return len(self.timestamps(since)) * 60.0 / float(window_sec)
+
+    def bounces(self) -> int:
+        with self._lock:
+            return self._bounces
+
+    def close(self):
+        try:
+            self._cb.cancel()
+        except Exception:
+            pass
+        try:
+            lgpio.gpio_free(self.h, self.pin)
+        except Exception:
+            pass
+        try:
+            lgpio.gpiochip_close(self.h)
+        except Exception:
+            pass
@@ -0,0 +1,74 @@
+# sensor/devices.py
+"""
+Device list for gateway mode.
+
+GATEWAY_CONFIG points at a JSON file describing every press served by this
+Pi, e.g.
+
+    {"devices": [
+      {"device_id": "press-01", "spi_bus": 0, "spi_ce": 0,
+       "jsn_trig": 23, "jsn_echo": 24, "prox_pin": 16,
+       "level_full_cm": 15, "level_empty_cm": 80},
+      {"device_id": "press-02", "spi_bus": 0, "spi_ce": 1,
+       "jsn_trig": 5, "jsn_echo": 6, "prox_pin": 26}
+    ]}
+
+Missing keys fall back to the single-device env vars, and without
+GATEWAY_CONFIG the list is just that one device (DEVICE_ID).
+"""
+import os
+import json
+from typing import Dict, List
+
+GATEWAY_CONFIG = os.getenv("GATEWAY_CONFIG", "")
+
+
+def _env_defaults() -> Dict:
+    return {
+        "device_id": os.getenv("DEVICE_ID", "pi5-001"),
+        "spi_bus": int(os.getenv("MAX6675_BUS", "0")),
+        "spi_ce": int(os.getenv("MAX6675_DEV", "0")),      # CE0=0, CE1=1
+        "jsn_trig": int(os.getenv("JSN_TRIG", "23")),
+        "jsn_echo": int(os.getenv("JSN_ECHO", "24")),
+        "level_full_cm": float(os.getenv("LEVEL_FULL_CM", "15")),
+        "level_empty_cm": float(os.getenv("LEVEL_EMPTY_CM", "80")),
+        "prox_pin": int(os.getenv("PROX_PIN", "16")),
+        "prox_active_low": os.getenv("PROX_ACTIVE_LOW", "1") == "1",
+        "prox_debounce_sec": float(os.getenv("PROX_DEBOUNCE", "0.08")),
+    }
+
+
+_cache = None
+
+
+def load_devices(path: str = GATEWAY_CONFIG) -> List[Dict]:
+    global _cache
+    if _cache is not None and path == GATEWAY_CONFIG:
+        return _cache
+
+    base = _env_defaults()
+    if not path:
+        out = [base]
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            cfg = json.load(f)
+        items = cfg.get("devices", []) if isinstance(cfg, dict) else cfg
+        out = []
+        seen = set()
+        for i, d in enumerate(items):
+            dev = {**base, **d}
+            dev["device_id"] = str(d.get("device_id") or f"{base['device_id']}-{i + 1}")
+            if dev["device_id"] in seen:
+                raise ValueError(f"duplicate device_id in {path}: {dev['device_id']}")
+            seen.add(dev["device_id"])
+            out.append(dev)
+        if not out:
+            raise ValueError(f"no devices in {path}")
+
+    if path == GATEWAY_CONFIG:
+        _cache = out
+    return out
+
+
+def device_ids() -> List[str]:
+    return [d["device_id"] for d in load_devices()]
@@ -1,14 +1,39 @@
 # sensor/firebase_admin_init.py
-import os, pathlib
-import firebase_admin
-from firebase_admin import credentials, firestore
-from typing import Optional
+"""
+Firestore clients for the primary / secondary projects.
+
+The toggle file (FB_TOGGLE_PATH) picks the *home* project; it is cached
+and only re-read when its mtime changes, so get_fs() is cheap enough to
+call every loop.
+
+Each project has a circuit breaker. Callers report outcomes with
+report(); FB_BREAKER_FAILS consecutive errors open it for
+FB_BREAKER_OPEN_SEC, a quota error (ResourceExhausted) for
+FB_QUOTA_OPEN_SEC. While the home project is open get_fs() hands out the
+other one; once the open period is over the next get_fs() returns home
+again as a probe, and its first reported result closes or re-opens it.
+
+The outbox keeps one cursor per project (outbox.project_consumer), so
+whatever went to the standby during a failover is replayed to home when
+it recovers (outbox.drain_active).
+
+firebase_admin / google.cloud.firestore (and gRPC under them) are only
+imported when the first client is created, so importing this module —
+get_active(), set_active(), health() — costs next to nothing.
+"""
+import os, pathlib, time, threading
+from typing import Dict, Optional, Tuple
 
 # ==== ENV ====
 PRIMARY_CRED   = os.getenv("FB_PRIMARY_CRED")    # /home/pi/projects/max6675/keys/firebase-sa.json
 SECONDARY_CRED = os.getenv("FB_SECONDARY_CRED")  # /home/pi/projects/max6675/keys/iot-demo-present.json
 TOGGLE_PATH    = os.getenv("FB_TOGGLE_PATH", "/var/lib/tempmon/firebase-active")
 DEFAULT_ACTIVE = (os.getenv("FB_ACTIVE", "primary")).lower()  # primary|secondary
+FB_BREAKER_FAILS    = int(os.getenv("FB_BREAKER_FAILS", "3"))          # error ติดกันกี่ครั้งจึงตัด
+FB_BREAKER_OPEN_SEC = float(os.getenv("FB_BREAKER_OPEN_SEC", "60"))    # ตัดนานเท่าไรก่อนลอง probe
+FB_QUOTA_OPEN_SEC   = float(os.getenv("FB_QUOTA_OPEN_SEC", "900"))     # โควต้าหมด: ตัดนานกว่า
+FB_BREAKER_MAX_SEC  = float(os.getenv("FB_BREAKER_MAX_SEC", "3600"))   # probe ล้มซ้ำ -> เพิ่มเป็นเท่าตัวถึงเท่านี้
+PROJECTS = ("primary", "secondary")
 
 # hold apps/clients
 _primary_app = _secondary_app = None
@@ -20,6 +45,8 @@ def _init_app(name: str, cred_path: Optional[str]):
     p = pathlib.Path(cred_path)
     if not p.exists():
         raise RuntimeError(f"[firebase] credential not found: {cred_path}")
+    import firebase_admin
+    from firebase_admin import credentials
     # reuse app if already created
     for app in firebase_admin._apps.values():
         if app.name == name:
@@ -29,6 +56,9 @@ def _init_app(name: str, cred_path: Optional[str]):
 
 def _ensure_clients():
     global _primary_app, _secondary_app, _primary_fs, _secondary_fs
+    if (_primary_app is not None or not PRIMARY_CRED) and (_secondary_app is not None or not SECONDARY_CRED):
+        return   # พร้อมแล้ว (ทางลัดของ get_fs ที่ถูกเรียกทุก loop)
+    from firebase_admin import firestore
     if _primary_app is None and PRIMARY_CRED:
         _primary_app = _init_app("primary", PRIMARY_CRED)
         _primary_fs = firestore.client(_primary_app) if _primary_app else None
@@ -36,15 +66,29 @@ def _ensure_clients():
         _secondary_app = _init_app("secondary", SECONDARY_CRED)
         _secondary_fs = firestore.client(_secondary_app) if _secondary_app else None
 
+_toggle = {"mtime": None, "value": None}
+
 def _read_toggle() -> str:
+    # อ่านไฟล์ใหม่เฉพาะตอน mtime เปลี่ยน (get_fs ถูกเรียกทุก loop)
     try:
-        with open(TOGGLE_PATH, "r", encoding="utf-8") as f:
-            v = f.read().strip().lower()
-            if v in ("primary", "secondary"):
-                return v
-    except Exception:
-        pass
-    return DEFAULT_ACTIVE if DEFAULT_ACTIVE in ("primary", "secondary") else "primary"
+        mtime = os.stat(TOGGLE_PATH).st_mtime_ns
+    except OSError:
+        mtime = None
+    if mtime is not None and mtime == _toggle["mtime"]:
+        return _toggle["value"]
+    value = None
+    if mtime is not None:
+        try:
+            with open(TOGGLE_PATH, "r", encoding="utf-8") as f:
+                v = f.read().strip().lower()
+                if v in PROJECTS:
+                    value = v
+        except Exception:
+            pass
+    if value is None:
+        value = DEFAULT_ACTIVE if DEFAULT_ACTIVE in PROJECTS else "primary"
+    _toggle.update(mtime=mtime, value=value)
+    return value
 
 def set_active(target: str) -> str:
     target = (target or "").lower()
@@ -58,10 +102,119 @@ def set_active(target: str) -> str:
 def get_active() -> str:
     return _read_toggle()
 
-def get_fs(prefer: Optional[str] = None):
-    """คืน Firestore client ตาม active (หรือ force ด้วย prefer)"""
+# ---------- circuit breaker ----------
+class Breaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"          # closed | open | half_open
+        self.fails = 0
+        self.opened_at = 0.0
+        self.open_for = 0.0
+        self.last_error: Optional[str] = None
+        self.counts = {"ok": 0, "error": 0, "quota": 0, "trips": 0}
+
+    def available(self, now: float) -> bool:
+        if self.state == "open" and now - self.opened_at >= self.open_for:
+            self.state = "half_open"   # ปล่อยให้ลอง (probe)
+        return self.state != "open"
+
+    def success(self):
+        if self.state != "closed":
+            print(f"[firebase] {self.name} recovered", flush=True)
+        self.state, self.fails = "closed", 0
+        self.counts["ok"] += 1
+
+    def failure(self, exc: BaseException, now: float):
+        from sensor.outbox import ResourceExhausted   # ตัวเดียวกับที่ outbox โยน (โหลดตอนใช้)
+        quota = isinstance(exc, ResourceExhausted)
+        self.counts["quota" if quota else "error"] += 1
+        self.fails += 1
+        self.last_error = f"{type(exc).__name__}: {exc}"[:200]
+        if self.state == "half_open":
+            # probe ล้ม: ตัดต่อ นานขึ้นเท่าตัว
+            self._trip(now, min(max(self.open_for * 2, FB_BREAKER_OPEN_SEC), FB_BREAKER_MAX_SEC))
+        elif quota:
+            self._trip(now, FB_QUOTA_OPEN_SEC)
+        elif self.fails >= FB_BREAKER_FAILS and self.state == "closed":
+            self._trip(now, FB_BREAKER_OPEN_SEC)
+
+    def _trip(self, now: float, seconds: float):
+        self.state, self.opened_at, self.open_for = "open", now, seconds
+        self.counts["trips"] += 1
+        print(f"[firebase] {self.name} circuit open for {seconds:.0f}s ({self.last_error})", flush=True)
+
+    def info(self, now: float) -> Dict:
+        return {
+            "state": self.state, "fails": self.fails, "last_error": self.last_error,
+            "retry_in": round(max(0.0, self.opened_at + self.open_for - now), 1) if self.state == "open" else 0,
+            **self.counts,
+        }
+
+
+_breakers = {name: Breaker(name) for name in PROJECTS}
+_lock = threading.Lock()
+_current = {"name": None}
+
+
+def _client(name: str):
+    return _secondary_fs if name == "secondary" else _primary_fs
+
+
+def other_project(name: str) -> str:
+    return "secondary" if name == "primary" else "primary"
+
+
+def get_fs_named(prefer: Optional[str] = None) -> Tuple[str, object]:
+    """(ชื่อ project, client) ที่ควรใช้ตอนนี้: home ถ้า circuit ไม่ตัด ไม่งั้นอีกตัว"""
     _ensure_clients()
-    choice = (prefer or get_active()).lower()
-    if choice == "secondary" and _secondary_fs:
-        return _secondary_fs
-    return _primary_fs  # default primary
+    home = (prefer or get_active()).lower()
+    now = time.time()
+    with _lock:
+        name = home
+        for cand in (home, other_project(home)):
+            if _client(cand) is not None and _breakers[cand].available(now):
+                name = cand
+                break
+        if name != _current["name"]:
+            if _current["name"] is not None:
+                print(f"[firebase] using {name} (home={home})", flush=True)
+            _current["name"] = name
+    return name, _client(name)
+
+
+def get_fs(prefer: Optional[str] = None):
+    """คืน Firestore client ตาม active (หรือ force ด้วย prefer) — สลับไปอีก project อัตโนมัติเมื่อ circuit ตัด"""
+    return get_fs_named(prefer)[1]
+
+
+def project_of(fs) -> Optional[str]:
+    if fs is not None and fs is _primary_fs:
+        return "primary"
+    if fs is not None and fs is _secondary_fs:
+        return "secondary"
+    return None
+
+
+def report(project=None, exc: Optional[BaseException] = None):
+    """
+    แจ้งผลการเรียก Firestore (project = ชื่อ หรือ client; None = ตัวที่ get_fs ให้ไปล่าสุด)
+    exc=None คือสำเร็จ
+    """
+    name = project if isinstance(project, str) else (project_of(project) or _current["name"])
+    if name not in _breakers:
+        return
+    with _lock:
+        if exc is None:
+            _breakers[name].success()
+        else:
+            _breakers[name].failure(exc, time.time())
+
+
+def health() -> Dict:
+    now = time.time()
+    with _lock:
+        return {
+            "home": get_active(),
+            "current": _current["name"],
+            "breakers": {n: b.info(now) for n, b in _breakers.items()},
+        }
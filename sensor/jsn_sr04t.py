@@ -1,5 +1,6 @@
 # sensor/jsn_sr04t.py
 import time
+import threading
 from statistics import median
 import lgpio
 
@@ -8,36 +9,102 @@ class JSNSR04T:
     JSN-SR04T (waterproof ultrasonic) on Raspberry Pi using lgpio.
     TRIG: GPIO output (3.3V OK)
     ECHO: GPIO input (MUST go through voltage divider to 3.3V)
+
+    mode="alert" (default): echo edges come from lgpio alerts with kernel
+    timestamps, the pulse width is fall_tick - rise_tick, and the reader
+    thread just waits on an Event (no busy loop, no Python jitter in the
+    measurement). mode="poll" keeps the old gpio_read loops; it is also the
+    fallback if alerts can't be claimed.
     """
-    def __init__(self, trig=23, echo=24, chip=0, warmup=5):
+    def __init__(self, trig=23, echo=24, chip=0, warmup=5, mode="alert",
+                 cycle_sec=0.06):
         self.trig = int(trig)
         self.echo = int(echo)
         self.h = lgpio.gpiochip_open(int(chip))
+        # ระยะห่างขั้นต่ำระหว่าง trigger (กัน echo สะท้อนค้างจากรอบก่อน)
+        # JSN-SR04T มีรอบวัด ~50-60 ms: ยิงถี่กว่านี้ echo ของ ping ก่อนจะถูกอ่านเป็นระยะของ ping ถัดไป
+        self.cycle_sec = float(cycle_sec)
+        self._last_trigger = 0.0
 
         lgpio.gpio_claim_output(self.h, self.trig, 0)
-        lgpio.gpio_claim_input(self.h, self.echo)
+
+        self.mode = "poll"
+        self._cb = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._armed = False
+        self._rise_tick = None
+        self._pulse_ns = None
+        if mode == "alert":
+            try:
+                lgpio.gpio_claim_alert(self.h, self.echo, lgpio.BOTH_EDGES)
+                self._cb = lgpio.callback(self.h, self.echo, lgpio.BOTH_EDGES, self._on_echo)
+                self.mode = "alert"
+            except Exception:
+                self.mode = "poll"
+        if self.mode == "poll":
+            lgpio.gpio_claim_input(self.h, self.echo)
 
         # warmup (sensor sometimes needs a few pulses)
         for _ in range(int(warmup)):
             self.read_distance_cm()
-            time.sleep(0.05)
+            self._wait_cycle()
 
     def close(self):
+        try:
+            if self._cb is not None:
+                self._cb.cancel()
+        except Exception:
+            pass
         try:
             lgpio.gpiochip_close(self.h)
         except Exception:
             pass
 
-    def read_distance_cm(self, timeout=0.06):
-        """
-        Return distance in cm (float) or None on timeout.
-        """
+    # ---------- alert mode ----------
+    def _on_echo(self, chip, gpio, level, tick):
+        with self._lock:
+            if not self._armed:
+                return
+            if level == 1:
+                self._rise_tick = tick
+            elif level == 0 and self._rise_tick is not None:
+                self._pulse_ns = tick - self._rise_tick
+                self._armed = False
+                self._done.set()
+
+    def _trigger(self):
         # trigger 10us
         lgpio.gpio_write(self.h, self.trig, 0)
         time.sleep(0.000005)
         lgpio.gpio_write(self.h, self.trig, 1)
         time.sleep(0.00001)
         lgpio.gpio_write(self.h, self.trig, 0)
+        self._last_trigger = time.monotonic()
+
+    def _wait_cycle(self):
+        left = self.cycle_sec - (time.monotonic() - self._last_trigger)
+        if left > 0:
+            time.sleep(left)
+
+    def _read_alert(self, timeout):
+        with self._lock:
+            self._rise_tick = None
+            self._pulse_ns = None
+            self._done.clear()
+            self._armed = True
+        self._trigger()
+        ok = self._done.wait(timeout * 2)   # รอทั้งขาขึ้นและขาลงของ echo
+        with self._lock:
+            self._armed = False
+            pulse_ns = self._pulse_ns
+        if not ok or pulse_ns is None or pulse_ns <= 0 or pulse_ns > timeout * 1e9:
+            return None
+        return (pulse_ns * 1e-9 * 34300) / 2.0
+
+    # ---------- poll mode ----------
+    def _read_poll(self, timeout):
+        self._trigger()
 
         t0 = time.monotonic()
         while lgpio.gpio_read(self.h, self.echo) == 0:
@@ -53,16 +120,41 @@ class JSNSR04T:
         pulse = end - start
         return (pulse * 34300) / 2.0
 
-    def read_filtered_cm(self, samples=7, min_cm=5.0, max_cm=200.0):
+    def read_distance_cm(self, timeout=0.06):
+        """
+        Return distance in cm (float) or None on timeout.
+        """
+        if self.mode == "alert":
+            return self._read_alert(timeout)
+        return self._read_poll(timeout)
+
+    def read_filtered_cm(self, samples=7, min_cm=5.0, max_cm=200.0, stable_cm=1.0):
         """
         Median filter. Return cm or None if not enough good samples.
+        Alert mode fires the next ping as soon as the previous echo ended
+        and cycle_sec (the sensor's ~60 ms measurement cycle) has passed,
+        instead of a fixed sleep after each read.
+
+        Pings can't be closer than one measurement cycle, so the time goes
+        down only by taking fewer of them: once 3 in-range samples lie
+        within stable_cm of their median (a still surface) the median is
+        returned right away, ~3 cycles (~180 ms) instead of `samples`
+        cycles (~420 ms for 7). Noisy readings still use up to `samples`
+        pings. stable_cm=0 disables the early exit.
         """
         vals = []
         for _ in range(int(samples)):
+            if self.mode == "alert":
+                self._wait_cycle()
             d = self.read_distance_cm()
             if d is not None and min_cm <= d <= max_cm:
                 vals.append(d)
-            time.sleep(0.05)
+                if stable_cm > 0 and len(vals) >= 3:
+                    m = median(vals)
+                    if all(abs(v - m) <= stable_cm for v in vals[-3:]):
+                        return float(m)
+            if self.mode == "poll":
+                time.sleep(0.05)
 
         if len(vals) < 3:
             return None
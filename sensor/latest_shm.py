@@ -0,0 +1,263 @@
+# sensor/latest_shm.py
+"""
+Latest sensor values in a fixed-layout shared-memory segment.
+
+The collector publishes every tick into an mmap'd file under /dev/shm
+(LATEST_SHM_PATH); Django views and the alert worker read it without
+touching disk, SQLite or JSON — a read is a memcpy and a CRC, a few
+microseconds.
+
+Layout (little endian):
+
+  header  64 bytes   magic "TMLS", version, slots, slot size
+  slot    96 bytes   seq u64 | device_id 32s | ts_ms i64 |
+                     temp, current, level, level_pct, cycles f64 |
+                     present u32 | crc32 u32
+
+One slot per device. The writer bumps `seq` to odd, writes the payload,
+then bumps it to even (seqlock); a reader copies the slot, and only
+accepts it if seq was even and unchanged across the copy and the CRC
+of the payload matches, so a torn write is retried, never returned.
+Missing values are flagged in `present` (bit per field).
+
+One writer per device (the collector that samples it); any number of
+readers, in any process. This is enforced: slots are claimed under an
+flock on the segment, and the first publisher of a device holds an
+flock on <path>.<device>.lock for its lifetime — a second process
+publishing the same device (e.g. collector.py with DEMO=1 next to
+collector_local) is refused with a log line instead of interleaving
+its values. The locks go away with the process.
+
+  LATEST_SHM_PATH     /dev/shm/tempmon-latest
+  LATEST_SHM_SLOTS    devices per segment (16)
+  LATEST_SHM_MAX_AGE  readers ignore values older than N seconds (10)
+"""
+import os
+import re
+import mmap
+import time
+import fcntl
+import struct
+import zlib
+from typing import Dict, List, Optional
+
+_DEFAULT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+LATEST_SHM_PATH = os.getenv("LATEST_SHM_PATH", os.path.join(_DEFAULT_DIR, "tempmon-latest"))
+LATEST_SHM_SLOTS = int(os.getenv("LATEST_SHM_SLOTS", "16"))
+LATEST_SHM_MAX_AGE = float(os.getenv("LATEST_SHM_MAX_AGE", "10"))
+
+MAGIC = b"TMLS"
+VERSION = 1
+FIELDS = ("temp", "current", "level", "level_pct", "cycles")
+
+_HEADER = struct.Struct("<4sIII")
+HEADER_SIZE = 64
+_SEQ = struct.Struct("<Q")
+_BODY = struct.Struct("<32sq5dI")       # device_id, ts_ms, ค่า 5 ตัว, present
+_CRC = struct.Struct("<I")
+SLOT_SIZE = _SEQ.size + _BODY.size + _CRC.size   # 96
+
+_SPINS = 100   # ลองอ่านซ้ำกี่ครั้งถ้าชนจังหวะเขียน
+
+
+def _size(slots: int) -> int:
+    return HEADER_SIZE + slots * SLOT_SIZE
+
+
+class Publisher:
+    """ฝั่ง collector: เขียนค่าล่าสุดของเครื่องลง slot ของตัวเอง"""
+
+    def __init__(self, path: str = LATEST_SHM_PATH, slots: int = LATEST_SHM_SLOTS):
+        self.path = path
+        size = _size(slots)
+        # fd เปิดค้างไว้: ใช้ flock ตอนสร้าง segment / จอง slot (หลาย process เขียนไฟล์เดียวกัน)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            st = os.fstat(self.fd)
+            fresh = st.st_size != size
+            if fresh:
+                # สร้างใหม่ / layout เปลี่ยน -> ล้างทั้งไฟล์ (inode เดิม reader ที่ map ไว้ยังใช้ได้)
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+            self.mm = mmap.mmap(self.fd, size)
+            head = _HEADER.unpack_from(self.mm, 0)
+            if fresh or head != (MAGIC, VERSION, slots, SLOT_SIZE):
+                self.mm[:] = bytes(size)
+                _HEADER.pack_into(self.mm, 0, MAGIC, VERSION, slots, SLOT_SIZE)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.slots = slots
+        self._index: Dict[str, int] = {}
+        self._owned: Dict[str, int] = {}   # device_id -> fd ของ lock เจ้าของ (ถือไว้ตลอดอายุ process)
+        self._refused = set()
+
+    def _own(self, device_id: str) -> bool:
+        """จองสิทธิ์ผู้เขียนของเครื่องนี้ (flock แบบไม่รอ) — process อื่นถืออยู่ = False"""
+        lock_path = f"{self.path}.{re.sub(r'[^A-Za-z0-9_.-]', '_', device_id)}.lock"
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._owned[device_id] = fd
+        return True
+
+    def _slot(self, device_id: str) -> Optional[int]:
+        i = self._index.get(device_id)
+        if i is not None:
+            return i
+        if device_id in self._refused:
+            return None
+        if not self._own(device_id):
+            self._refused.add(device_id)
+            print(f"[latest_shm] {device_id} already published by another process — skipped", flush=True)
+            return None
+        key = device_id.encode("utf-8")[:32].ljust(32, b"\0")
+        fcntl.flock(self.fd, fcntl.LOCK_EX)   # หา + จอง slot ว่างแบบ atomic ข้าม process
+        try:
+            free = None
+            for i in range(self.slots):
+                off = HEADER_SIZE + i * SLOT_SIZE + _SEQ.size
+                cur = bytes(self.mm[off:off + 32])
+                if cur == key:
+                    break
+                if free is None and cur == bytes(32):
+                    free = i
+            else:
+                if free is None:
+                    raise RuntimeError(f"[latest_shm] no free slot for {device_id} (LATEST_SHM_SLOTS={self.slots})")
+                i = free
+                # เขียน key ไว้เลย (seq ยังเป็น 0 = reader เห็นเป็น slot ว่าง) ให้ publisher อื่นข้ามไป
+                off = HEADER_SIZE + i * SLOT_SIZE + _SEQ.size
+                self.mm[off:off + 32] = key
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self._index[device_id] = i
+        return i
+
+    def publish(self, device_id: str, ts_ms: int, **values) -> bool:
+        """
+        publish(device_id, ts_ms, temp=..., current=..., level=..., level_pct=..., cycles=...)
+        False = เครื่องนี้มี process อื่นเป็นผู้เขียนอยู่แล้ว (ไม่เขียนทับ)
+        """
+        i = self._slot(device_id)
+        if i is None:
+            return False
+        off = HEADER_SIZE + i * SLOT_SIZE
+        present = 0
+        vals = []
+        for bit, f in enumerate(FIELDS):
+            v = values.get(f)
+            if v is None:
+                vals.append(0.0)
+            else:
+                vals.append(float(v))
+                present |= 1 << bit
+        body = _BODY.pack(device_id.encode("utf-8")[:32], int(ts_ms), *vals, present)
+        seq = _SEQ.unpack_from(self.mm, off)[0]
+        _SEQ.pack_into(self.mm, off, seq + 1)            # คี่ = กำลังเขียน
+        self.mm[off + _SEQ.size:off + _SEQ.size + _BODY.size] = body
+        _CRC.pack_into(self.mm, off + _SEQ.size + _BODY.size, zlib.crc32(body))
+        _SEQ.pack_into(self.mm, off, seq + 2)            # คู่ = เสร็จ
+        return True
+
+    def close(self):
+        self.mm.close()
+        for fd in self._owned.values():
+            os.close(fd)   # ปล่อยสิทธิ์ผู้เขียน
+        self._owned.clear()
+        os.close(self.fd)
+
+
+class Reader:
+    """ฝั่งผู้อ่าน (Django / alert_worker): ไม่มี segment = คืน None ให้ผู้เรียก fallback เอง"""
+
+    def __init__(self, path: str = LATEST_SHM_PATH):
+        self.path = path
+        self.mm: Optional[mmap.mmap] = None
+        self.slots = 0
+        self._next_try = 0.0
+        self._index: Dict[str, int] = {}
+
+    def _open(self) -> bool:
+        if self.mm is not None:
+            return True
+        now = time.monotonic()
+        if now < self._next_try:
+            return False
+        self._next_try = now + 1.0   # ยังไม่มี collector -> ไม่ต้อง stat ทุก request
+        try:
+            with open(self.path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        magic, version, slots, slot_size = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE or len(mm) < _size(slots):
+            mm.close()
+            return False
+        self.mm, self.slots = mm, slots
+        return True
+
+    def _read_slot(self, i: int) -> Optional[Dict]:
+        off = HEADER_SIZE + i * SLOT_SIZE
+        for n in range(_SPINS):
+            if n:
+                time.sleep(0)   # ชนจังหวะเขียน: ปล่อย CPU ให้ writer เขียนจบก่อน
+            s1 = _SEQ.unpack_from(self.mm, off)[0]
+            if s1 & 1:
+                continue
+            raw = self.mm[off + _SEQ.size:off + SLOT_SIZE]
+            s2 = _SEQ.unpack_from(self.mm, off)[0]
+            if s1 != s2:
+                continue
+            body = raw[:_BODY.size]
+            if s1 == 0 or _CRC.unpack_from(raw, _BODY.size)[0] != zlib.crc32(body):
+                if s1 == 0:
+                    return None   # slot ว่าง
+                continue
+            dev, ts_ms, *vals, present = _BODY.unpack(body)
+            out = {"device_id": dev.rstrip(b"\0").decode("utf-8", "replace"), "ts_ms": ts_ms, "seq": s1}
+            for bit, (f, v) in enumerate(zip(FIELDS, vals)):
+                out[f] = v if present & (1 << bit) else None
+            if out["cycles"] is not None and out["cycles"].is_integer():
+                out["cycles"] = int(out["cycles"])   # ตัวนับสะสม ให้หน้าตาเหมือนใน SQLite
+            return out
+        return None
+
+    def get(self, device_id: str, max_age: Optional[float] = LATEST_SHM_MAX_AGE) -> Optional[Dict]:
+        """ค่าล่าสุดของเครื่อง หรือ None (ไม่มี segment / ไม่มีเครื่องนี้ / เก่ากว่า max_age วินาที)"""
+        if not self._open():
+            return None
+        i = self._index.get(device_id)
+        snap = self._read_slot(i) if i is not None else None
+        if snap is None or snap["device_id"] != device_id:
+            snap = None
+            for i in range(self.slots):
+                s = self._read_slot(i)
+                if s is not None and s["device_id"] == device_id:
+                    self._index[device_id] = i
+                    snap = s
+                    break
+        if snap is None:
+            return None
+        if max_age is not None and time.time() * 1000 - snap["ts_ms"] > max_age * 1000:
+            return None
+        return snap
+
+    def all(self) -> List[Dict]:
+        if not self._open():
+            return []
+        return [s for s in (self._read_slot(i) for i in range(self.slots)) if s is not None]
+
+
+_reader: Optional[Reader] = None
+
+
+def read(device_id: str, max_age: Optional[float] = LATEST_SHM_MAX_AGE) -> Optional[Dict]:
+    """ตัวอ่านร่วมของ process (map ครั้งเดียว)"""
+    global _reader
+    if _reader is None:
+        _reader = Reader()
+    return _reader.get(device_id, max_age)
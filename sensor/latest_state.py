@@ -0,0 +1,133 @@
+# sensor/latest_state.py
+"""
+Canonical "latest values" of a device: one map field on devices/{device_id}
+
+  latest.temp    {value, unit, temp_f, createdAt}
+  latest.level   {value, unit, percent, createdAt}
+  latest.cycles  {value, unit, createdAt}
+  latest.current {value, unit, createdAt}      (collectors that still read it)
+  latest.updatedAt
+
+LatestState remembers what was last written and, per tick, merges only
+the metrics that moved past their deadband into a single set(merge=True).
+A tick where nothing crossed a threshold costs no write at all; readers
+(latest_api, status_summary, temp_api) need exactly one document read.
+
+  LATEST_DEADBANDS      temp=0.3,current=0.15,level=0.3,cycles=1
+  LATEST_MIN_SEC        at most one write per N seconds (0 = every tick)
+  LATEST_HEARTBEAT_SEC  rewrite a metric whose createdAt is older than N
+                        seconds even if it did not move, so readers and
+                        staleness checks can tell the device is alive
+                        (300; 0 = off)
+"""
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from sensor import budget
+
+UNITS = {"temp": "°C", "current": "A", "level": "cm", "cycles": "cpm"}
+
+
+def _parse(s: str) -> Dict[str, float]:
+    out = {}
+    for part in s.split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip()] = float(v)
+    return out
+
+
+DEADBANDS = _parse(os.getenv("LATEST_DEADBANDS", "temp=0.3,current=0.15,level=0.3,cycles=1"))
+LATEST_MIN_SEC = float(os.getenv("LATEST_MIN_SEC", "0"))
+# ค่านิ่ง = ไม่มีการเขียน -> createdAt ไม่ขยับ; ต้องมี heartbeat ไม่งั้นหน้า dashboard เห็นเครื่องเป็น offline
+LATEST_HEARTBEAT_SEC = float(os.getenv("LATEST_HEARTBEAT_SEC", "300"))
+
+
+def doc_path(device_id: str) -> str:
+    return f"devices/{device_id}"
+
+
+def entry(metric: str, value, ts: datetime, extra: Optional[Dict] = None) -> Dict:
+    e = {"value": value, "unit": UNITS.get(metric), "createdAt": ts}
+    if metric == "temp" and value is not None:
+        e["temp_f"] = round(float(value) * 9 / 5 + 32, 2)
+    if extra:
+        e.update(extra)
+    return e
+
+
+def build(values: Dict[str, Optional[float]], ts: datetime,
+          extra: Optional[Dict[str, Dict]] = None) -> Dict:
+    """payload {"latest": {...}} ของ metric ที่ให้มา (ใช้ได้ทั้ง set(merge) และ outbox)"""
+    extra = extra or {}
+    latest = {m: entry(m, v, ts, extra.get(m)) for m, v in values.items()}
+    latest["updatedAt"] = ts
+    return {"latest": latest}
+
+
+class LatestState:
+    def __init__(self, device_id: str, deadbands: Optional[Dict[str, float]] = None,
+                 min_interval: float = LATEST_MIN_SEC, heartbeat: float = LATEST_HEARTBEAT_SEC):
+        self.device_id = device_id
+        self.deadbands = dict(DEADBANDS, **(deadbands or {}))
+        self.min_interval = min_interval
+        self.heartbeat = heartbeat
+        self.sent: Dict[str, float] = {}     # ค่าที่เขียนขึ้นไปล่าสุดต่อ metric
+        self.sent_ts: Dict[str, float] = {}  # เวลาที่เขียน metric นั้นล่าสุด (heartbeat ต่อ metric)
+        self.sent_at = 0.0
+        self.stats = {"writes": 0, "skipped": 0, "fields": 0}
+
+    def changes(self, values: Dict[str, Optional[float]], now: float) -> Dict[str, float]:
+        """metric ที่ต้องเขียนรอบนี้ (ข้ามเกินเดดแบนด์ / ยังไม่เคยเขียน / ถึงรอบ heartbeat)"""
+        if self.sent_at and now - self.sent_at < self.min_interval:
+            return {}
+        out = {}
+        for m, v in values.items():
+            if v is None:
+                continue
+            last = self.sent.get(m)
+            if last is None or abs(float(v) - last) >= self.deadbands.get(m, 0.0):
+                out[m] = v
+            elif self.heartbeat and now - self.sent_ts.get(m, 0.0) >= self.heartbeat:
+                out[m] = v   # ค่านิ่งนานเกิน heartbeat -> เขียนซ้ำให้ createdAt ขยับ
+        return out
+
+    def commit(self, changed: Dict[str, float], now: float):
+        for m, v in changed.items():
+            self.sent[m] = float(v)
+            self.sent_ts[m] = now
+        self.sent_at = now
+        self.stats["writes"] += 1
+        self.stats["fields"] += len(changed)
+
+    def item(self, values: Dict[str, Optional[float]], extra: Optional[Dict[str, Dict]] = None,
+             now: Optional[float] = None) -> Optional[Tuple[str, str, Dict]]:
+        """แบบ outbox: คืน ("latest", path, payload) หรือ None ถ้าไม่มีอะไรเปลี่ยน (ถือว่าส่งแล้ว)"""
+        now = time.time() if now is None else now
+        changed = self.changes(values, now)
+        if not changed:
+            self.stats["skipped"] += 1
+            return None
+        self.commit(changed, now)
+        ts = datetime.fromtimestamp(now, tz=timezone.utc)
+        return ("latest", doc_path(self.device_id), build(changed, ts, extra))
+
+    def publish(self, fs, values: Dict[str, Optional[float]], extra: Optional[Dict[str, Dict]] = None,
+                now: Optional[float] = None) -> Dict[str, float]:
+        """
+        เขียนตรงขึ้น Firestore: หนึ่ง write ต่อ tick (เฉพาะ metric ที่เปลี่ยน)
+        คืน metric ที่เขียน ({} = ไม่ต้องเขียน หรือ budget หมด); error โยนต่อ ค่าไม่ถูก commit -> รอบหน้าลองใหม่
+        """
+        now = time.time() if now is None else now
+        changed = self.changes(values, now)
+        if not changed:
+            self.stats["skipped"] += 1
+            return {}
+        if not budget.try_spend("write", "latest"):
+            return {}
+        ts = datetime.fromtimestamp(now, tz=timezone.utc)
+        fs.collection("devices").document(self.device_id).set(build(changed, ts, extra), merge=True)
+        self.commit(changed, now)
+        return changed
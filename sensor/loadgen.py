@@ -0,0 +1,203 @@
+# sensor/loadgen.py
+"""
+Synthetic load / accelerated replay for the local ingestion pipeline.
+
+Rows go through the same path as collector_local (local_db schema +
+ReadingsWriter group commits), and the minute aggregator runs in-process
+on its normal functions, so the numbers reflect the real code.
+
+  LOADGEN_MODE=synthetic  N virtual devices at LOADGEN_RATE_HZ each
+  LOADGEN_MODE=replay     re-play REPLAY_DB's readings at REPLAY_SPEED x
+
+Every LOADGEN_REPORT_SEC it prints ingest rows/s, writer backlog, commit
+latency p50/p95/max, aggregator run time and lag, and the upload backlog
+(outbox depth + age of the oldest queued document).
+
+Run:  LOADGEN_DEVICES=6 LOADGEN_RATE_HZ=50 python -m sensor.loadgen
+"""
+import os
+import math
+import time
+import random
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sensor.local_db import connect, ensure_readings_table, ensure_minutes_table
+from sensor.readings_writer import ReadingsWriter, WRITE_BATCH_ROWS, WRITE_BATCH_MS
+from sensor import minute_aggregator as agg
+from sensor import outbox
+from sensor.minute_uploader import queue_pending_minutes
+
+# ---- ENV ----
+LOADGEN_DB           = os.getenv("LOADGEN_DB", "/tmp/tempmon-loadgen.sqlite")  # อย่าชี้ไปที่ DB จริง
+LOADGEN_MODE         = os.getenv("LOADGEN_MODE", "synthetic")    # synthetic | replay
+LOADGEN_DEVICES      = int(os.getenv("LOADGEN_DEVICES", "4"))
+LOADGEN_RATE_HZ      = float(os.getenv("LOADGEN_RATE_HZ", "10"))  # ต่อเครื่อง
+LOADGEN_DURATION_SEC = float(os.getenv("LOADGEN_DURATION_SEC", "60"))
+LOADGEN_REPORT_SEC   = float(os.getenv("LOADGEN_REPORT_SEC", "5"))
+LOADGEN_AGG_SEC      = float(os.getenv("LOADGEN_AGG_SEC", "5"))   # รัน aggregator ทุกกี่วินาที (0=ปิด)
+LOADGEN_PREFIX       = os.getenv("LOADGEN_PREFIX", "lg")
+
+REPLAY_DB    = os.getenv("REPLAY_DB", "/var/lib/tempmon/data.sqlite")
+REPLAY_SPEED = float(os.getenv("REPLAY_SPEED", "60"))
+
+TICK_SEC = 0.01   # สร้างแถวเป็นก้อนทุก 10ms (เร็วถึงระดับ kHz ได้)
+
+
+def pct(xs: List[float], p: float) -> Optional[float]:
+    if not xs:
+        return None
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(len(xs) * p / 100.0))], 2)
+
+
+# ---------- sources ----------
+def synthetic_rows(devices: List[str], rate_hz: float, start_s: float) -> Iterator[Tuple[float, tuple]]:
+    """(due_at_sec, row) ตามเวลาจริง — ทุกเครื่องส่งพร้อมกันทุก 1/rate วินาที"""
+    step = 1.0 / rate_hz
+    cycles = {d: 0 for d in devices}
+    i = 0
+    while True:
+        t = start_s + i * step
+        ts_ms = int(t * 1000)
+        for k, d in enumerate(devices):
+            if random.random() < 0.02:
+                cycles[d] += 1
+            yield t, (d, ts_ms,
+                      60 + 10 * math.sin(t / 60 + k) + random.uniform(-0.2, 0.2),
+                      40 + 5 * math.sin(t / 300 + k),
+                      cycles[d])
+        i += 1
+
+
+def replay_rows(path: str, speed: float, start_s: float) -> Iterator[Tuple[float, tuple]]:
+    """อ่าน readings จาก DB ที่บันทึกไว้ แล้วบีบเวลาให้เร็วขึ้น speed เท่า"""
+    src = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    cols = {r[1] for r in src.execute("PRAGMA table_info(readings)")}
+    dev_col = "device_id" if "device_id" in cols else "'replay'"
+    q = src.execute(f"SELECT {dev_col}, ts_ms, temp, level, cycles FROM readings ORDER BY ts_ms")
+    t0 = None
+    for dev, ts_ms, temp, level, cycles in q:
+        if t0 is None:
+            t0 = ts_ms
+        due = start_s + (ts_ms - t0) / 1000.0 / speed
+        yield due, (f"{LOADGEN_PREFIX}-{dev}", int(due * 1000), temp, level, cycles)
+    src.close()
+
+
+# ---------- measurements ----------
+def run_aggregator(cur, devices: List[str]) -> float:
+    t0 = time.perf_counter()
+    target = agg.floor_to_minute_utc(int(time.time() * 1000)) - 60000
+    for d in devices:
+        agg.backfill_device(cur, d, target)
+    queue_pending_minutes(cur)
+    cur.connection.commit()
+    return (time.perf_counter() - t0) * 1000.0
+
+
+def lag_report(cur, devices: List[str]) -> Dict:
+    now_ms = int(time.time() * 1000)
+    qs = ",".join("?" * len(devices))
+    last_min = cur.execute(
+        f"SELECT MAX(ts_minute) FROM minutes WHERE device_id IN ({qs})", devices).fetchone()[0]
+    m = outbox.metrics(cur)   # loadgen ไม่มี consumer -> depth โตตามจำนวนนาที
+    return {
+        # นาทีล่าสุดที่สรุปแล้ว ปิดไปนานแค่ไหน
+        "agg_lag_s": round((now_ms - (last_min + 60000)) / 1000.0, 1) if last_min else None,
+        "upload_backlog": m["depth"],
+        "upload_oldest_s": m["oldest_age_s"],
+    }
+
+
+def main():
+    start = time.time()
+    conn = connect(LOADGEN_DB, isolation_level=None, check_same_thread=False)
+    cur = conn.cursor()
+    ensure_readings_table(cur)
+    ensure_minutes_table(cur)
+    cur.execute("PRAGMA synchronous=NORMAL")
+    writer = ReadingsWriter(conn, max_rows=WRITE_BATCH_ROWS, max_ms=WRITE_BATCH_MS)
+
+    # aggregator ใช้ connection ของตัวเอง (แบบเดียวกับ process จริง)
+    acon = sqlite3.connect(LOADGEN_DB)
+    acur = acon.cursor()
+
+    if LOADGEN_MODE == "replay":
+        src = replay_rows(REPLAY_DB, REPLAY_SPEED, start)
+        devices: List[str] = []
+        print(f"[loadgen] replay {REPLAY_DB} x{REPLAY_SPEED} -> {LOADGEN_DB}", flush=True)
+    else:
+        devices = [f"{LOADGEN_PREFIX}-{i + 1:03d}" for i in range(LOADGEN_DEVICES)]
+        src = synthetic_rows(devices, LOADGEN_RATE_HZ, start)
+        print(f"[loadgen] synthetic devices={LOADGEN_DEVICES} rate={LOADGEN_RATE_HZ}Hz/device "
+              f"(target {LOADGEN_DEVICES * LOADGEN_RATE_HZ:.0f} rows/s) -> {LOADGEN_DB}", flush=True)
+
+    seen = set(devices)
+    sent = 0
+    sent_at_report = 0
+    agg_ms: List[float] = []
+    next_report = start + LOADGEN_REPORT_SEC
+    next_agg = start + LOADGEN_AGG_SEC if LOADGEN_AGG_SEC > 0 else float("inf")
+    pending_item = None
+    done = False
+
+    try:
+        while not done:
+            now = time.time()
+            if now - start >= LOADGEN_DURATION_SEC:
+                break
+
+            # ส่งทุกแถวที่ถึงเวลาแล้ว
+            while True:
+                item = pending_item or next(src, None)
+                pending_item = None
+                if item is None:
+                    done = True
+                    break
+                due, row = item
+                if due > now:
+                    pending_item = item
+                    break
+                writer.add(row)
+                sent += 1
+                seen.add(row[0])
+
+            if now >= next_agg and seen:
+                agg_ms.append(run_aggregator(acur, sorted(seen)))
+                next_agg += LOADGEN_AGG_SEC
+
+            if now >= next_report:
+                span = LOADGEN_REPORT_SEC
+                lat = list(writer.commit_ms)
+                lag = lag_report(acur, sorted(seen)) if seen else {}
+                print(
+                    f"[loadgen] t={now - start:6.1f}s ingest={(sent - sent_at_report) / span:8.1f} rows/s "
+                    f"pending={writer.pending()} commits={writer.stats['commits']} "
+                    f"commit_p50={pct(lat, 50)}ms p95={pct(lat, 95)}ms max={round(writer.stats['max_commit_ms'], 2)}ms "
+                    f"errors={writer.stats['errors']} agg_run={pct(agg_ms[-5:], 50)}ms "
+                    f"agg_lag={lag.get('agg_lag_s')}s upload_backlog={lag.get('upload_backlog')} "
+                    f"upload_oldest={lag.get('upload_oldest_s')}s",
+                    flush=True,
+                )
+                sent_at_report = sent
+                next_report += LOADGEN_REPORT_SEC
+
+            time.sleep(TICK_SEC)
+    finally:
+        writer.close()
+        elapsed = time.time() - start
+        lat = list(writer.commit_ms)
+        print(
+            f"[loadgen] DONE rows={sent} in {elapsed:.1f}s = {sent / max(elapsed, 1e-9):.1f} rows/s "
+            f"devices={len(seen)} commits={writer.stats['commits']} "
+            f"commit_p50={pct(lat, 50)}ms p95={pct(lat, 95)}ms max={round(writer.stats['max_commit_ms'], 2)}ms "
+            f"dropped={writer.stats['dropped']} agg_run_p95={pct(agg_ms, 95)}ms",
+            flush=True,
+        )
+        acon.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
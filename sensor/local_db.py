@@ -0,0 +1,108 @@
+# sensor/local_db.py
+"""
+Local SQLite schema (readings / minutes) shared by the collector, the
+aggregator, the uploader, the alert worker and the Django views.
+
+Every table is keyed by device_id so one gateway process can serve several
+presses. Raw readings are split into one table per day (see partitions.py).
+Older single-device databases are migrated in place: existing rows are
+assigned to DEVICE_ID.
+"""
+import os
+import time
+import sqlite3
+
+from sensor import partitions
+
+DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+DEVICE_ID = os.getenv("DEVICE_ID", "pi5-001")
+
+
+def table_cols(cur, table: str) -> set:
+    # PRAGMA: cid, name, type, notnull, dflt_value, pk
+    return {r[1] for r in cur.execute(f"PRAGMA table_info({table})")}
+
+
+def ensure_readings_table(cur, default_device: str = DEVICE_ID):
+    """
+    raw readings เก็บเป็นตารางรายวัน (sensor/partitions.py) + view `readings`
+    DB เก่าที่เป็นตารางเดียวจะถูกย้ายเข้า partition ครั้งแรกที่เรียก
+    """
+    partitions.migrate_legacy(cur, default_device)
+    partitions.ensure_partition(cur, int(time.time() * 1000), refresh=False)
+    # view ต้องครอบทุก partition — ไม่ใช่แค่ตอนยังไม่มี view (ข้ามวัน = มีตารางใหม่)
+    partitions.sync_view(cur)
+
+
+MINUTES_DDL = """
+CREATE TABLE IF NOT EXISTS {name} (
+  device_id TEXT NOT NULL,
+  minute_id TEXT NOT NULL,
+  ts_minute INTEGER NOT NULL,
+  temp_avg REAL,
+  temp_min REAL,
+  temp_max REAL,
+  temp_last REAL,
+  level_avg REAL,
+  level_min REAL,
+  level_max REAL,
+  level_last REAL,
+  cycles_delta INTEGER,
+  n_samples INTEGER,
+  uploaded INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (device_id, minute_id)
+)
+"""
+
+# สถิติต่อ bucket (minutes / hours / days ใช้ชุดเดียวกัน)
+STAT_COLS = (
+    "temp_avg", "temp_min", "temp_max", "temp_last",
+    "level_avg", "level_min", "level_max", "level_last",
+    "cycles_delta", "n_samples",
+)
+
+# คอลัมน์ที่เพิ่มทีหลัง (DB เก่าจะถูก ALTER TABLE ADD COLUMN ให้)
+MINUTES_EXTRA_COLS = {
+    "temp_last": "REAL",
+    "level_min": "REAL",
+    "level_max": "REAL",
+    "level_last": "REAL",
+    "n_samples": "INTEGER",
+}
+
+
+def ensure_minutes_table(cur, default_device: str = DEVICE_ID):
+    cur.execute(MINUTES_DDL.format(name="minutes"))
+    if "device_id" not in table_cols(cur, "minutes"):
+        # PK เดิมคือ minute_id อย่างเดียว -> สร้างตารางใหม่แล้วย้ายข้อมูล
+        cur.execute("DROP INDEX IF EXISTS idx_minutes_ts")
+        cur.execute("ALTER TABLE minutes RENAME TO minutes_legacy")
+        cur.execute(MINUTES_DDL.format(name="minutes"))
+        cur.execute("""
+          INSERT INTO minutes(device_id, minute_id, ts_minute, temp_avg, temp_min, temp_max,
+                              level_avg, cycles_delta, uploaded)
+          SELECT ?, minute_id, ts_minute, temp_avg, temp_min, temp_max,
+                 level_avg, cycles_delta, uploaded
+          FROM minutes_legacy
+        """, (default_device,))
+        cur.execute("DROP TABLE minutes_legacy")
+    have = table_cols(cur, "minutes")
+    for col, typ in MINUTES_EXTRA_COLS.items():
+        if col not in have:
+            cur.execute(f"ALTER TABLE minutes ADD COLUMN {col} {typ}")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_minutes_ts ON minutes(ts_minute)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_minutes_dev_ts ON minutes(device_id, ts_minute)")
+    # minutes ที่ยังไม่เข้า outbox (มีไม่กี่แถว -> index เล็ก)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_minutes_pending ON minutes(ts_minute) WHERE uploaded = 0")
+
+
+def connect(path: str = DB, **kw) -> sqlite3.Connection:
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    con = sqlite3.connect(path, **kw)
+    if con.execute("PRAGMA page_count").fetchone()[0] == 0:
+        # DB ใหม่: ให้หน้าที่ว่างจากการ DROP partition คืนพื้นที่ได้ (PRAGMA incremental_vacuum)
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    con.execute("PRAGMA journal_mode=WAL")
+    return con
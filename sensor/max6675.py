@@ -1,7 +1,22 @@
-import time, spidev, statistics
+import os, time, spidev, statistics, threading
+from collections import deque
+from typing import Dict, NamedTuple, Optional, Sequence
 
 CONV_TIME = 0.25  # ~220ms ต่อการแปลง 1 ค่า
+STALE_SEC = float(os.getenv("MAX6675_STALE_SEC", "2.0"))   # cache เก่ากว่านี้ = stale
+FILTER_N  = int(os.getenv("MAX6675_FILTER_N", "3"))        # median ของกี่ค่าล่าสุด
 _reader = None
+_reader_lock = threading.Lock()
+
+# หนึ่ง SPI bus ใช้ร่วมกันหลายชิป (CE0/CE1) -> ล็อกต่อ bus
+_bus_locks: Dict[int, threading.Lock] = {}
+_bus_locks_guard = threading.Lock()
+
+def spi_bus_lock(bus: int) -> threading.Lock:
+    with _bus_locks_guard:
+        if bus not in _bus_locks:
+            _bus_locks[bus] = threading.Lock()
+        return _bus_locks[bus]
 
 class Max6675:
     def __init__(self, bus=0, ce=0, hz=4_000_000, samples=3):
@@ -11,22 +26,105 @@ class Max6675:
         self.spi.mode = 0
         self.samples = samples
 
+    def read_once(self) -> float:
+        """อ่าน 1 ค่า (ไม่รอ) — การอ่านจะเริ่มการแปลงรอบใหม่ของชิป"""
+        h, l = self.spi.xfer2([0, 0])
+        v = (h << 8) | l
+        if v & 0x04:
+            raise RuntimeError("Thermocouple not connected")
+        return (v >> 3) * 0.25   # 12-bit, step 0.25°C
+
     def read_c(self) -> float:
         vals = []
         for _ in range(self.samples):
-            h, l = self.spi.xfer2([0, 0])
-            v = (h << 8) | l
-            if v & 0x04:
-                raise RuntimeError("Thermocouple not connected")
-            vals.append((v >> 3) * 0.25)   # 12-bit, step 0.25°C
+            vals.append(self.read_once())
             time.sleep(CONV_TIME)
         return statistics.median(vals)
 
-def get_reader():
+    def close(self):
+        try:
+            self.spi.close()
+        except Exception:
+            pass
+
+class TempReading(NamedTuple):
+    temp_c: Optional[float]   # median ของ FILTER_N ค่าล่าสุด
+    ts: Optional[float]       # epoch sec ของค่าล่าสุดที่อ่านได้
+    age: Optional[float]      # วินาทีตั้งแต่อ่านได้ล่าสุด
+    stale: bool
+
+class Max6675Poller(threading.Thread):
+    """
+    Background reader for one or more MAX6675 on one SPI bus (CE0/CE1).
+    Each chip is read once per conversion time; every read holds the bus
+    lock, so several thermocouples (and other code using spi_bus_lock)
+    never talk on the bus at the same time. Readers get the cached,
+    median-filtered value immediately via get().
+    """
+    def __init__(self, bus=0, ces: Sequence[int] = (0,), hz=4_000_000,
+                 window=FILTER_N, conv_time=CONV_TIME, stale_sec=STALE_SEC):
+        super().__init__(name=f"max6675-bus{bus}", daemon=True)
+        self.bus = int(bus)
+        self.conv_time = float(conv_time)
+        self.stale_sec = float(stale_sec)
+        self.lock = spi_bus_lock(self.bus)
+        self.chips = {int(ce): Max6675(bus=self.bus, ce=int(ce), hz=hz, samples=1) for ce in ces}
+        self._vals = {ce: deque(maxlen=max(1, int(window))) for ce in self.chips}
+        self._ts: Dict[int, Optional[float]] = {ce: None for ce in self.chips}
+        self.errors: Dict[int, Optional[str]] = {ce: None for ce in self.chips}
+        self._state_lock = threading.Lock()
+        self._stop_evt = threading.Event()
+
+    def stop(self):
+        self._stop_evt.set()
+
+    def run(self):
+        next_t = time.monotonic()
+        while not self._stop_evt.is_set():
+            for ce, chip in self.chips.items():
+                try:
+                    with self.lock:
+                        v = chip.read_once()
+                    with self._state_lock:
+                        self._vals[ce].append(v)
+                        self._ts[ce] = time.time()
+                        self.errors[ce] = None
+                except Exception as e:
+                    # อ่านไม่ได้ -> ไม่อัปเดต cache (จะกลายเป็น stale เอง)
+                    self.errors[ce] = str(e)
+            # รอให้ชิปแปลงค่ารอบใหม่เสร็จก่อนอ่านซ้ำ
+            next_t += self.conv_time
+            now = time.monotonic()
+            if next_t < now:
+                next_t = now
+            self._stop_evt.wait(next_t - now)
+        for chip in self.chips.values():
+            chip.close()
+
+    def get(self, ce=0) -> TempReading:
+        with self._state_lock:
+            vals = list(self._vals.get(int(ce), ()))
+            ts = self._ts.get(int(ce))
+        if not vals or ts is None:
+            return TempReading(None, None, None, True)
+        age = max(0.0, time.time() - ts)
+        return TempReading(float(statistics.median(vals)), ts, age, age > self.stale_sec)
+
+def get_reader() -> Max6675Poller:
     global _reader
-    if _reader is None:
-        _reader = Max6675(bus=0, ce=0)   # ใช้ CE1 → เปลี่ยนเป็น ce=1
-    return _reader
+    with _reader_lock:
+        if _reader is None:
+            bus = int(os.getenv("MAX6675_BUS", "0"))
+            ces = [int(x) for x in os.getenv("MAX6675_CES", "0").split(",") if x.strip()]  # "0,1" = CE0+CE1
+            _reader = Max6675Poller(bus=bus, ces=ces)
+            _reader.start()
+        return _reader
+
+def get_temp_reading(ce=0) -> TempReading:
+    """ค่าจาก cache ทันที พร้อมอายุและ flag stale"""
+    return get_reader().get(ce)
 
-def get_temp_c() -> float:
-    return get_reader().read_c()
+def get_temp_c(ce=0) -> Optional[float]:
+    """ค่าจาก cache ทันที (ไม่ block) — None ถ้ายังไม่มีค่าหรือ stale"""
+    r = get_temp_reading(ce)
+    return None if r.stale else r.temp_c
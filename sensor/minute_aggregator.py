@@ -3,28 +3,28 @@ import os
 import sqlite3
 import time
 from datetime import datetime, timezone
+from typing import Optional
+
+from sensor.local_db import ensure_readings_table, ensure_minutes_table, STAT_COLS
+from sensor import partitions, rollups
+from sensor.devices import device_ids
+from sensor.scheduler import DeadlineScheduler
+from sensor.minute_uploader import queue_pending_minutes
+from sensor.readings_writer import WRITE_BATCH_MS
 
 DB_PATH = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+DEVICE_ID = os.getenv("DEVICE_ID", "pi5-001")
 
 # ถ้าอยากให้ “สรุปย้อนหลังหลายๆนาที” เวลาเครื่องดับ/เน็ตหลุด
 # ให้ตั้ง RUN_BACKFILL=1 แล้วมันจะไล่เติมให้ครบจนถึงนาทีล่าสุดที่ปิดแล้ว
 RUN_BACKFILL = os.getenv("RUN_BACKFILL", "0") == "1"
 
-
-def ensure_minutes_table(cur: sqlite3.Cursor):
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS minutes (
-      minute_id TEXT PRIMARY KEY,
-      ts_minute INTEGER NOT NULL,
-      temp_avg REAL,
-      temp_min REAL,
-      temp_max REAL,
-      level_avg REAL,
-      cycles_delta INTEGER,
-      uploaded INTEGER NOT NULL DEFAULT 0
-    );
-    """)
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_minutes_ts ON minutes(ts_minute);")
+# AGG_DAEMON=1: รันค้างไว้ (systemd) tail readings แล้วสรุปนาทีทันทีที่ปิด แทน cron ทุกนาที
+AGG_DAEMON = os.getenv("AGG_DAEMON", "0") == "1"
+AGG_POLL_SEC = float(os.getenv("AGG_POLL_SEC", "0.5"))
+# รอแถวที่ยังค้างใน writer หลังนาทีปิด: ต้องไม่น้อยกว่ารอบ flush ของ ReadingsWriter
+# (WRITE_BATCH_MS + tick 250ms) ไม่งั้นนาทีถูกสรุปก่อนแถวท้ายๆ commit
+AGG_GRACE_MS = int(os.getenv("AGG_GRACE_MS", str(WRITE_BATCH_MS + 500)))
 
 
 def floor_to_minute_utc(ts_ms: int) -> int:
@@ -38,27 +38,11 @@ def minute_id_utc(ts_minute_ms: int) -> str:
     return dt.strftime("%Y%m%d%H%M")
 
 
-def compute_and_upsert_one_minute(cur: sqlite3.Cursor, ts_minute_ms: int) -> bool:
+def minute_stats(rows) -> dict:
     """
-    สรุปข้อมูลของนาที ts_minute_ms (ช่วง [ts_minute_ms, ts_minute_ms+60000) )
-    คืน True ถ้ามีข้อมูลแล้วเขียนได้, False ถ้าไม่มี readings ในช่วงนั้น
+    rows: (ts_ms, temp, level, cycles) ของหนึ่งนาที เรียงตามเวลา
+    คืน dict ตามคอลัมน์ของตาราง minutes
     """
-    start_ms = ts_minute_ms
-    end_ms = ts_minute_ms + 60000
-
-    rows = cur.execute(
-        """
-        SELECT ts_ms, temp, level, cycles
-        FROM readings
-        WHERE ts_ms >= ? AND ts_ms < ?
-        ORDER BY ts_ms ASC
-        """,
-        (start_ms, end_ms),
-    ).fetchall()
-
-    if not rows:
-        return False
-
     temps = []
     levels = []
     cycles_vals = []
@@ -80,98 +64,357 @@ def compute_and_upsert_one_minute(cur: sqlite3.Cursor, ts_minute_ms: int) -> boo
             except Exception:
                 pass
 
-    # temp stats
-    temp_avg = (sum(temps) / len(temps)) if temps else None
-    temp_min = (min(temps)) if temps else None
-    temp_max = (max(temps)) if temps else None
-
-    # level avg (มึงเก็บเป็น % หรือ cm ก็ได้ เอาเป็น avg ตรงๆ)
-    level_avg = (sum(levels) / len(levels)) if levels else None
-
     # cycles delta: ใช้ค่าต้นนาที -> ปลายนาที
     # ถ้า cycles เป็น cumulative counter จะได้ delta ต่อ นาทีพอดี
     cycles_delta = None
     if cycles_vals:
-        first_c = cycles_vals[0]
-        last_c = cycles_vals[-1]
-        d = last_c - first_c
+        d = cycles_vals[-1] - cycles_vals[0]
         if d < 0:
             # กันกรณี counter reset
             d = 0
         cycles_delta = d
-    else:
-        cycles_delta = None
-
-    mid = minute_id_utc(ts_minute_ms)
-
-    # ถ้า record นี้เคย upload แล้ว แต่มีการ recompute ใหม่ (rare)
-    # เรา "คง uploaded" ไว้เดิม เพื่อไม่ทำให้มัน upload ซ้ำ
-    old = cur.execute("SELECT uploaded FROM minutes WHERE minute_id=?", (mid,)).fetchone()
-    old_uploaded = int(old[0]) if old else 0
 
+    return {
+        # temp stats
+        "temp_avg": (sum(temps) / len(temps)) if temps else None,
+        "temp_min": min(temps) if temps else None,
+        "temp_max": max(temps) if temps else None,
+        "temp_last": temps[-1] if temps else None,
+        # level (มึงเก็บเป็น % หรือ cm ก็ได้ เอาเป็น avg ตรงๆ)
+        "level_avg": (sum(levels) / len(levels)) if levels else None,
+        "level_min": min(levels) if levels else None,
+        "level_max": max(levels) if levels else None,
+        "level_last": levels[-1] if levels else None,
+        "cycles_delta": cycles_delta,
+        "n_samples": len(rows),
+    }
+
+
+UPSERT_MINUTE_SQL = f"""
+INSERT INTO minutes(device_id, minute_id, ts_minute, {", ".join(STAT_COLS)}, uploaded)
+VALUES(?,?,?,{",".join("?" * len(STAT_COLS))},0)
+ON CONFLICT(device_id, minute_id) DO UPDATE SET
+  ts_minute = excluded.ts_minute,
+  {", ".join(f"{c} = excluded.{c}" for c in STAT_COLS)}
+"""
+# uploaded ไม่อยู่ใน DO UPDATE: ถ้า record นี้เคย upload แล้ว แต่มีการ recompute ใหม่ (rare)
+# เรา "คง uploaded" ไว้เดิม เพื่อไม่ทำให้มัน upload ซ้ำ
+
+# สรุปนาทีใหม่เพราะมีแถวมาเพิ่ม (late / spill): ค่าเปลี่ยน -> uploaded=0 ให้เข้า outbox อีกรอบ
+# ค่าเท่าเดิม -> คง uploaded ไว้ (ไม่ส่งซ้ำ)
+REUPLOAD_MINUTE_SQL = f"""
+INSERT INTO minutes(device_id, minute_id, ts_minute, {", ".join(STAT_COLS)}, uploaded)
+VALUES(?,?,?,{",".join("?" * len(STAT_COLS))},0)
+ON CONFLICT(device_id, minute_id) DO UPDATE SET
+  ts_minute = excluded.ts_minute,
+  {", ".join(f"{c} = excluded.{c}" for c in STAT_COLS)},
+  uploaded = CASE WHEN {" OR ".join(f"minutes.{c} IS NOT excluded.{c}" for c in STAT_COLS)}
+                  THEN 0 ELSE minutes.uploaded END
+"""
+
+
+def upsert_minute(cur: sqlite3.Cursor, device_id: str, ts_minute_ms: int, stats: dict,
+                  reupload: bool = False):
     cur.execute(
-        """
-        INSERT INTO minutes(
-          minute_id, ts_minute, temp_avg, temp_min, temp_max, level_avg, cycles_delta, uploaded
-        )
-        VALUES(?,?,?,?,?,?,?,?)
-        ON CONFLICT(minute_id) DO UPDATE SET
-          ts_minute     = excluded.ts_minute,
-          temp_avg      = excluded.temp_avg,
-          temp_min      = excluded.temp_min,
-          temp_max      = excluded.temp_max,
-          level_avg     = excluded.level_avg,
-          cycles_delta  = excluded.cycles_delta,
-          uploaded      = minutes.uploaded
-        """,
-        (mid, ts_minute_ms, temp_avg, temp_min, temp_max, level_avg, cycles_delta, old_uploaded),
+        REUPLOAD_MINUTE_SQL if reupload else UPSERT_MINUTE_SQL,
+        (device_id, minute_id_utc(ts_minute_ms), ts_minute_ms) + tuple(stats[c] for c in STAT_COLS),
     )
 
+
+def compute_and_upsert_one_minute(cur: sqlite3.Cursor, ts_minute_ms: int,
+                                  device_id: str = DEVICE_ID, reupload: bool = False) -> bool:
+    """
+    สรุปข้อมูลของนาที ts_minute_ms (ช่วง [ts_minute_ms, ts_minute_ms+60000) ) ของ device_id
+    คืน True ถ้ามีข้อมูลแล้วเขียนได้, False ถ้าไม่มี readings ในช่วงนั้น
+    reupload=True: ถ้าค่าต่างจากที่เขียนไว้ ให้ส่งขึ้น Firestore ใหม่ (REUPLOAD_MINUTE_SQL)
+    """
+    rows = partitions.query_range(cur, device_id, ts_minute_ms, ts_minute_ms + 60000)
+    if not rows:
+        return False
+
+    upsert_minute(cur, device_id, ts_minute_ms, minute_stats(rows), reupload)
     return True
 
 
-def main():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
+# set-based: สรุปทุกนาทีในช่วงด้วย GROUP BY ts_ms/60000 (ต่อ partition)
+MINUTE_GROUP_SQL = """
+SELECT device_id, ts_ms / 60000 AS m, COUNT(*),
+       AVG(temp), MIN(temp), MAX(temp),
+       AVG(level), MIN(level), MAX(level)
+FROM {part}
+WHERE {where} ts_ms >= ? AND ts_ms < ?
+GROUP BY device_id, m
+"""
+
+# ค่า last/first ที่ไม่ใช่ NULL ต่อนาที: SQLite คืนคอลัมน์ "bare" จากแถวที่ได้ MAX()/MIN()
+# (เร็วกว่า window function ~4 เท่าบน Pi เพราะไม่ต้อง sort ซ้ำ)
+MINUTE_EDGE_SQL = """
+SELECT device_id, ts_ms / 60000 AS m, {fn}(ts_ms), {col}
+FROM {part}
+WHERE {where} ts_ms >= ? AND ts_ms < ? AND {col} IS NOT NULL
+GROUP BY device_id, m
+"""
+_EDGES = (("temp_last", "MAX", "temp"), ("level_last", "MAX", "level"),
+          ("cyc_first", "MIN", "cycles"), ("cyc_last", "MAX", "cycles"))
+
+
+def compute_range(cur: sqlite3.Cursor, device_id, start_ms: int, end_ms: int) -> list:
+    """
+    สรุปทุกนาทีใน [start_ms, end_ms) ของ device_id (None = ทุกเครื่อง) แบบ set-based
+    คืน list ของ tuple ตาม UPSERT_MINUTE_SQL (อ่านอย่างเดียว ใช้กับ connection mode=ro ได้)
+    """
+    start_ms = floor_to_minute_utc(start_ms)
+    where = "" if device_id is None else "device_id = ? AND"
+    params = (start_ms, end_ms) if device_id is None else (device_id, start_ms, end_ms)
+    out = []
+    # partition รายวันตรงกับขอบนาทีพอดี -> หนึ่งนาทีไม่มีทางคร่อมสองตาราง
+    for name in partitions.overlapping(cur, start_ms, end_ms):
+        edges = {}
+        for key, fn, col in _EDGES:
+            q = MINUTE_EDGE_SQL.format(part=name, where=where, fn=fn, col=col)
+            for did, m, _, v in cur.execute(q, params):
+                edges[(key, did, m)] = v
+
+        q = MINUTE_GROUP_SQL.format(part=name, where=where)
+        for did, m, cnt, t_avg, t_min, t_max, l_avg, l_min, l_max in cur.execute(q, params).fetchall():
+            c_first = edges.get(("cyc_first", did, m))
+            c_last = edges.get(("cyc_last", did, m))
+            cycles_delta = None
+            if c_last is not None:
+                cycles_delta = max(0, int(c_last) - int(c_first))   # กันกรณี counter reset
+            stats = {
+                "temp_avg": t_avg, "temp_min": t_min, "temp_max": t_max,
+                "temp_last": edges.get(("temp_last", did, m)),
+                "level_avg": l_avg, "level_min": l_min, "level_max": l_max,
+                "level_last": edges.get(("level_last", did, m)),
+                "cycles_delta": cycles_delta, "n_samples": cnt,
+            }
+            out.append((did, minute_id_utc(m * 60000), m * 60000) + tuple(stats[c] for c in STAT_COLS))
+    return out
+
+
+def aggregate_range(cur: sqlite3.Cursor, device_id, start_ms: int, end_ms: int) -> int:
+    """compute_range() แล้ว upsert ลง minutes — ไม่มีเพดาน 24 ชม. แล้ว คืนจำนวนนาทีที่เขียน"""
+    out = compute_range(cur, device_id, start_ms, end_ms)
+    cur.executemany(UPSERT_MINUTE_SQL, out)
+    return len(out)
+
+
+def backfill_device(cur: sqlite3.Cursor, device_id: str, target_minute_ms: int) -> int:
+    # backfill: เติมตั้งแต่ minute ล่าสุดที่มีใน minutes +1 ไปจนถึง target (รวม target)
+    last = cur.execute(
+        "SELECT MAX(ts_minute) FROM minutes WHERE device_id=?", (device_id,)
+    ).fetchone()
+    last_ts = int(last[0]) if last and last[0] is not None else None
 
-    # WAL ช่วยให้ collector เขียนพร้อมกันได้ลื่นขึ้น
-    cur.execute("PRAGMA journal_mode=WAL;")
-    ensure_minutes_table(cur)
-    con.commit()
+    if last_ts is None:
+        # ยังไม่มี minutes เลย -> เริ่มจาก partition แรกที่มี
+        parts = partitions.list_partitions(cur)
+        if not parts:
+            return 0
+        start = parts[0][0]
+    else:
+        start = last_ts + 60000
+
+    if start > target_minute_ms:
+        return 0
+    return aggregate_range(cur, device_id, start, target_minute_ms + 60000)
 
+
+# =========================================================
+# daemon: tail readings ตาม rowid แล้วสรุปนาทีทันทีที่ปิด
+# =========================================================
+class MinuteTailer:
+    """
+    อ่านแถวใหม่จาก partition รายวันตาม watermark (ตาราง, rowid) แล้วสะสมไว้ใน
+    RAM ต่อ (device_id, นาที) — พอนาทีปิด (+ grace) ก็สรุปด้วย minute_stats()
+    แล้ว upsert ทันที ไม่ต้องสแกน readings ซ้ำ
+
+    แถวที่มาช้ากว่านาทีที่ emit ไปแล้ว -> สรุปนาทีนั้นใหม่จาก DB (แม่นยำเหมือนเดิม)
+
+    sensor/supervisor.py ไม่ poll DB: ป้อนแถวจาก collector ด้วย feed() แล้วเรียก emit()
+    """
+
+    def __init__(self, cur: sqlite3.Cursor, grace_ms: int = AGG_GRACE_MS):
+        self.cur = cur
+        self.grace_ms = grace_ms
+        self.marks = {}      # partition name -> last rowid
+        self.acc = {}        # (device_id, ts_minute) -> [(ts_ms, temp, level, cycles), ...]
+        self.emitted_until = {}   # device_id -> ต้นนาทีถัดจากนาทีล่าสุดที่ emit
+        self.late = set()         # (device_id, นาที) ที่ emit ไปแล้วแต่มีแถวมาเพิ่ม
+        self.spilled = set()      # (device_id, นาที) ที่มีแถวไม่ผ่าน RAM -> สรุปจาก DB
+        self.stats = {"rows": 0, "minutes": 0, "late": 0, "spilled": 0, "lag_ms_max": 0.0}
+
+    def _recent_parts(self, now_ms: int):
+        # partition ของวันนี้และเมื่อวาน (แถวช้าข้ามเที่ยงคืน)
+        return [(d, n) for d, n in partitions.list_partitions(self.cur)
+                if d + partitions.DAY_MS > now_ms - partitions.DAY_MS]
+
+    def start(self, now_ms: int):
+        """ตั้ง watermark = rowid สูงสุดตอนนี้ แล้วโหลดแถวของนาทีที่ยังเปิดอยู่เข้า RAM"""
+        open_min = floor_to_minute_utc(now_ms)
+        self.cur.execute("BEGIN")   # snapshot เดียว: watermark กับ seed ตรงกัน
+        for _, name in self._recent_parts(now_ms):
+            mark = self.cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {name}").fetchone()[0]
+            self.marks[name] = mark
+            for did, ts, t, lvl, cyc in self.cur.execute(
+                f"SELECT device_id, ts_ms, temp, level, cycles FROM {name} WHERE ts_ms >= ? AND id <= ?",
+                (open_min, mark),
+            ):
+                self.acc.setdefault((did, floor_to_minute_utc(ts)), []).append((ts, t, lvl, cyc))
+        self.cur.execute("COMMIT")
+
+    def feed(self, did: str, ts: int, t, lvl, cyc) -> bool:
+        """หนึ่งแถว -> สะสมใน RAM; False = แถวช้า (นาทีนั้น emit ไปแล้ว จะสรุปใหม่จาก DB)"""
+        m = floor_to_minute_utc(ts)
+        if m < self.emitted_until.get(did, 0):
+            self.late.add((did, m))
+            return False
+        self.acc.setdefault((did, m), []).append((ts, t, lvl, cyc))
+        return True
+
+    def spill(self, did: str, ts: int):
+        """แถวที่ไม่ได้ส่งผ่าน RAM (คิวเต็ม) -> นาทีนั้นตอนปิดให้สรุปจาก DB แทน"""
+        self.spilled.add((did, floor_to_minute_utc(ts)))
+
+    def poll(self, now_ms: int) -> int:
+        """ดึงแถวใหม่ + emit นาทีที่ปิดแล้ว คืนจำนวนนาทีที่เขียน"""
+        for _, name in self._recent_parts(now_ms):
+            mark = self.marks.get(name, 0)
+            rows = self.cur.execute(
+                f"SELECT id, device_id, ts_ms, temp, level, cycles FROM {name} WHERE id > ? ORDER BY id",
+                (mark,),
+            ).fetchall()
+            if rows:
+                self.marks[name] = rows[-1][0]
+            for _, did, ts, t, lvl, cyc in rows:
+                self.feed(did, ts, t, lvl, cyc)
+            self.stats["rows"] += len(rows)
+        # ลืม partition ที่หลุดช่วงไปแล้ว
+        live = {n for _, n in self._recent_parts(now_ms)}
+        self.marks = {n: v for n, v in self.marks.items() if n in live}
+        return self.emit(now_ms)
+
+    def emit(self, now_ms: int) -> int:
+        """สรุป + upsert นาทีที่ปิดแล้ว (+ rollups, เข้า outbox) ใน transaction เดียว คืนจำนวนนาที"""
+        closed = lambda k: k[1] + 60000 + self.grace_ms <= now_ms
+        emitted = 0
+        devices = set()
+        for key in sorted(k for k in self.acc if closed(k) and k not in self.spilled):
+            did, m = key
+            rows = sorted(self.acc.pop(key))
+            # reupload: นาทีนี้อาจถูกเขียนไปแล้ว (recovery / รอบก่อน) ด้วยแถวไม่ครบ
+            upsert_minute(self.cur, did, m, minute_stats(rows), reupload=True)
+            self.emitted_until[did] = max(self.emitted_until.get(did, 0), m + 60000)
+            self.stats["lag_ms_max"] = max(self.stats["lag_ms_max"], now_ms - (m + 60000))
+            devices.add(did)
+            emitted += 1
+        for key in sorted(k for k in self.spilled if closed(k)):
+            did, m = key
+            self.spilled.discard(key)
+            self.acc.pop(key, None)
+            compute_and_upsert_one_minute(self.cur, m, did, reupload=True)
+            self.emitted_until[did] = max(self.emitted_until.get(did, 0), m + 60000)
+            self.stats["spilled"] += 1
+            devices.add(did)
+            emitted += 1
+        late, self.late = self.late, set()
+        for did, m in sorted(late):
+            # emit ไปแล้ว (อาจ upload แล้ว) -> ค่าใหม่ต้องเข้า outbox อีกรอบ
+            compute_and_upsert_one_minute(self.cur, m, did, reupload=True)
+            self.stats["late"] += 1
+            devices.add(did)
+        for did in devices:
+            rollups.update_device(self.cur, did)
+        if devices:
+            queue_pending_minutes(self.cur)   # เข้า outbox ใน transaction เดียวกัน
+        self.cur.connection.commit()
+        self.stats["minutes"] += emitted
+        return emitted
+
+def run_daemon(con: sqlite3.Connection):
+    cur = con.cursor()
     now_ms = int(time.time() * 1000)
+    target_minute_ms = floor_to_minute_utc(now_ms) - 60000
+
+    # recovery: นาทีที่ขาดระหว่างเครื่องดับ (set-based ครั้งเดียวต่อเครื่อง)
+    t0 = time.perf_counter()
+    known = {r[0] for r in cur.execute("SELECT DISTINCT device_id FROM minutes")}
+    recovered = 0
+    for did in sorted(set(device_ids()) | known):
+        recovered += backfill_device(cur, did, target_minute_ms)
+        rollups.update_device(cur, did)
+    queue_pending_minutes(cur)
+    con.commit()
+    print(f"[minute_aggregator] recovery minutes={recovered} "
+          f"in {(time.perf_counter() - t0) * 1000:.0f}ms", flush=True)
+
+    tailer = MinuteTailer(cur)
+    tailer.start(now_ms)
+    # นาทีก่อนหน้านี้ recovery ทำไปแล้ว
+    for did in sorted(set(device_ids()) | known):
+        tailer.emitted_until[did] = target_minute_ms + 60000
+
+    def tail(tick_ts):
+        tailer.poll(int(time.time() * 1000))
+
+    def report(tick_ts):
+        print(f"[minute_aggregator] {tailer.stats} open={len(tailer.acc)}", flush=True)
+        tailer.stats["lag_ms_max"] = 0.0
+
+    sched = DeadlineScheduler("minute_aggregator")
+    sched.every("tail", AGG_POLL_SEC, tail)
+    sched.every("report", 300, report)
+    sched.run()
+
+
+def run_once(con: sqlite3.Connection, now_ms: Optional[int] = None) -> int:
+    """สรุปนาทีที่เพิ่งปิด + rollups + เข้า outbox หนึ่งรอบ (cron หรือ worker) คืนจำนวนเครื่อง"""
+    cur = con.cursor()
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
     this_minute_ms = floor_to_minute_utc(now_ms)
 
     # เราสรุป “นาทีที่ปิดแล้ว” = นาทีล่าสุด - 1
     target_minute_ms = this_minute_ms - 60000
 
-    if not RUN_BACKFILL:
-        ok = compute_and_upsert_one_minute(cur, target_minute_ms)
-        con.commit()
-        con.close()
-        return
-
-    # backfill: ไล่เติมตั้งแต่ minute ล่าสุดที่มีใน minutes +1 ไปจนถึง target
-    last = cur.execute("SELECT MAX(ts_minute) FROM minutes").fetchone()
-    last_ts = int(last[0]) if last and last[0] is not None else None
+    # ทุกเครื่องใน gateway (ไม่ตั้ง GATEWAY_CONFIG = DEVICE_ID เดียว)
+    devices = device_ids()
+    for did in devices:
+        if not RUN_BACKFILL:
+            # นาทีก่อนหน้าด้วย: แถวที่ commit หลังรอบที่แล้วจะได้ไม่ค้างเป็นค่าไม่ครบบน Firestore
+            compute_and_upsert_one_minute(cur, target_minute_ms - 60000, did, reupload=True)
+            compute_and_upsert_one_minute(cur, target_minute_ms, did, reupload=True)
+        else:
+            backfill_device(cur, did, target_minute_ms)
+        # hours / days ที่เพิ่งปิด
+        rollups.update_device(cur, did)
+
+    # นาทีใหม่เข้า outbox (minute_uploader เป็นคนส่ง)
+    queue_pending_minutes(cur)
+    con.commit()
+    return len(devices)
 
-    if last_ts is None:
-        start = target_minute_ms  # ถ้ายังไม่มี minutes เลย ทำแค่นาทีล่าสุดพอ
-    else:
-        start = last_ts + 60000
+def main():
+    con = sqlite3.connect(DB_PATH)
+    cur = con.cursor()
 
-    # จำกัดความเสี่ยง: backfill ทีละไม่เกิน 24 ชม.
-    max_steps = 24 * 60
-    steps = 0
+    # WAL ช่วยให้ collector เขียนพร้อมกันได้ลื่นขึ้น
+    cur.execute("PRAGMA journal_mode=WAL;")
+    ensure_readings_table(cur)
+    ensure_minutes_table(cur)
+    con.commit()
 
-    t = start
-    while t <= target_minute_ms and steps < max_steps:
-        compute_and_upsert_one_minute(cur, t)
-        t += 60000
-        steps += 1
+    if AGG_DAEMON:
+        try:
+            run_daemon(con)
+        finally:
+            con.close()
+        return
 
-    con.commit()
-    con.close()
+    try:
+        run_once(con)
+    finally:
+        con.close()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,44 @@
 # sensor/minute_uploader.py
+"""
+minutes -> outbox -> Firestore devices/{device_id}/minutes/{minute_id}
+
+MINUTES_LAYOUT=hourly packs an hour into one doc instead,
+devices/{device_id}/minutes_h/{YYYYMMDDHH}:
+
+  m.MM     [temp_avg, temp_min, temp_max, temp_last,
+            level_avg, level_min, level_max, level_last, cycles_delta, n_samples]
+  summary  hour stats (sensor/rollups.py)
+
+Every minute is a merge into m.MM, and the outbox coalesces several
+minutes of the same hour into one write. (MINUTES_LAYOUT=both writes both.)
+
+minutes.uploaded = 0 means "not handed to the outbox yet". The aggregator
+queues new minutes itself (queue_pending_minutes, same transaction); this
+script queues anything still pending (e.g. rows from an older DB), then
+drains the outbox in seq order and compacts what has been sent. A backlog
+deeper than RESYNC_DEPTH (e.g. after an outage) goes through
+sensor/resync.py instead, with several batches in flight.
+"""
 import os
 import sqlite3
 from datetime import datetime, timezone
+from typing import Optional, Tuple
 
-from sensor.firebase_admin_init import get_fs
+from sensor.local_db import ensure_minutes_table
+from sensor import outbox, rollups
 
 DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
 DEVICE_ID = os.getenv("DEVICE_ID", "pi5-001")
-BATCH = int(os.getenv("MINUTE_UPLOAD_BATCH", "300"))  # ส่งครั้งละกี่นาที
+BATCH = int(os.getenv("MINUTE_UPLOAD_BATCH", "300"))  # ส่งครั้งละกี่ doc (ต่อ Firestore batch)
+MINUTES_LAYOUT = os.getenv("MINUTES_LAYOUT", "minute").lower()  # minute | hourly | both
+RESYNC_DEPTH = int(os.getenv("RESYNC_DEPTH", "5000"))  # ค้างเกินนี้ -> ส่งแบบขนาน (resync)
+
+# ลำดับค่าใน array m.MM ของ doc รายชั่วโมง
+HOURLY_FIELDS = (
+    "temp_avg", "temp_min", "temp_max", "temp_last",
+    "level_avg", "level_min", "level_max", "level_last",
+    "cycles_delta", "n_samples",
+)
 
 
 def minute_id_to_iso(minute_id: str) -> str:
@@ -31,123 +62,231 @@ def pick(row, key: str):
         return None
 
 
-def main():
-    fs = get_fs()
-    if fs is None:
-        raise RuntimeError(
-            "Firestore client not ready. "
-            "Check FB_PRIMARY_CRED / FB_SECONDARY_CRED env in your systemd service."
-        )
+def minute_payload(r) -> dict:
+    """แปลงแถว minutes (dict / sqlite3.Row) เป็น doc ของ Firestore"""
+    minute_id = pick(r, "minute_id")
+    device_id = pick(r, "device_id") or DEVICE_ID
+
+    # ---- values (may be None depending on schema) ----
+    temp_avg  = pick(r, "temp_avg")
+    temp_min  = pick(r, "temp_min")
+    temp_max  = pick(r, "temp_max")
+    temp_last = pick(r, "temp_last")
+
+    level_avg  = pick(r, "level_avg")
+    level_min  = pick(r, "level_min")
+    level_max  = pick(r, "level_max")
+    level_last = pick(r, "level_last")
+
+    cycles_delta = pick(r, "cycles_delta")
+
+    # ---- fallbacks ----
+    if temp_last is None:
+        temp_last = temp_avg
+    if temp_min is None:
+        temp_min = temp_avg
+    if temp_max is None:
+        temp_max = temp_avg
+
+    if level_last is None:
+        level_last = level_avg
+    if level_min is None:
+        level_min = level_avg
+    if level_max is None:
+        level_max = level_avg
+
+    return {
+        "device_id": device_id,
+        "minute_id": minute_id,
+        "ts_minute": minute_id_to_iso(minute_id),
+
+        "temp": {
+            "avg": temp_avg,
+            "min": temp_min,
+            "max": temp_max,
+            "last": temp_last,
+            "unit": "°C",
+        },
+
+        "level": {
+            "avg": level_avg,
+            "min": level_min,
+            "max": level_max,
+            "last": level_last,
+            "unit": "cm",
+        },
+
+        # cycles_delta = จำนวน cycle ที่เพิ่มขึ้นใน 1 นาที (ถ้า schema มี)
+        "cycles": {
+            "last": cycles_delta,
+            "unit": "count/min",
+        },
+
+        "uploaded_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def minute_doc_path(device_id: str, minute_id: str) -> str:
+    return f"devices/{device_id}/minutes/{minute_id}"
+
+
+def hour_doc_path(device_id: str, hour_id: str) -> str:
+    return f"devices/{device_id}/minutes_h/{hour_id}"
+
+
+def hour_summary(cur, device_id: str, hour_start_ms: int) -> dict:
+    """สรุปทั้งชั่วโมงจาก rollups (ชั่วโมงที่ยังไม่ปิดคิดสดจาก minutes)"""
+    _, rows = rollups.series(cur, device_id, hour_start_ms, hour_start_ms + 3_600_000, "hours")
+    if not rows:
+        return {}
+    r = rows[0]
+    return {
+        "temp":  {k: r.get(f"temp_{k}") for k in ("avg", "min", "max", "last")},
+        "level": {k: r.get(f"level_{k}") for k in ("avg", "min", "max", "last")},
+        "cycles": {"sum": r.get("cycles_delta")},
+        "n_minutes": r.get("n_minutes"),
+        "n_samples": r.get("n_samples"),
+    }
+
+
+def hourly_items(cur, keys: list) -> list:
+    """minutes หลายแถว -> item ของ outbox หนึ่งอันต่อ (device, ชั่วโมง)"""
+    by_hour = {}
+    for k in keys:
+        device_id = k.get("device_id") or DEVICE_ID
+        hour_id = k["minute_id"][:10]   # YYYYMMDDHH
+        by_hour.setdefault((device_id, hour_id), []).append(k)
+
+    items = []
+    for (device_id, hour_id), ks in by_hour.items():
+        hs = datetime.strptime(hour_id, "%Y%m%d%H").replace(tzinfo=timezone.utc)
+        payload = {
+            "device_id": device_id,
+            "hour_id": hour_id,
+            "ts_hour": hs.isoformat(),
+            "m": {k["minute_id"][10:]: [k.get(f) for f in HOURLY_FIELDS] for k in ks},
+            "summary": hour_summary(cur, device_id, int(hs.timestamp() * 1000)),
+            "uploaded_at": datetime.now(timezone.utc).isoformat(),
+        }
+        items.append(("minutes_h", hour_doc_path(device_id, hour_id), payload))
+    return items
 
-    con = sqlite3.connect(DB)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
 
-    cols = get_cols(cur)
+def hour_doc_minutes(hour_id: str, doc: dict) -> list:
+    """decode doc รายชั่วโมง -> [{"t_ms", "temp_avg", ...}, ...] เรียงตามนาที"""
+    hs = datetime.strptime(hour_id, "%Y%m%d%H").replace(tzinfo=timezone.utc)
+    base = int(hs.timestamp() * 1000)
+    out = []
+    for mm, arr in sorted((doc.get("m") or {}).items()):
+        row = {"t_ms": base + int(mm) * 60000}
+        row.update(zip(HOURLY_FIELDS, arr or []))
+        out.append(row)
+    return out
+
+
+def hour_docs_page(docs: list, start_ms: int, end_ms: int, limit: int,
+                   doc_limit: Optional[int] = None) -> Tuple[list, Optional[int]]:
+    """
+    แบ่งหน้านาทีจาก doc รายชั่วโมง [(hour_id, dict), ...] (เรียงตามชั่วโมง)
+    -> (นาทีใน [start_ms, end_ms) ไม่เกิน limit แถว, ts_ms ของ cursor หน้าถัดไป หรือ None)
 
-    # --- build SELECT only existing columns ---
-    base_fields = ["minute_id", "ts_minute", "uploaded"]
+    ชั่วโมงที่ไม่มีข้อมูลไม่มี doc -> นับนาทีอย่างเดียวไม่พอ: อ่านได้ครบ doc_limit doc
+    แปลว่าอาจมี doc ถัดไป ให้หน้าถัดไปเริ่มหลังชั่วโมงสุดท้ายที่อ่าน
+    """
+    out = []
+    for hour_id, doc in docs:
+        out.extend(m for m in hour_doc_minutes(hour_id, doc) if start_ms <= m["t_ms"] < end_ms)
+    if len(out) > limit:
+        return out[:limit], out[limit - 1]["t_ms"]
+    if doc_limit is not None and docs and len(docs) >= doc_limit:
+        hs = datetime.strptime(docs[-1][0], "%Y%m%d%H").replace(tzinfo=timezone.utc)
+        last_min = int(hs.timestamp() * 1000) + 59 * 60000   # นาทีสุดท้ายของชั่วโมงนั้น
+        if last_min + 60000 < end_ms:
+            return out, last_min
+    return out, None
+
+
+def queue_pending_minutes(cur, limit: int = 5000) -> int:
+    """
+    ย้าย minutes ที่ uploaded=0 เข้า outbox แล้ว mark 1 (ใน transaction ของผู้เรียก)
+    ใช้ partial index idx_minutes_pending -> ไม่สแกนทั้งตาราง
+    """
+    outbox.ensure_outbox_tables(cur)
+    cols = get_cols(cur)
+    base_fields = ["device_id", "minute_id", "ts_minute"]
     want_fields = [
         "temp_avg", "temp_min", "temp_max", "temp_last",
         "level_avg", "level_min", "level_max", "level_last",
-        "cycles_delta",
+        "cycles_delta", "n_samples",
     ]
     select_fields = base_fields + [f for f in want_fields if f in cols]
 
-    sql = f"""
-      SELECT {",".join(select_fields)}
-      FROM minutes
-      WHERE uploaded = 0
-      ORDER BY ts_minute ASC
-      LIMIT ?
-    """
-
-    rows = cur.execute(sql, (BATCH,)).fetchall()
-    if not rows:
-        con.close()
-        return
-
-    batch = fs.batch()
-    base = fs.collection("devices").document(DEVICE_ID).collection("minutes")
-    uploaded_ids = []
-
-    for r in rows:
-        minute_id = pick(r, "minute_id")
-        if not minute_id:
-            continue
-
-        # ---- values (may be None depending on schema) ----
-        temp_avg  = pick(r, "temp_avg")
-        temp_min  = pick(r, "temp_min")
-        temp_max  = pick(r, "temp_max")
-        temp_last = pick(r, "temp_last")
-
-        level_avg  = pick(r, "level_avg")
-        level_min  = pick(r, "level_min")
-        level_max  = pick(r, "level_max")
-        level_last = pick(r, "level_last")
-
-        cycles_delta = pick(r, "cycles_delta")
-
-        # ---- fallbacks ----
-        if temp_last is None:
-            temp_last = temp_avg
-        if temp_min is None:
-            temp_min = temp_avg
-        if temp_max is None:
-            temp_max = temp_avg
-
-        if level_last is None:
-            level_last = level_avg
-        if level_min is None:
-            level_min = level_avg
-        if level_max is None:
-            level_max = level_avg
+    total = 0
+    while True:
+        rows = cur.execute(f"""
+          SELECT {",".join(select_fields)}
+          FROM minutes
+          WHERE uploaded = 0
+          ORDER BY ts_minute ASC
+          LIMIT ?
+        """, (limit,)).fetchall()
+        if not rows:
+            return total
+        keys = [dict(zip(select_fields, r)) for r in rows]
+        if MINUTES_LAYOUT in ("minute", "both"):
+            outbox.enqueue_many(cur, [
+                ("minutes", minute_doc_path(k["device_id"] or DEVICE_ID, k["minute_id"]), minute_payload(k))
+                for k in keys
+            ])
+        if MINUTES_LAYOUT in ("hourly", "both"):
+            outbox.enqueue_many(cur, hourly_items(cur, keys))
+        cur.executemany(
+            "UPDATE minutes SET uploaded = 1 WHERE device_id = ? AND minute_id = ?",
+            [(k["device_id"], k["minute_id"]) for k in keys],
+        )
+        total += len(rows)
 
-        payload = {
-            "device_id": DEVICE_ID,
-            "minute_id": minute_id,
-            "ts_minute": minute_id_to_iso(minute_id),
-
-            "temp": {
-                "avg": temp_avg,
-                "min": temp_min,
-                "max": temp_max,
-                "last": temp_last,
-                "unit": "°C",
-            },
-
-            "level": {
-                "avg": level_avg,
-                "min": level_min,
-                "max": level_max,
-                "last": level_last,
-                "unit": "cm",
-            },
-
-            # cycles_delta = จำนวน cycle ที่เพิ่มขึ้นใน 1 นาที (ถ้า schema มี)
-            "cycles": {
-                "last": cycles_delta,
-                "unit": "count/min",
-            },
 
-            "uploaded_at": datetime.now(timezone.utc).isoformat(),
-        }
+def run_once(con: sqlite3.Connection) -> dict:
+    """queue ที่ค้าง + drain outbox + compact หนึ่งรอบ (cron หรือ worker ที่ถือ client อุ่นไว้)"""
+    from sensor.firebase_admin_init import get_fs, get_active
 
-        doc = base.document(minute_id)
-        batch.set(doc, payload, merge=True)
-        uploaded_ids.append(minute_id)
+    if get_fs() is None:
+        raise RuntimeError(
+            "Firestore client not ready. "
+            "Check FB_PRIMARY_CRED / FB_SECONDARY_CRED env in your systemd service."
+        )
 
-    batch.commit()
+    cur = con.cursor()
+    ensure_minutes_table(cur)
+    outbox.ensure_outbox_tables(cur)
+    queued = queue_pending_minutes(cur)
+    con.commit()
 
-    # mark uploaded
-    cur.executemany(
-        "UPDATE minutes SET uploaded = 1 WHERE minute_id = ?",
-        [(mid,) for mid in uploaded_ids],
-    )
+    # project ที่ใช้ได้ตอนนี้ (failover อัตโนมัติ) — cursor แยกต่อ project
+    home_consumer = outbox.project_consumer(get_active())
+    if outbox.metrics(cur, home_consumer)["depth"] > RESYNC_DEPTH:
+        from sensor.resync import resync
+        stats = outbox.drain_active(con, batch_size=BATCH, cls="backfill", drain_fn=resync)
+        print(f"[minute_uploader] resync project={stats['project']}", flush=True)
+    else:
+        stats = outbox.drain_active(con, batch_size=BATCH)
+    outbox.compact(cur)
     con.commit()
-    con.close()
 
+    m = outbox.metrics(cur, home_consumer)
+    print(f"[minute_uploader] queued={queued} project={stats['project']} sent={stats['sent']} dead={stats['dead']} "
+          f"retries={stats['retries']} depth={m['depth']} oldest={m['oldest_age_s']}s"
+          + (f" stopped={stats['stopped']}" if stats["stopped"] else ""), flush=True)
+    return dict(stats, queued=queued, depth=m["depth"])
+
+
+def main():
+    con = sqlite3.connect(DB, check_same_thread=False)
+    try:
+        run_once(con)
+    finally:
+        con.close()
 
 if __name__ == "__main__":
     main()
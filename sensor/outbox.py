@@ -0,0 +1,394 @@
+# sensor/outbox.py
+"""
+Local outbox for everything that goes to Firestore.
+
+Producers append documents to `outbox` (append-only, seq = INTEGER PRIMARY
+KEY) in the same SQLite transaction as the data they describe. A consumer
+keeps its position in `outbox_cursor`; draining is a sequential scan of
+seq > cursor, so resync after a multi-day outage never touches per-row
+flags.
+
+  outbox         seq, topic, doc_path, payload (JSON), created_ms
+  outbox_cursor  consumer -> last_seq
+  outbox_dead    documents Firestore rejected (poison docs), with the error
+  outbox_marks   producer watermarks (e.g. last ts_ms uploader_30m queued)
+
+Document paths are deterministic (e.g. devices/{id}/minutes/{minute_id})
+and written with set(merge=True), so replaying a batch is harmless.
+
+drain() commits up to 500 writes per Firestore batch; rows for the same
+document inside a batch are merged into one write (coalesce()). ResourceExhausted
+backs off exponentially and retries the same batch. Errors that belong
+to one document (InvalidArgument — including payload too large —,
+FailedPrecondition, a payload the client cannot encode) bisect the batch
+until the failing document is isolated and moved to the dead-letter
+table, and the cursor moves on. Anything else (PermissionDenied,
+Unauthenticated, NotFound database, credential refresh, RetryError, ...)
+is about the connection, not the data: drain() stops with the cursor
+where it was and returns the error for the failover breaker. compact() deletes rows every
+consumer has passed. Each batch is charged to the shared daily budget
+(sensor/budget.py) first; when the class is out of budget drain() stops
+and the rest waits in the outbox for the next run.
+"""
+import os
+import json
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sensor import budget
+
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "400"))            # Firestore batch สูงสุด 500
+OUTBOX_BACKOFF_MAX_SEC = float(os.getenv("OUTBOX_BACKOFF_MAX_SEC", "60"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "8"))   # ต่อ batch ก่อนยอมแพ้รอบนี้
+
+DEFAULT_CONSUMER = "firestore"
+
+# exception ของ google.api_core โหลดตอนใช้ครั้งแรก (import ลาก grpc มาด้วย ช้าบน Pi)
+# งานที่แค่ enqueue (เช่น minute_aggregator) จึงไม่ต้องจ่ายค่า import นี้
+_errors: Dict[str, tuple] = {}
+
+
+def _load_errors() -> Dict[str, tuple]:
+    if _errors:
+        return _errors
+    try:
+        from google.api_core.exceptions import ResourceExhausted
+    except Exception:
+        class ResourceExhausted(Exception):  # type: ignore
+            pass
+    # error ชั่วคราว (เน็ต/เซิร์ฟเวอร์): ลองใหม่เหมือนโควต้า ไม่ผ่าครึ่งส่งเข้า dead-letter
+    try:
+        from google.api_core.exceptions import DeadlineExceeded, InternalServerError, ServiceUnavailable
+        transient: tuple = (ServiceUnavailable, DeadlineExceeded, InternalServerError, ConnectionError, TimeoutError)
+    except Exception:
+        transient = (ConnectionError, TimeoutError)
+    # error ที่เป็นของ doc เดียว (ข้อมูลเสีย / ใหญ่เกิน): ผ่าครึ่งหา doc แล้วส่งเข้า dead-letter
+    # นอกนั้น (สิทธิ์ / credential / database ผิด) ห้ามแตะ dead-letter — ทั้ง backlog จะหายเข้าไปหมด
+    try:
+        from google.api_core.exceptions import FailedPrecondition, InvalidArgument
+        poison: tuple = (InvalidArgument, FailedPrecondition, TypeError, ValueError)
+    except Exception:
+        poison = (TypeError, ValueError)
+    _errors.update(ResourceExhausted=ResourceExhausted, TRANSIENT=transient,
+                   RETRYABLE=(ResourceExhausted,) + transient, POISON=poison)
+    return _errors
+
+
+def retryable() -> tuple:
+    """(ResourceExhausted,) + TRANSIENT — ใช้ใน except ได้ตรง ๆ: `except outbox.retryable():`"""
+    return _load_errors()["RETRYABLE"]
+
+
+def poison() -> tuple:
+    """error ที่ผูกกับ doc เดียว -> dead-letter ได้ (InvalidArgument, FailedPrecondition, ...)"""
+    return _load_errors()["POISON"]
+
+
+def __getattr__(name: str):
+    # outbox.ResourceExhausted / TRANSIENT / RETRYABLE ยังใช้ได้เหมือนเดิม (PEP 562)
+    if name in ("ResourceExhausted", "TRANSIENT", "RETRYABLE", "POISON"):
+        return _load_errors()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def project_consumer(project: str) -> str:
+    """cursor ต่อ Firestore project (primary ใช้ชื่อเดิม DEFAULT_CONSUMER)"""
+    return DEFAULT_CONSUMER if project == "primary" else f"{DEFAULT_CONSUMER}:{project}"
+
+
+def ensure_outbox_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS outbox(
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      topic TEXT NOT NULL,
+      doc_path TEXT NOT NULL,
+      payload TEXT NOT NULL,
+      created_ms INTEGER NOT NULL
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS outbox_cursor(
+      consumer TEXT PRIMARY KEY,
+      last_seq INTEGER NOT NULL DEFAULT 0,
+      updated_ms INTEGER
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS outbox_marks(
+      name TEXT PRIMARY KEY,
+      value INTEGER NOT NULL
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS outbox_dead(
+      seq INTEGER PRIMARY KEY,
+      consumer TEXT NOT NULL,
+      topic TEXT NOT NULL,
+      doc_path TEXT NOT NULL,
+      payload TEXT NOT NULL,
+      created_ms INTEGER NOT NULL,
+      failed_ms INTEGER NOT NULL,
+      error TEXT
+    )""")
+
+
+# ---------- payload JSON (datetime -> Firestore timestamp) ----------
+def _default(o):
+    if isinstance(o, datetime):
+        return {"$ts": o.isoformat()}
+    raise TypeError(f"not JSON serializable: {type(o).__name__}")
+
+
+def _hook(d):
+    if len(d) == 1 and "$ts" in d:
+        return datetime.fromisoformat(d["$ts"])
+    return d
+
+
+def dumps(payload: Dict) -> str:
+    return json.dumps(payload, default=_default, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(s: str) -> Dict:
+    return json.loads(s, object_hook=_hook)
+
+
+# ---------- producer ----------
+def enqueue(cur, topic: str, doc_path: str, payload: Dict, created_ms: Optional[int] = None):
+    enqueue_many(cur, [(topic, doc_path, payload)], created_ms)
+
+
+def enqueue_many(cur, items: Iterable[Tuple[str, str, Dict]], created_ms: Optional[int] = None) -> int:
+    now = int(time.time() * 1000) if created_ms is None else created_ms
+    rows = [(topic, path, dumps(p), now) for topic, path, p in items]
+    cur.executemany(
+        "INSERT INTO outbox(topic, doc_path, payload, created_ms) VALUES(?,?,?,?)", rows)
+    return len(rows)
+
+
+# ---------- cursor ----------
+def get_cursor(cur, consumer: str = DEFAULT_CONSUMER) -> int:
+    row = cur.execute("SELECT last_seq FROM outbox_cursor WHERE consumer=?", (consumer,)).fetchone()
+    return int(row[0]) if row else 0
+
+
+def set_cursor(cur, consumer: str, seq: int):
+    cur.execute(
+        """
+        INSERT INTO outbox_cursor(consumer, last_seq, updated_ms) VALUES(?,?,?)
+        ON CONFLICT(consumer) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq),
+                                            updated_ms = excluded.updated_ms
+        """,
+        (consumer, int(seq), int(time.time() * 1000)),
+    )
+
+
+def get_mark(cur, name: str, default: Optional[int] = None) -> Optional[int]:
+    row = cur.execute("SELECT value FROM outbox_marks WHERE name=?", (name,)).fetchone()
+    return int(row[0]) if row else default
+
+
+def set_mark(cur, name: str, value: int):
+    cur.execute(
+        "INSERT INTO outbox_marks(name, value) VALUES(?,?) "
+        "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+        (name, int(value)),
+    )
+
+
+def read_batch(cur, after_seq: int, limit: int) -> List[tuple]:
+    """[(seq, topic, doc_path, payload_json, created_ms), ...]"""
+    return cur.execute(
+        "SELECT seq, topic, doc_path, payload, created_ms FROM outbox WHERE seq > ? ORDER BY seq LIMIT ?",
+        (after_seq, limit),
+    ).fetchall()
+
+
+def dead_letter(cur, consumer: str, row: Sequence, error: str):
+    seq, topic, path, payload, created_ms = row
+    cur.execute(
+        """
+        INSERT OR REPLACE INTO outbox_dead(seq, consumer, topic, doc_path, payload, created_ms, failed_ms, error)
+        VALUES(?,?,?,?,?,?,?,?)
+        """,
+        (seq, consumer, topic, path, payload, created_ms, int(time.time() * 1000), error[:500]),
+    )
+
+
+# ---------- metrics / compaction ----------
+def metrics(cur, consumer: str = DEFAULT_CONSUMER) -> Dict:
+    last = get_cursor(cur, consumer)
+    depth, oldest, head = cur.execute(
+        "SELECT COUNT(*), MIN(created_ms), (SELECT MAX(seq) FROM outbox) FROM outbox WHERE seq > ?",
+        (last,),
+    ).fetchone()
+    dead = cur.execute("SELECT COUNT(*) FROM outbox_dead WHERE consumer=?", (consumer,)).fetchone()[0]
+    now = int(time.time() * 1000)
+    return {
+        "consumer": consumer,
+        "cursor": last,
+        "head": head or last,
+        "depth": depth,
+        "oldest_age_s": round((now - oldest) / 1000.0, 1) if oldest else None,
+        "dead": dead,
+    }
+
+
+def compact(cur, consumers: Optional[List[str]] = None) -> int:
+    """ลบแถวที่ทุก consumer ผ่านไปแล้ว"""
+    if consumers:
+        qs = ",".join("?" * len(consumers))
+        row = cur.execute(
+            f"SELECT MIN(last_seq), COUNT(*) FROM outbox_cursor WHERE consumer IN ({qs})", consumers
+        ).fetchone()
+        if row[1] < len(consumers):
+            return 0   # มี consumer ที่ยังไม่เคยอ่านเลย
+    else:
+        row = cur.execute("SELECT MIN(last_seq), COUNT(*) FROM outbox_cursor").fetchone()
+    if not row or row[0] is None:
+        return 0
+    cur.execute("DELETE FROM outbox WHERE seq <= ?", (row[0],))
+    return cur.rowcount
+
+
+# ---------- consumer ----------
+def _deep_merge(dst: Dict, src: Dict) -> Dict:
+    # เหมือน set(merge=True): map ซ้อนกันรวมกัน ค่าอื่น (รวม array) ทับของเดิม
+    for k, v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict):
+            _deep_merge(dst[k], v)
+        else:
+            dst[k] = v
+    return dst
+
+
+def coalesce(rows: List[tuple]) -> List[Tuple[str, Dict]]:
+    """หลายแถวที่ชี้ doc เดียวกัน (เช่น นาทีในชั่วโมงเดียวกัน) -> write เดียว ตามลำดับ seq"""
+    docs: Dict[str, Dict] = {}
+    for _, _, path, payload, _ in rows:
+        if path in docs:
+            _deep_merge(docs[path], loads(payload))
+        else:
+            docs[path] = loads(payload)
+    return list(docs.items())
+
+
+def _commit_docs(fs, rows: List[tuple]):
+    batch = fs.batch()
+    for path, payload in coalesce(rows):
+        batch.set(fs.document(path), payload, merge=True)
+    batch.commit()
+
+
+def _send(fs, cur, consumer: str, rows: List[tuple], commit: Callable, stats: Dict):
+    """
+    ส่ง rows; error ของ doc (poison()) -> ผ่าครึ่งจนเจอ doc ที่เสีย แล้วส่งเข้า dead-letter
+    error อื่น (quota / เน็ต / สิทธิ์ / credential) -> โยนต่อให้ drain() หยุด
+    """
+    try:
+        commit(fs, rows)
+        stats["sent"] += len(rows)
+    except retryable():
+        raise
+    except poison() as e:
+        if len(rows) == 1:
+            dead_letter(cur, consumer, rows[0], f"{type(e).__name__}: {e}")
+            stats["dead"] += 1
+            print(f"[outbox][dead] seq={rows[0][0]} {rows[0][2]}: {e}", flush=True)
+            return
+        mid = len(rows) // 2
+        _send(fs, cur, consumer, rows[:mid], commit, stats)
+        _send(fs, cur, consumer, rows[mid:], commit, stats)
+
+
+def drain(fs, conn, consumer: str = DEFAULT_CONSUMER, batch_size: int = OUTBOX_BATCH,
+          max_batches: Optional[int] = None, commit: Callable = _commit_docs,
+          cls: str = "minutes", max_retries: int = OUTBOX_MAX_RETRIES) -> Dict:
+    """
+    ส่งทุกอย่างหลัง cursor ของ consumer ขึ้น Firestore ตามลำดับ seq
+    cls = คลาสของงบ (sensor/budget.py) ที่ใช้คิดค่า write
+    คืนสถิติ {"sent", "dead", "batches", "retries", "stopped"} (+ "error" = exception ที่ทำให้หยุด
+    ทั้งจาก retry หมด และจาก error ที่ไม่ใช่ของ doc — cursor ไม่ขยับทั้งสองกรณี)
+    """
+    cur = conn.cursor()
+    stats = {"sent": 0, "dead": 0, "batches": 0, "retries": 0, "stopped": None}
+    last = get_cursor(cur, consumer)
+    while max_batches is None or stats["batches"] < max_batches:
+        rows = read_batch(cur, last, batch_size)
+        if not rows:
+            break
+        n_docs = len({r[2] for r in rows})
+        if not budget.try_spend("write", cls, n_docs):
+            stats["stopped"] = f"budget: {cls} write budget exhausted"
+            break
+
+        backoff = 1.0
+        for attempt in range(max_retries + 1):
+            try:
+                _send(fs, cur, consumer, rows, commit, stats)
+                break
+            except retryable() as e:
+                if attempt == max_retries:
+                    stats["stopped"] = f"{type(e).__name__}: {e}"
+                    stats["error"] = e
+                    conn.commit()
+                    return stats
+                stats["retries"] += 1
+                print(f"[outbox] {type(e).__name__}, retry in {backoff:.0f}s", flush=True)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, OUTBOX_BACKOFF_MAX_SEC)
+            except Exception as e:
+                # สิทธิ์ / credential / database: ไม่ใช่ความผิดของ doc -> cursor อยู่ที่เดิม ให้ breaker ตัดสิน
+                print(f"[outbox] {type(e).__name__}: {e} — stop, cursor stays at {last}", flush=True)
+                stats["stopped"] = f"{type(e).__name__}: {e}"
+                stats["error"] = e
+                conn.commit()   # dead-letter ของ doc ที่แยกได้ก่อนหน้า (ไม่ขยับ cursor)
+                return stats
+
+        last = rows[-1][0]
+        set_cursor(cur, consumer, last)
+        conn.commit()
+        stats["batches"] += 1
+    return stats
+
+
+def drain_active(conn, batch_size: int = OUTBOX_BATCH, cls: str = "minutes",
+                 drain_fn: Optional[Callable] = None, max_retries: int = 2) -> Dict:
+    """
+    ส่งขึ้น project ที่ใช้ได้ตอนนี้ (sensor/firebase_admin_init.py) ด้วย cursor ของ project นั้น
+    - project สำรองเริ่มจาก cursor ของ home -> ได้เฉพาะของที่ home ยังไม่ได้
+    - home ตามหลังอยู่ = ของช่วง failover จะถูกส่งซ้ำให้ home เมื่อกลับมา
+    - home ส่งครบแล้ว -> ดัน cursor ของตัวสำรองตามมา (compact จะได้ไม่ติด)
+    ล้มกลางทางด้วย quota/เน็ต -> แจ้ง circuit breaker แล้วลองอีก project ในรอบเดียวกัน
+    """
+    from sensor import firebase_admin_init as fb
+
+    cur = conn.cursor()
+    home = fb.get_active()
+    home_consumer = project_consumer(home)
+    total = {"sent": 0, "dead": 0, "batches": 0, "retries": 0, "stopped": None, "project": None}
+    tried = set()
+    while True:
+        name, fs = fb.get_fs_named()
+        if fs is None or name in tried:
+            if fs is None:
+                total["stopped"] = total["stopped"] or "no Firestore client"
+            break
+        tried.add(name)
+        consumer = project_consumer(name)
+        if name != home:
+            set_cursor(cur, consumer, get_cursor(cur, home_consumer))
+            conn.commit()
+        stats = (drain_fn or drain)(fs, conn, consumer=consumer, batch_size=batch_size,
+                                    cls=cls, max_retries=max_retries)
+        err = stats.pop("error", None)
+        for k in ("sent", "dead", "batches", "retries"):
+            total[k] += stats.get(k, 0)
+        total["stopped"], total["project"] = stats.get("stopped"), name
+        if err is None:
+            if stats.get("batches") or not stats.get("stopped"):
+                fb.report(name)
+            if name == home and not stats.get("stopped"):
+                set_cursor(cur, project_consumer(fb.other_project(home)), get_cursor(cur, home_consumer))
+                conn.commit()
+            break
+        fb.report(name, err)
+    return total
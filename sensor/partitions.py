@@ -0,0 +1,223 @@
+# sensor/partitions.py
+"""
+Day-partitioned raw readings.
+
+Raw rows live in one table per UTC day (readings_pYYYYMMDD) inside the main
+DB. A `readings` view UNION ALLs every partition so ad-hoc SQL keeps
+working, but the hot paths (writer, aggregator, latest lookups) use the
+helpers below, which only touch the partitions that overlap the range.
+Retention is DROP TABLE of whole days — no row-by-row DELETE, and the
+freed pages are reused by the next partitions.
+
+`id` is only unique within one partition: every day table numbers its
+rows from 1, and migrate_legacy renumbers the old AUTOINCREMENT ids. The
+view adds a `part` column (the table name); anything that keys on a row
+must key on (part, id), as MinuteTailer's watermarks do.
+"""
+import re
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+DAY_MS = 86_400_000
+PREFIX = "readings_p"
+_NAME_RE = re.compile(r"^readings_p(\d{8})$")
+
+COLS = "id, device_id, ts_ms, temp, level, cycles, uploaded"
+
+
+def day_start(ts_ms: int) -> int:
+    return (int(ts_ms) // DAY_MS) * DAY_MS
+
+
+def part_name(ts_ms: int) -> str:
+    d = datetime.fromtimestamp(day_start(ts_ms) / 1000.0, tz=timezone.utc)
+    return PREFIX + d.strftime("%Y%m%d")
+
+
+def part_day(name: str) -> Optional[int]:
+    m = _NAME_RE.match(name)
+    if not m:
+        return None
+    d = datetime.strptime(m.group(1), "%Y%m%d").replace(tzinfo=timezone.utc)
+    return int(d.timestamp() * 1000)
+
+
+def list_partitions(cur) -> List[Tuple[int, str]]:
+    """[(day_start_ms, table_name), ...] เรียงจากเก่าไปใหม่"""
+    out = []
+    for (name,) in cur.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'readings\\_p%' ESCAPE '\\'"
+    ):
+        day = part_day(name)
+        if day is not None:
+            out.append((day, name))
+    out.sort()
+    return out
+
+
+def refresh_view(cur, parts: Optional[List[Tuple[int, str]]] = None):
+    parts = list_partitions(cur) if parts is None else parts
+    cur.execute("DROP VIEW IF EXISTS readings")
+    if not parts:
+        return
+    # id ซ้ำกันข้าม partition ได้ -> ใส่ชื่อตาราง (part) ให้ผู้ใช้ key ด้วย (part, id)
+    body = "\nUNION ALL\n".join(f"SELECT {COLS}, '{name}' AS part FROM {name}" for _, name in parts)
+    cur.execute(f"CREATE VIEW readings AS\n{body}")
+
+
+def view_parts(cur) -> Optional[List[str]]:
+    """partition ที่ view `readings` อ้างอยู่ตอนนี้ (None = ยังไม่มี view)"""
+    row = cur.execute("SELECT sql FROM sqlite_master WHERE type='view' AND name='readings'").fetchone()
+    if row is None:
+        return None
+    return re.findall(r"\bFROM\s+(readings_p\d{8})\b", row[0] or "")
+
+
+def sync_view(cur) -> bool:
+    """สร้าง view ใหม่ถ้าชุด partition ไม่ตรงกับที่ view อ้าง (เช่น ข้ามวันแล้วมีตารางใหม่) -> True ถ้าสร้างใหม่"""
+    parts = list_partitions(cur)
+    sql = (cur.execute("SELECT sql FROM sqlite_master WHERE type='view' AND name='readings'").fetchone()
+           or ("",))[0] or ""
+    # view รุ่นก่อนยังไม่มีคอลัมน์ part -> สร้างใหม่ด้วย
+    if parts and " AS part " in sql and view_parts(cur) == [name for _, name in parts]:
+        return False
+    refresh_view(cur, parts)
+    return True
+
+
+def ensure_partition(cur, ts_ms: int, refresh: bool = True) -> str:
+    name = part_name(ts_ms)
+    exists = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)
+    ).fetchone()
+    if exists:
+        if refresh and name not in (view_parts(cur) or []):
+            refresh_view(cur)   # ตารางถูกสร้างแบบ refresh=False ไว้ก่อน -> ให้ view เห็นด้วย
+        return name
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {name}(
+      id INTEGER PRIMARY KEY,   -- unique ภายในวันเดียว (ดู docstring)
+      device_id TEXT NOT NULL DEFAULT '',
+      ts_ms INTEGER NOT NULL,
+      temp REAL,
+      level REAL,
+      cycles INTEGER,
+      uploaded INTEGER NOT NULL DEFAULT 0
+    )""")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {name}_dev_ts ON {name}(device_id, ts_ms)")
+    if refresh:
+        refresh_view(cur)
+    return name
+
+
+def migrate_legacy(cur, default_device: str):
+    """
+    ย้ายตาราง readings แบบเดิม (ตารางเดียว) ไปเป็นรายวัน แล้วแทนด้วย view
+    id เดิม (AUTOINCREMENT) ไม่ถูกเก็บ — แต่ละ partition นับ id ใหม่ตาม ts_ms
+    """
+    row = cur.execute("SELECT type FROM sqlite_master WHERE name='readings'").fetchone()
+    if not row or row[0] != "table":
+        return
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(readings)")}
+    dev = "device_id" if "device_id" in cols else "?"
+    params = () if dev == "device_id" else (default_device,)
+
+    cur.execute("ALTER TABLE readings RENAME TO readings_legacy")
+    lo, hi = cur.execute("SELECT MIN(ts_ms), MAX(ts_ms) FROM readings_legacy").fetchone()
+    if lo is not None:
+        d = day_start(lo)
+        while d <= hi:
+            name = ensure_partition(cur, d, refresh=False)
+            cur.execute(f"""
+              INSERT INTO {name}(device_id, ts_ms, temp, level, cycles, uploaded)
+              SELECT {dev}, ts_ms, temp, level, cycles, uploaded
+              FROM readings_legacy WHERE ts_ms >= ? AND ts_ms < ?
+              ORDER BY ts_ms
+            """, params + (d, d + DAY_MS))
+            d += DAY_MS
+    cur.execute("DROP TABLE readings_legacy")
+    refresh_view(cur)
+
+
+# ---------- write ----------
+def insert_rows(cur, rows: Iterable[Sequence]):
+    """rows: (device_id, ts_ms, temp, level, cycles) — แยกลงตารางของแต่ละวัน"""
+    by_part: Dict[str, List[Sequence]] = {}
+    known = {name for _, name in list_partitions(cur)}
+    for r in rows:
+        name = part_name(r[1])
+        if name not in known:
+            ensure_partition(cur, r[1])
+            known.add(name)
+        by_part.setdefault(name, []).append(r)
+    for name, rs in by_part.items():
+        cur.executemany(
+            f"INSERT INTO {name}(device_id, ts_ms, temp, level, cycles, uploaded) VALUES(?,?,?,?,?,0)",
+            rs,
+        )
+
+
+# ---------- read ----------
+def overlapping(cur, start_ms: int, end_ms: int) -> List[str]:
+    """ตารางที่ทับช่วง [start_ms, end_ms)"""
+    return [name for day, name in list_partitions(cur) if day < end_ms and day + DAY_MS > start_ms]
+
+
+def query_range(cur, device_id: Optional[str], start_ms: int, end_ms: int,
+                cols: str = "ts_ms, temp, level, cycles") -> List[tuple]:
+    """แถวในช่วง [start_ms, end_ms) เรียงตาม ts_ms (ทีละ partition ต่อกัน)"""
+    out: List[tuple] = []
+    for name in overlapping(cur, start_ms, end_ms):
+        if device_id is None:
+            q = f"SELECT {cols} FROM {name} WHERE ts_ms >= ? AND ts_ms < ? ORDER BY ts_ms"
+            out.extend(cur.execute(q, (start_ms, end_ms)).fetchall())
+        else:
+            q = (f"SELECT {cols} FROM {name} WHERE device_id = ? AND ts_ms >= ? AND ts_ms < ? "
+                 f"ORDER BY ts_ms")
+            out.extend(cur.execute(q, (device_id, start_ms, end_ms)).fetchall())
+    return out
+
+
+def latest(cur, device_id: str, cols: str = "ts_ms, temp, level, cycles",
+           max_parts: int = 3) -> Optional[tuple]:
+    """แถวล่าสุดของเครื่อง — ดูจาก partition ใหม่สุดย้อนไปไม่เกิน max_parts วัน"""
+    for _, name in reversed(list_partitions(cur)[-max_parts:]):
+        row = cur.execute(
+            f"SELECT {cols} FROM {name} WHERE device_id = ? ORDER BY ts_ms DESC LIMIT 1",
+            (device_id,),
+        ).fetchone()
+        if row:
+            return row
+    return None
+
+
+# ---------- retention ----------
+def expired(cur, cutoff_ms: int) -> List[Tuple[int, str]]:
+    """partition ที่ทั้งวันเก่ากว่า cutoff_ms"""
+    return [(day, name) for day, name in list_partitions(cur) if day + DAY_MS <= cutoff_ms]
+
+
+def drop(cur, names: Iterable[str]) -> List[str]:
+    """DROP partition ตามชื่อ (view สร้างใหม่ก่อน ให้ไม่อ้างตารางที่จะลบ)"""
+    dropped = [n for n in names if part_day(n) is not None]
+    if not dropped:
+        return []
+    refresh_view(cur, [(d, n) for d, n in list_partitions(cur) if n not in dropped])
+    for name in dropped:
+        cur.execute(f"DROP TABLE IF EXISTS {name}")
+    return dropped
+
+
+def drop_before(cur, cutoff_ms: int) -> List[str]:
+    """DROP ทุก partition ที่ทั้งวันเก่ากว่า cutoff_ms"""
+    return drop(cur, [name for _, name in expired(cur, cutoff_ms)])
+
+
+def retention_cutoff(days: int, now_ms: Optional[int] = None) -> int:
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    return day_start(now_ms) - int(days) * DAY_MS
+
+
+def drop_older_than_days(cur, days: int) -> List[str]:
+    return drop_before(cur, retention_cutoff(days))
@@ -0,0 +1,132 @@
+# sensor/readings_writer.py
+import os
+import time
+import sqlite3
+import threading
+from collections import deque
+from typing import Callable, List, Optional, Sequence
+
+from sensor import partitions
+
+# เขียนลง SQLite เป็นก้อน (group commit) แทนการ commit ทีละแถว
+WRITE_BATCH_ROWS = int(os.getenv("WRITE_BATCH_ROWS", "50"))       # flush เมื่อครบกี่แถว
+WRITE_BATCH_MS = int(os.getenv("WRITE_BATCH_MS", "2000"))         # หรือเมื่อแถวแรกค้างเกินกี่ ms
+WRITE_MAX_PENDING = int(os.getenv("WRITE_MAX_PENDING", "20000"))  # กัน RAM บวมตอน DB ล็อกนาน
+
+
+class ReadingsWriter:
+    """
+    Buffered ingestion writer for the local `readings` table.
+
+    add() only queues the row in memory. Queued rows are written with
+    executemany() (one per day partition) inside one transaction when the buffer reaches `max_rows`, or
+    when the oldest queued row has waited `max_ms` (checked by a small timer
+    thread, so a quiet collector still gets flushed).
+
+    Crash bound: at most `max_rows` rows / `max_ms` milliseconds of samples are
+    ever held only in memory. close() flushes whatever is left.
+
+    The connection must be opened with isolation_level=None (we issue BEGIN /
+    COMMIT ourselves) and check_same_thread=False (the timer thread flushes).
+    """
+
+    def __init__(self, conn: sqlite3.Connection,
+                 max_rows: int = WRITE_BATCH_ROWS,
+                 max_ms: int = WRITE_BATCH_MS,
+                 insert: Callable = partitions.insert_rows,
+                 max_pending: int = WRITE_MAX_PENDING):
+        self.conn = conn
+        self.insert = insert   # (cursor, rows) -> None; ค่าเริ่มต้นแยกลง partition รายวัน
+        self.max_rows = max(1, int(max_rows))
+        self.max_ms = max(0, int(max_ms))
+        self.max_pending = max(self.max_rows, int(max_pending))
+
+        self._buf: List[tuple] = []
+        self._first_at: Optional[float] = None   # monotonic ของแถวแรกในบัฟเฟอร์
+        self._lock = threading.Lock()            # กัน _buf
+        self._flush_lock = threading.Lock()      # ให้ flush ทีละครั้ง
+
+        self.stats = {
+            "rows": 0, "commits": 0, "errors": 0, "dropped": 0,
+            "last_commit_ms": 0.0, "max_commit_ms": 0.0,
+        }
+        self.commit_ms = deque(maxlen=1024)     # เวลา commit ล่าสุด (ไว้ดู p50/p95)
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="readings-writer", daemon=True)
+        self._thread.start()
+
+    # ---------- public ----------
+    def add(self, row: Sequence):
+        with self._lock:
+            if not self._buf:
+                self._first_at = time.monotonic()
+            self._buf.append(tuple(row))
+            full = len(self._buf) >= self.max_rows
+        if full:
+            self.flush()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._buf)
+
+    def flush(self) -> int:
+        """เขียนทุกแถวที่ค้างอยู่ใน transaction เดียว คืนจำนวนแถวที่เขียนได้"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buf = self._buf, []
+                self._first_at = None
+            if not rows:
+                return 0
+
+            t0 = time.perf_counter()
+            try:
+                cur = self.conn.cursor()
+                cur.execute("BEGIN")
+                self.insert(cur, rows)
+                cur.execute("COMMIT")
+            except Exception as e:
+                try:
+                    self.conn.execute("ROLLBACK")
+                except Exception:
+                    pass
+                self._requeue(rows)
+                self.stats["errors"] += 1
+                print(f"[writer][err] {e} (pending={self.pending()})", flush=True)
+                return 0
+
+            ms = (time.perf_counter() - t0) * 1000.0
+            self.stats["rows"] += len(rows)
+            self.stats["commits"] += 1
+            self.stats["last_commit_ms"] = ms
+            self.stats["max_commit_ms"] = max(self.stats["max_commit_ms"], ms)
+            self.commit_ms.append(ms)
+            return len(rows)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=2.0)
+        self.flush()
+
+    # ---------- internal ----------
+    def _requeue(self, rows: List[tuple]):
+        # เอาแถวที่เขียนไม่สำเร็จกลับไปไว้หน้าคิว (ลำดับเวลาไม่เปลี่ยน)
+        with self._lock:
+            self._buf[:0] = rows
+            over = len(self._buf) - self.max_pending
+            if over > 0:
+                del self._buf[:over]          # ทิ้งแถวเก่าสุดก่อน
+                self.stats["dropped"] += over
+            self._first_at = time.monotonic()
+
+    def _due(self) -> bool:
+        with self._lock:
+            if not self._buf or self._first_at is None:
+                return False
+            return (time.monotonic() - self._first_at) * 1000.0 >= self.max_ms
+
+    def _run(self):
+        tick = min(max(self.max_ms / 4000.0, 0.01), 0.25)
+        while not self._stop.wait(tick):
+            if self._due():
+                self.flush()
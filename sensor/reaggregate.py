@@ -0,0 +1,196 @@
+# sensor/reaggregate.py
+"""
+Recompute `minutes` (and the hours/days rollups) for a range of history,
+e.g. after changing aggregation rules or fixing a sensor calibration.
+
+The range is split into UTC-day chunks (one day partition each). Workers in
+a process pool compute each chunk with minute_aggregator.compute_range() on
+their own read-only connection (mode=ro), and the parent is the only
+writer: it upserts every finished chunk in one transaction, so workers never
+contend for the write lock.
+
+Days older than RETENTION_DAYS no longer have a partition; their chunks are
+computed from the readings_archive blocks instead (sensor/archive.py). Days
+in the range with neither are reported as not recomputed.
+
+The `uploaded` flag keeps its normal meaning: recomputed minutes stay
+uploaded. With REAGG_REUPLOAD=1, minutes whose values actually changed are
+reset to uploaded=0 and queued in the outbox again in the same transaction.
+
+Run:
+  REAGG_START=2026-09-01 REAGG_END=2026-10-01 python -m sensor.reaggregate
+
+ENV:
+  REAGG_START / REAGG_END  YYYY-MM-DD (UTC), END exclusive (default: today+1)
+  REAGG_DEVICE             device_id or ALL (default ALL)
+  REAGG_WORKERS            process count (default: CPU count, 4 on a Pi 5)
+  REAGG_REUPLOAD           1 = mark changed minutes for re-upload
+"""
+import os
+import time
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+from sensor.local_db import connect, ensure_readings_table, ensure_minutes_table, STAT_COLS
+from sensor import archive, partitions, rollups
+from sensor import minute_aggregator as agg
+from sensor.minute_uploader import queue_pending_minutes
+
+DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+REAGG_START = os.getenv("REAGG_START", "")
+REAGG_END = os.getenv("REAGG_END", "")
+REAGG_DEVICE = os.getenv("REAGG_DEVICE", "ALL")
+REAGG_WORKERS = int(os.getenv("REAGG_WORKERS", str(os.cpu_count() or 4)))
+REAGG_REUPLOAD = os.getenv("REAGG_REUPLOAD", "0") == "1"
+
+# เหมือน UPSERT_MINUTE_SQL แต่ถ้าค่าเปลี่ยนจริงให้ uploaded=0 (ส่งขึ้น Firestore ใหม่)
+REUPLOAD_SQL = agg.REUPLOAD_MINUTE_SQL
+
+
+def parse_day(s: str) -> int:
+    d = datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return int(d.timestamp() * 1000)
+
+
+def compute_archived(cur, device_id, start_ms: int, end_ms: int) -> list:
+    """เหมือน agg.compute_range() แต่ decode จาก readings_archive (วันที่ partition ถูกลบแล้ว)"""
+    start_ms = agg.floor_to_minute_utc(start_ms)
+    if device_id is None:
+        dids = [r[0] for r in cur.execute(
+            "SELECT DISTINCT device_id FROM readings_archive WHERE hour_start_ms < ? AND hour_start_ms + ? > ?",
+            (end_ms, archive.HOUR_MS, start_ms),
+        )]
+    else:
+        dids = [device_id]
+    out = []
+    for did in dids:
+        by_minute = {}
+        for _, rows in archive.iter_blocks(cur, did, start_ms, end_ms):
+            for r in rows:
+                by_minute.setdefault(agg.floor_to_minute_utc(r[0]), []).append(r)
+        for m, rows in sorted(by_minute.items()):
+            stats = agg.minute_stats(rows)
+            out.append((did, agg.minute_id_utc(m), m) + tuple(stats[c] for c in STAT_COLS))
+    return out
+
+
+def archived_days(cur, device_id, end_ms: int) -> set:
+    """วัน (ms ต้นวัน UTC) ที่มี block ใน readings_archive"""
+    where, params = "hour_start_ms < ?", [end_ms]
+    if device_id is not None:
+        where += " AND device_id = ?"
+        params.append(device_id)
+    return {r[0] for r in cur.execute(
+        f"SELECT DISTINCT hour_start_ms - hour_start_ms % ? FROM readings_archive WHERE {where}",
+        [partitions.DAY_MS] + params,
+    )}
+
+
+def missing_ranges(days, lo: int, hi: int) -> list:
+    """ช่วง [a, b) ใน [lo, hi) ที่ไม่มีวันไหนใน days (รวมวันติดกันเป็นช่วงเดียว)"""
+    out = []
+    d = partitions.day_start(lo)
+    while d < hi:
+        if d not in days:
+            a, b = max(d, lo), min(d + partitions.DAY_MS, hi)
+            if out and out[-1][1] == a:
+                out[-1] = (out[-1][0], b)
+            else:
+                out.append((a, b))
+        d += partitions.DAY_MS
+    return out
+
+
+def compute_chunk(path: str, device_id, start_ms: int, end_ms: int, from_archive: bool = False):
+    """รันใน worker process: connection อ่านอย่างเดียวของตัวเอง"""
+    t0 = time.perf_counter()
+    con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        compute = compute_archived if from_archive else agg.compute_range
+        rows = compute(con.cursor(), device_id, start_ms, end_ms)
+    finally:
+        con.close()
+    return start_ms, rows, time.perf_counter() - t0
+
+
+def main():
+    now_ms = int(time.time() * 1000)
+    start_ms = parse_day(REAGG_START) if REAGG_START else None
+    end_ms = parse_day(REAGG_END) if REAGG_END else partitions.day_start(now_ms) + partitions.DAY_MS
+    device_id = None if REAGG_DEVICE == "ALL" else REAGG_DEVICE
+
+    conn = connect(DB, isolation_level=None)
+    cur = conn.cursor()
+    ensure_readings_table(cur)
+    ensure_minutes_table(cur)
+    rollups.ensure_rollup_tables(cur)
+    archive.ensure_archive_table(cur)
+
+    # หนึ่ง chunk = หนึ่งวัน: partition รายวัน หรือ archive ถ้า partition ถูกลบไปแล้ว
+    part_days = {d for d, _ in partitions.list_partitions(cur)}
+    arch_days = archived_days(cur, device_id, end_ms) - part_days
+    days = sorted(d for d in part_days | arch_days
+                  if (start_ms is None or d + partitions.DAY_MS > start_ms) and d < end_ms)
+    # นาทีที่ยังเปิดอยู่ไม่ต้องทำ (aggregator ทำเอง)
+    hi = min(end_ms, agg.floor_to_minute_utc(now_ms))
+    lo = start_ms if start_ms is not None else (days[0] if days else hi)
+
+    # วันที่ไม่มีทั้ง partition และ archive (เก่ากว่า ARCHIVE_RETENTION_DAYS) คำนวณใหม่ไม่ได้
+    missing = missing_ranges(set(days), lo, hi)
+    for a, b in missing:
+        print(f"[reaggregate] WARN ไม่มี readings (ทั้ง partition และ archive) ช่วง "
+              f"{datetime.fromtimestamp(a / 1000, tz=timezone.utc):%Y-%m-%d %H:%M} - "
+              f"{datetime.fromtimestamp(b / 1000, tz=timezone.utc):%Y-%m-%d %H:%M} UTC: ไม่ได้คำนวณใหม่",
+              flush=True)
+    if not days:
+        print("[reaggregate] ไม่มี readings ในช่วงนี้", flush=True)
+        return
+    lo = max(days[0], lo)
+    chunks = [(max(d, lo), min(d + partitions.DAY_MS, hi), d in arch_days)
+              for d in days if max(d, lo) < min(d + partitions.DAY_MS, hi)]
+
+    sql = REUPLOAD_SQL if REAGG_REUPLOAD else agg.UPSERT_MINUTE_SQL
+    print(f"[reaggregate] chunks={len(chunks)} (archive={sum(c[2] for c in chunks)}) "
+          f"device={REAGG_DEVICE} workers={REAGG_WORKERS} "
+          f"reupload={REAGG_REUPLOAD} db={DB}", flush=True)
+
+    t0 = time.perf_counter()
+    minutes = samples = reset = 0
+    devices = set()
+    with ProcessPoolExecutor(max_workers=REAGG_WORKERS) as pool:
+        futs = [pool.submit(compute_chunk, DB, device_id, a, b, arch) for a, b, arch in chunks]
+        for i, fut in enumerate(as_completed(futs), 1):
+            day, rows, took = fut.result()
+            # writer เดียว: หนึ่ง transaction ต่อ chunk
+            cur.execute("BEGIN")
+            cur.executemany(sql, rows)
+            # นาทีใหม่ / นาทีที่ถูก reset -> outbox
+            reset += queue_pending_minutes(cur)
+            cur.execute("COMMIT")
+
+            n_samples = sum(r[3 + STAT_COLS.index("n_samples")] or 0 for r in rows)
+            minutes += len(rows)
+            samples += n_samples
+            devices.update(r[0] for r in rows)
+            elapsed = time.perf_counter() - t0
+            src = "archive" if partitions.day_start(day) in arch_days else partitions.part_name(day)
+            print(f"[reaggregate] {i}/{len(chunks)} {src} minutes={len(rows)} "
+                  f"rows={n_samples} ({n_samples / max(took, 1e-9):.0f} rows/s in worker) "
+                  f"total {samples / max(elapsed, 1e-9):.0f} rows/s", flush=True)
+
+    # hours / days ของช่วงที่คำนวณใหม่
+    cur.execute("BEGIN")
+    for did in sorted(devices):
+        rollups.reroll_closed(cur, did, lo, hi)
+    cur.execute("COMMIT")
+    conn.close()
+
+    elapsed = time.perf_counter() - t0
+    print(f"[reaggregate] DONE minutes={minutes} rows={samples} in {elapsed:.1f}s "
+          f"= {samples / max(elapsed, 1e-9):.0f} rows/s"
+          f" queued={reset} missing_days={sum(b - a for a, b in missing) / partitions.DAY_MS:.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
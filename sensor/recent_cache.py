@@ -0,0 +1,233 @@
+# sensor/recent_cache.py
+"""
+In-process cache of the last RECENT_CACHE_HOURS of minute rows per device.
+
+Dashboard charts mostly ask for the last 1–24 hours; instead of a Firestore
+query or a fresh SQLite connection per request, each process (Django
+worker) keeps the recent `minutes` rows in compact columns:
+
+  ts      array('q')   ts_minute (ms), ascending
+  <stat>  array('d')   one column per STAT_COLS, NaN = NULL
+
+A range is two bisects on `ts` plus slicing — no query. The buffer is a
+ring: new minutes are appended, minutes older than the window are
+dropped from the head (compacted in bulk), rewritten minutes (late rows)
+are overwritten in place.
+
+Feeding: `put()` for an aggregator running in the same process, and
+`refresh()` which tails the `minutes` table — at most once per
+RECENT_CACHE_REFRESH_SEC, re-reading the last RECENT_CACHE_LOOKBACK_MIN
+minutes so recomputed ones are picked up. The first use for a device
+loads the whole window (one indexed query).
+
+  RECENT_CACHE_HOURS         window kept in memory (24)
+  RECENT_CACHE_REFRESH_SEC   min seconds between tails of `minutes` (5)
+  RECENT_CACHE_LOOKBACK_MIN  minutes re-read on every tail (10)
+  RECENT_CACHE_ENABLE        0 = views go straight to SQLite / Firestore
+"""
+import os
+import math
+import time
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+from sensor.local_db import STAT_COLS
+from sensor import rollups
+
+DB_PATH = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+RECENT_CACHE_HOURS = float(os.getenv("RECENT_CACHE_HOURS", "24"))
+RECENT_CACHE_REFRESH_SEC = float(os.getenv("RECENT_CACHE_REFRESH_SEC", "5"))
+RECENT_CACHE_LOOKBACK_MIN = int(os.getenv("RECENT_CACHE_LOOKBACK_MIN", "10"))
+RECENT_CACHE_ENABLE = os.getenv("RECENT_CACHE_ENABLE", "1") == "1"
+
+MINUTE_MS = 60_000
+_INT_COLS = ("cycles_delta", "n_samples")   # เก็บเป็น float แต่คืนค่าเป็น int เหมือน SQLite
+_NAN = float("nan")
+
+
+class Ring:
+    """minutes ของเครื่องเดียว เรียงตาม ts (ไม่ thread-safe — RecentCache ล็อกให้)"""
+
+    def __init__(self, window_ms: int):
+        self.window_ms = window_ms
+        self.ts = array("q")
+        self.cols: Dict[str, array] = {c: array("d") for c in STAT_COLS}
+        self.head = 0   # index แรกที่ยังอยู่ในหน้าต่าง (ข้างหน้าคือของเก่ารอ compact)
+
+    def __len__(self):
+        return len(self.ts) - self.head
+
+    def first_ts(self) -> Optional[int]:
+        return self.ts[self.head] if len(self) else None
+
+    def last_ts(self) -> Optional[int]:
+        return self.ts[-1] if len(self) else None
+
+    def put(self, ts: int, stats: Dict):
+        vals = [_NAN if stats.get(c) is None else float(stats[c]) for c in STAT_COLS]
+        n = len(self.ts)
+        if n == self.head or ts > self.ts[-1]:
+            i = n                                   # ปกติ: นาทีใหม่ต่อท้าย
+        else:
+            i = bisect_left(self.ts, ts, self.head)
+            if i < n and self.ts[i] == ts:          # นาทีเดิมถูกคำนวณใหม่ -> ทับ
+                for c, v in zip(STAT_COLS, vals):
+                    self.cols[c][i] = v
+                return
+        if i == n:
+            self.ts.append(ts)
+            for c, v in zip(STAT_COLS, vals):
+                self.cols[c].append(v)
+        else:
+            self.ts.insert(i, ts)
+            for c, v in zip(STAT_COLS, vals):
+                self.cols[c].insert(i, v)
+
+    def trim(self, now_ms: int):
+        """ตัดนาทีที่หลุดหน้าต่าง; ย้ายข้อมูลจริงเมื่อของเก่าสะสมเกินครึ่ง buffer"""
+        cut = bisect_left(self.ts, now_ms - self.window_ms, self.head)
+        if cut > self.head:
+            self.head = cut
+        if self.head and self.head * 2 >= len(self.ts):
+            del self.ts[:self.head]
+            for col in self.cols.values():
+                del col[:self.head]
+            self.head = 0
+
+    def range(self, start_ms: int, end_ms: int) -> List[Dict]:
+        """แถวใน [start_ms, end_ms) เป็น dict แบบ rollups.series (ts + STAT_COLS)"""
+        lo = bisect_left(self.ts, start_ms, self.head)
+        hi = bisect_left(self.ts, end_ms, lo)
+        cols = {c: self.cols[c][lo:hi] for c in STAT_COLS}
+        out = []
+        for k, ts in enumerate(self.ts[lo:hi]):
+            r = {"ts": ts}
+            for c in STAT_COLS:
+                v = cols[c][k]
+                r[c] = None if math.isnan(v) else (int(v) if c in _INT_COLS else v)
+            out.append(r)
+        return out
+
+
+class RecentCache:
+    def __init__(self, db_path: str = DB_PATH, hours: float = RECENT_CACHE_HOURS,
+                 refresh_sec: float = RECENT_CACHE_REFRESH_SEC,
+                 lookback_min: int = RECENT_CACHE_LOOKBACK_MIN):
+        self.db_path = db_path
+        # +1 ชั่วโมง: กราฟรายชั่วโมงปัดต้นช่วงลงเป็นต้นชั่วโมง (24h ต้องได้ 25 ชั่วโมงเต็ม)
+        self.window_ms = int(hours * 3_600_000) + rollups.HOUR_MS
+        self.refresh_sec = refresh_sec
+        self.lookback_ms = lookback_min * MINUTE_MS
+        self.rings: Dict[str, Ring] = {}
+        self.since: Dict[str, int] = {}         # ครอบคลุมตั้งแต่ ts นี้ (โหลดครั้งแรก)
+        self.next_refresh: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "loads": 0, "refreshes": 0}
+
+    # ---------- feed ----------
+    def put(self, device_id: str, ts_minute: int, stats: Dict):
+        """aggregator ใน process เดียวกันส่งนาทีที่เพิ่ง upsert มาให้ตรงๆ"""
+        with self.lock:
+            ring = self.rings.get(device_id)
+            if ring is not None:
+                ring.put(int(ts_minute), stats)
+
+    def _query(self, device_id: str, since_ms: int) -> List[Tuple]:
+        con = sqlite3.connect(self.db_path)
+        try:
+            return con.execute(
+                f"SELECT ts_minute, {', '.join(STAT_COLS)} FROM minutes "
+                f"WHERE device_id=? AND ts_minute >= ? ORDER BY ts_minute",
+                (device_id, since_ms),
+            ).fetchall()
+        finally:
+            con.close()
+
+    def refresh(self, device_id: str, now_ms: Optional[int] = None, force: bool = False) -> Ring:
+        """tail ตาราง minutes ของเครื่องนี้ (ไม่เกินทุก refresh_sec วินาที)"""
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        mono = time.monotonic()
+        with self.lock:
+            ring = self.rings.get(device_id)
+            if ring is not None and not force and mono < self.next_refresh.get(device_id, 0.0):
+                return ring
+            self.next_refresh[device_id] = mono + self.refresh_sec
+            if ring is None:
+                since = now_ms - self.window_ms
+            else:
+                last = ring.last_ts()
+                since = (now_ms - self.window_ms) if last is None else last - self.lookback_ms
+        # query นอก lock: request อื่นยังอ่านของเดิมได้
+        rows = self._query(device_id, since)
+        with self.lock:
+            if device_id not in self.rings:
+                self.rings[device_id] = Ring(self.window_ms)
+                self.since[device_id] = since
+                self.stats["loads"] += 1
+            else:
+                self.stats["refreshes"] += 1
+            ring = self.rings[device_id]
+            for r in rows:
+                ring.put(r[0], dict(zip(STAT_COLS, r[1:])))
+            ring.trim(now_ms)
+            self.since[device_id] = max(self.since[device_id], now_ms - self.window_ms)
+            return ring
+
+    # ---------- query ----------
+    def covers(self, device_id: str, start_ms: int) -> bool:
+        s = self.since.get(device_id)
+        return s is not None and start_ms >= s
+
+    def range(self, device_id: str, start_ms: int, end_ms: int) -> Optional[List[Dict]]:
+        """minutes ใน [start_ms, end_ms) หรือ None ถ้าช่วงเก่ากว่าหน้าต่าง (ให้ผู้เรียก fallback)"""
+        now_ms = int(time.time() * 1000)
+        if start_ms < now_ms - self.window_ms:
+            self.stats["misses"] += 1
+            return None
+        self.refresh(device_id, now_ms)
+        with self.lock:
+            if not self.covers(device_id, start_ms):
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            return self.rings[device_id].range(start_ms, end_ms)
+
+    def series(self, device_id: str, start_ms: int, end_ms: int,
+               resolution: Optional[str] = None) -> Optional[Tuple[str, List[Dict]]]:
+        """เหมือน rollups.series แต่จาก memory: minutes ตรงๆ หรือรวมเป็นชั่วโมง (UTC); days -> None"""
+        res = resolution or rollups.pick_resolution(end_ms - start_ms)
+        if res not in ("minutes", "hours"):
+            return None
+        if res == "hours":
+            start_ms = rollups.bucket_start("hours", start_ms)
+        rows = self.range(device_id, start_ms, end_ms)
+        if rows is None or res == "minutes":
+            return None if rows is None else (res, rows)
+        out: List[Dict] = []
+        cur_b, acc = None, []
+        for r in rows:
+            b = rollups.bucket_start("hours", r["ts"])
+            if b != cur_b and acc:
+                out.append(dict(rollups.combine(acc), ts=cur_b))
+                acc = []
+            cur_b = b
+            acc.append(r)
+        if acc:
+            out.append(dict(rollups.combine(acc), ts=cur_b))
+        return res, out
+
+
+_cache: Optional[RecentCache] = None
+
+
+def get() -> Optional[RecentCache]:
+    """แคชร่วมของ process (None ถ้าปิดด้วย RECENT_CACHE_ENABLE=0)"""
+    global _cache
+    if not RECENT_CACHE_ENABLE:
+        return None
+    if _cache is None:
+        _cache = RecentCache()
+    return _cache
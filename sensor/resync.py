@@ -0,0 +1,250 @@
+# sensor/resync.py
+"""
+Parallel outbox drain for catching up after an outage.
+
+outbox.drain() commits one Firestore batch at a time; each commit is a
+full round trip, so a week of backlog is thousands of serial waits.
+resync() keeps several batch commits in flight on a thread pool:
+
+- concurrency is AIMD: +1 after a full window of acknowledged batches,
+  halved on ResourceExhausted / transient errors (the failed batch is
+  retried after a backoff)
+- only the main thread touches SQLite; the cursor advances to the highest
+  *contiguous* acknowledged window and is committed as batches land, so a
+  crash never skips a batch that was still in flight
+- rows are read in windows; all rows of one document in a window go to the
+  same batch (coalesced into one write), and a batch whose documents clash
+  with an earlier unfinished batch waits, so an older write to e.g.
+  devices/{id} (latest) can never land after a newer one
+- non-quota errors fall back to outbox's serial bisect + dead-letter
+- every batch is charged to the daily budget as class "backfill" before it
+  is sent; resync stops (cursor stays put) once that class is exhausted
+
+RESYNC_MAX=1 gives the serial behaviour for comparison; docs/s is printed
+every RESYNC_REPORT_SEC and at the end.
+
+Run:  python -m sensor.resync
+"""
+import os
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional
+
+from sensor import budget, outbox
+
+DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+RESYNC_START = int(os.getenv("RESYNC_START", "2"))        # จำนวน batch ที่ส่งพร้อมกันตอนเริ่ม
+RESYNC_MAX = int(os.getenv("RESYNC_MAX", "8"))
+RESYNC_BATCH = int(os.getenv("RESYNC_BATCH", str(outbox.OUTBOX_BATCH)))
+RESYNC_REPORT_SEC = float(os.getenv("RESYNC_REPORT_SEC", "5"))
+
+
+class _Window:
+    """rows ที่อ่านมาพร้อมกัน; cursor เลื่อนถึง last ได้เมื่อทุก batch ในนี้ ack แล้ว"""
+    def __init__(self, last: int):
+        self.last = last
+        self.left = 0
+
+
+class _Batch:
+    def __init__(self, rows: List[tuple], win: _Window):
+        self.rows = rows
+        self.paths = {r[2] for r in rows}
+        self.win = win
+        self.tries = 0
+        win.left += 1
+
+
+def split_window(rows: List[tuple], batch_size: int) -> List[List[tuple]]:
+    """
+    แบ่ง rows เป็น batch ละไม่เกิน batch_size doc โดยทุกแถวของ doc เดียวกัน
+    อยู่ batch เดียวกัน (ลำดับ seq เดิม) -> ใน window เดียวไม่มี doc ชนกันข้าม batch
+    """
+    groups: Dict[str, List[tuple]] = {}
+    for r in rows:
+        groups.setdefault(r[2], []).append(r)
+    out: List[List[tuple]] = []
+    cur: List[tuple] = []
+    n = 0
+    for g in groups.values():
+        if n == batch_size:
+            out.append(cur)
+            cur, n = [], 0
+        cur.extend(g)
+        n += 1
+    if cur:
+        out.append(cur)
+    return out
+
+
+def _push(fs, rows: List[tuple], commit):
+    commit(fs, rows)
+    return len(rows)
+
+
+def resync(fs, conn: sqlite3.Connection, consumer: str = outbox.DEFAULT_CONSUMER,
+           batch_size: int = RESYNC_BATCH, start: int = RESYNC_START, max_conc: int = RESYNC_MAX,
+           commit=outbox._commit_docs, max_seconds: Optional[float] = None,
+           cls: str = "backfill", max_retries: int = outbox.OUTBOX_MAX_RETRIES) -> Dict:
+    """
+    ส่งทุกอย่างหลัง cursor ของ consumer แบบหลาย batch พร้อมกัน
+    คืนสถิติแบบ outbox.drain() + {"docs", "conc_max", "docs_per_sec", "seconds"}
+    """
+    cur = conn.cursor()
+    stats = {"sent": 0, "docs": 0, "dead": 0, "batches": 0, "retries": 0, "stopped": None,
+             "conc_max": 0, "docs_per_sec": 0.0}
+    cursor = outbox.get_cursor(cur, consumer)
+    read_pos = cursor                  # seq สุดท้ายที่อ่านออกมาแล้ว
+    conc = max(1, min(start, max_conc))
+    ok_in_window = 0
+    backoff = 1.0
+    hold_until = 0.0
+
+    pending: List[_Batch] = []         # อ่านแล้ว ยังไม่ได้ส่ง (batch ที่ต้อง retry อยู่หน้าสุด)
+    inflight: Dict = {}                # future -> _Batch
+    windows: List[_Window] = []        # ตามลำดับการอ่าน
+
+    t0 = time.perf_counter()
+    next_report = t0 + RESYNC_REPORT_SEC
+    exhausted = False
+
+    def ack(b: _Batch):
+        nonlocal cursor
+        stats["batches"] += 1
+        stats["docs"] += len(b.paths)
+        b.win.left -= 1
+        moved = False
+        while windows and windows[0].left == 0:
+            cursor = windows.pop(0).last
+            moved = True
+        if moved:
+            outbox.set_cursor(cur, consumer, cursor)
+            conn.commit()
+
+    with ThreadPoolExecutor(max_workers=max_conc, thread_name_prefix="resync") as pool:
+        while True:
+            # ---- เติมงาน ----
+            if not exhausted and len(pending) < conc:
+                rows = outbox.read_batch(cur, read_pos, batch_size * conc)
+                if not rows:
+                    exhausted = True
+                else:
+                    win = _Window(rows[-1][0])
+                    windows.append(win)
+                    pending.extend(_Batch(part, win) for part in split_window(rows, batch_size))
+                    read_pos = win.last
+
+            # ---- ส่ง ----
+            # batch ที่มี doc ชนกับ batch ก่อนหน้า (กำลังส่ง หรือยังรอ) ต้องรอ ไม่ให้ของเก่าทับของใหม่
+            if time.monotonic() >= hold_until:
+                blocked = set()
+                for b in inflight.values():
+                    blocked |= b.paths
+                for b in list(pending):
+                    if len(inflight) >= conc:
+                        break
+                    if not (b.paths & blocked):
+                        if b.tries == 0 and not budget.try_spend("write", cls, len(b.paths)):
+                            stats["stopped"] = f"budget: {cls} write budget exhausted"
+                            break
+                        pending.remove(b)
+                        b.tries += 1
+                        inflight[pool.submit(_push, fs, b.rows, commit)] = b
+                    blocked |= b.paths
+            stats["conc_max"] = max(stats["conc_max"], len(inflight))
+
+            if not inflight:
+                if (exhausted and not pending) or stats["stopped"]:
+                    break
+                time.sleep(max(0.0, min(0.2, hold_until - time.monotonic())))
+                continue
+
+            # ---- รอผล ----
+            done, _ = wait(list(inflight), timeout=0.5, return_when=FIRST_COMPLETED)
+            for fut in done:
+                b = inflight.pop(fut)
+                try:
+                    stats["sent"] += fut.result()
+                    ack(b)
+                    ok_in_window += 1
+                    backoff = 1.0
+                    if ok_in_window >= conc and conc < max_conc:
+                        conc += 1                       # additive increase
+                        ok_in_window = 0
+                except outbox.RETRYABLE as e:
+                    stats["retries"] += 1
+                    conc = max(1, conc // 2)            # multiplicative decrease
+                    ok_in_window = 0
+                    if b.tries > max_retries:
+                        stats["stopped"] = f"{type(e).__name__}: {e}"
+                        stats["error"] = e
+                    pending.insert(0, b)
+                    hold_until = time.monotonic() + backoff
+                    print(f"[resync] {type(e).__name__}, conc={conc} retry in {backoff:.0f}s", flush=True)
+                    backoff = min(backoff * 2, outbox.OUTBOX_BACKOFF_MAX_SEC)
+                except Exception:
+                    # ผ่าครึ่งแบบ serial บน thread หลัก (แตะ SQLite ได้) แล้วนับว่าจบ batch
+                    # (set merge ซ้ำได้ ถ้าโดน quota กลางทางก็เริ่มผ่าใหม่ทั้ง batch)
+                    sub = {"sent": 0, "dead": 0}
+                    wait_s = 1.0
+                    for attempt in range(max_retries + 1):
+                        try:
+                            outbox._send(fs, cur, consumer, b.rows, commit, sub)
+                            break
+                        except outbox.RETRYABLE as e:
+                            stats["retries"] += 1
+                            sub = {"sent": 0, "dead": 0}
+                            if attempt == max_retries:
+                                stats["stopped"] = f"{type(e).__name__}: {e}"
+                                stats["error"] = e
+                            else:
+                                time.sleep(wait_s)
+                                wait_s = min(wait_s * 2, outbox.OUTBOX_BACKOFF_MAX_SEC)
+                    if stats["stopped"]:
+                        continue
+                    stats["sent"] += sub["sent"]
+                    stats["dead"] += sub["dead"]
+                    ack(b)
+
+            elapsed = time.perf_counter() - t0
+            if stats["stopped"] or (max_seconds is not None and elapsed >= max_seconds):
+                # ไม่ส่งเพิ่ม รอแค่ที่ค้างอยู่; cursor ไม่ข้าม batch ที่ยังไม่ ack
+                exhausted = True
+                pending.clear()
+            if time.perf_counter() >= next_report:
+                print(f"[resync] docs={stats['docs']} {stats['docs'] / max(elapsed, 1e-9):.0f} docs/s "
+                      f"conc={conc} inflight={len(inflight)} cursor={cursor}", flush=True)
+                next_report += RESYNC_REPORT_SEC
+
+    elapsed = time.perf_counter() - t0
+    stats["docs_per_sec"] = round(stats["docs"] / max(elapsed, 1e-9), 1)
+    stats["seconds"] = round(elapsed, 2)
+    return stats
+
+
+def main():
+    from sensor.firebase_admin_init import get_fs_named, report
+
+    name, fs = get_fs_named()
+    if fs is None:
+        raise RuntimeError("Firestore client not ready")
+    consumer = outbox.project_consumer(name)
+    conn = sqlite3.connect(DB, check_same_thread=False)
+    cur = conn.cursor()
+    outbox.ensure_outbox_tables(cur)
+    conn.commit()
+
+    before = outbox.metrics(cur, consumer)
+    print(f"[resync] project={name} depth={before['depth']} oldest={before['oldest_age_s']}s "
+          f"conc={RESYNC_START}..{RESYNC_MAX} batch={RESYNC_BATCH}", flush=True)
+    stats = resync(fs, conn, consumer=consumer)
+    report(name, stats.pop("error", None))
+    outbox.compact(cur)
+    conn.commit()
+    print(f"[resync] DONE {stats}", flush=True)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# sensor/rollups.py
+"""
+Hierarchical rollups: minutes -> hours -> days.
+
+  hours  one row per (device_id, UTC hour)             built from minutes
+  days   one row per (device_id, tz, local calendar day) built from hours
+         for every tz in ROLLUP_TZS (default UTC + Asia/Bangkok)
+
+Each row keeps avg/min/max/last of temp and level, the cycles delta and the
+sample count. Averages are weighted by n_samples so an hour with a gap is
+not skewed by the minutes around it.
+
+update_device() is called by minute_aggregator after each run: a watermark
+per (device, level, tz) remembers the end of the last closed bucket, so
+every call only rolls the buckets that closed since (plus the last one
+again, to pick up late minutes).
+
+series() answers chart queries with the coarsest resolution that still
+gives ROLLUP_MIN_POINTS points: a week reads 168 hour rows, a month 30 day
+rows. The still-open tail bucket is computed on the fly from minutes.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    from backports.zoneinfo import ZoneInfo  # type: ignore
+
+from sensor.local_db import STAT_COLS
+
+ROLLUP_TZS = [t.strip() for t in os.getenv("ROLLUP_TZS", "UTC,Asia/Bangkok").split(",") if t.strip()]
+ROLLUP_TZ = os.getenv("ROLLUP_TZ", "Asia/Bangkok")              # tz ของ days ที่ series() ใช้
+ROLLUP_MIN_POINTS = int(os.getenv("ROLLUP_MIN_POINTS", "24"))   # จุดขั้นต่ำต่อกราฟ
+
+MINUTE_MS = 60_000
+HOUR_MS = 3_600_000
+
+ROLLUP_DDL = """
+CREATE TABLE IF NOT EXISTS {name}(
+  device_id TEXT NOT NULL,
+  tz TEXT NOT NULL,
+  bucket_start INTEGER NOT NULL,
+  bucket_id TEXT NOT NULL,
+  temp_avg REAL,
+  temp_min REAL,
+  temp_max REAL,
+  temp_last REAL,
+  level_avg REAL,
+  level_min REAL,
+  level_max REAL,
+  level_last REAL,
+  cycles_delta INTEGER,
+  n_samples INTEGER,
+  n_minutes INTEGER,
+  PRIMARY KEY (device_id, tz, bucket_start)
+)
+"""
+
+
+def ensure_rollup_tables(cur):
+    cur.execute(ROLLUP_DDL.format(name="hours"))
+    cur.execute(ROLLUP_DDL.format(name="days"))
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS rollup_state(
+      device_id TEXT NOT NULL,
+      level TEXT NOT NULL,
+      tz TEXT NOT NULL,
+      done_until INTEGER NOT NULL,
+      PRIMARY KEY (device_id, level, tz)
+    )""")
+
+
+# ---------- buckets ----------
+def _tz(name: str):
+    return timezone.utc if name == "UTC" else ZoneInfo(name)
+
+
+def bucket_start(level: str, ts_ms: int, tz: str = "UTC") -> int:
+    if level == "minutes":
+        return (int(ts_ms) // MINUTE_MS) * MINUTE_MS
+    if level == "hours":
+        return (int(ts_ms) // HOUR_MS) * HOUR_MS
+    dt = datetime.fromtimestamp(ts_ms / 1000.0, tz=_tz(tz))
+    return int(dt.replace(hour=0, minute=0, second=0, microsecond=0).timestamp() * 1000)
+
+
+def bucket_end(level: str, start_ms: int, tz: str = "UTC") -> int:
+    if level == "minutes":
+        return start_ms + MINUTE_MS
+    if level == "hours":
+        return start_ms + HOUR_MS
+    dt = datetime.fromtimestamp(start_ms / 1000.0, tz=_tz(tz)) + timedelta(days=1)
+    return int(dt.replace(hour=0, minute=0, second=0, microsecond=0).timestamp() * 1000)
+
+
+def bucket_id(level: str, start_ms: int, tz: str = "UTC") -> str:
+    dt = datetime.fromtimestamp(start_ms / 1000.0, tz=_tz(tz))
+    return dt.strftime("%Y%m%d%H" if level == "hours" else "%Y%m%d")
+
+
+# ---------- combine ----------
+def combine(rows: List[Dict]) -> Dict:
+    """รวมหลาย bucket ย่อย (เรียงตามเวลา) เป็น bucket เดียว"""
+    out: Dict = {}
+    for m in ("temp", "level"):
+        num = den = 0.0
+        mins, maxs = [], []
+        last = None
+        for r in rows:
+            avg = r.get(f"{m}_avg")
+            if avg is None:
+                continue
+            w = r.get("n_samples") or 1
+            num += avg * w
+            den += w
+            mins.append(r.get(f"{m}_min") if r.get(f"{m}_min") is not None else avg)
+            maxs.append(r.get(f"{m}_max") if r.get(f"{m}_max") is not None else avg)
+            last = r.get(f"{m}_last") if r.get(f"{m}_last") is not None else avg
+        out[f"{m}_avg"] = num / den if den else None
+        out[f"{m}_min"] = min(mins) if mins else None
+        out[f"{m}_max"] = max(maxs) if maxs else None
+        out[f"{m}_last"] = last
+
+    deltas = [r["cycles_delta"] for r in rows if r.get("cycles_delta") is not None]
+    out["cycles_delta"] = sum(deltas) if deltas else None
+    ns = [r["n_samples"] for r in rows if r.get("n_samples") is not None]
+    out["n_samples"] = sum(ns) if ns else None
+    out["n_minutes"] = sum(r.get("n_minutes") or 1 for r in rows)
+    return out
+
+
+# ---------- source rows ----------
+def _fetch(cur, level: str, device_id: str, tz: str, start_ms: int, end_ms: int) -> List[Dict]:
+    """แถวของ level นั้นในช่วง [start_ms, end_ms) เป็น dict ที่มี ts"""
+    cols = ", ".join(STAT_COLS)
+    if level == "minutes":
+        q = cur.execute(
+            f"SELECT ts_minute, {cols}, 1 FROM minutes "
+            f"WHERE device_id=? AND ts_minute >= ? AND ts_minute < ? ORDER BY ts_minute",
+            (device_id, start_ms, end_ms),
+        )
+    else:
+        q = cur.execute(
+            f"SELECT bucket_start, {cols}, n_minutes FROM {level} "
+            f"WHERE device_id=? AND tz=? AND bucket_start >= ? AND bucket_start < ? ORDER BY bucket_start",
+            (device_id, tz, start_ms, end_ms),
+        )
+    keys = ("ts",) + STAT_COLS + ("n_minutes",)
+    return [dict(zip(keys, r)) for r in q.fetchall()]
+
+
+def _group(level: str, tz: str, rows: List[Dict]) -> List[Tuple[int, Dict]]:
+    """จัดแถวย่อยเข้า bucket ของ level แล้ว combine"""
+    out: List[Tuple[int, Dict]] = []
+    cur_b, acc = None, []
+    for r in rows:
+        b = bucket_start(level, r["ts"], tz)
+        if b != cur_b and acc:
+            out.append((cur_b, combine(acc)))
+            acc = []
+        cur_b = b
+        acc.append(r)
+    if acc:
+        out.append((cur_b, combine(acc)))
+    return out
+
+
+# hours = UTC ทุกชั่วโมง; days สร้างจาก hours (ใช้ได้กับ tz ที่ offset เป็นชั่วโมงเต็ม เช่น Asia/Bangkok)
+_SOURCE = {"hours": ("minutes", "UTC"), "days": ("hours", "UTC")}
+
+
+def _upsert(cur, level: str, device_id: str, tz: str, buckets: List[Tuple[int, Dict]]):
+    cols = STAT_COLS + ("n_minutes",)
+    cur.executemany(
+        f"""
+        INSERT OR REPLACE INTO {level}(device_id, tz, bucket_start, bucket_id, {", ".join(cols)})
+        VALUES(?,?,?,?,{",".join("?" * len(cols))})
+        """,
+        [(device_id, tz, b, bucket_id(level, b, tz)) + tuple(s[c] for c in cols) for b, s in buckets],
+    )
+
+
+def reroll_range(cur, level: str, device_id: str, tz: str, start_ms: int, end_ms: int) -> int:
+    """คำนวณ bucket ของ level ที่อยู่ใน [start_ms, end_ms) ใหม่จาก level ที่ละเอียดกว่า"""
+    src, src_tz = _SOURCE[level]
+    start_ms = bucket_start(level, start_ms, tz)
+    buckets = _group(level, tz, _fetch(cur, src, device_id, src_tz, start_ms, end_ms))
+    _upsert(cur, level, device_id, tz, buckets)
+    return len(buckets)
+
+
+def reroll_closed(cur, device_id: str, start_ms: int, end_ms: int) -> int:
+    """
+    หลังแก้ minutes ย้อนหลัง: คำนวณ hours/days ที่ทับ [start_ms, end_ms) ใหม่
+    เฉพาะ bucket ที่เคย roll แล้ว (ไม่เขียน bucket ที่ยังเปิดอยู่)
+    """
+    ensure_rollup_tables(cur)
+    n = 0
+    for level, tzs in (("hours", ["UTC"]), ("days", ROLLUP_TZS)):
+        for tz in tzs:
+            row = cur.execute(
+                "SELECT done_until FROM rollup_state WHERE device_id=? AND level=? AND tz=?",
+                (device_id, level, tz),
+            ).fetchone()
+            if not row:
+                continue
+            end = min(bucket_end(level, bucket_start(level, end_ms - 1, tz), tz), row[0])
+            if end > start_ms:
+                n += reroll_range(cur, level, device_id, tz, start_ms, end)
+    return n
+
+
+def _roll(cur, level: str, device_id: str, tz: str, complete_until: int) -> int:
+    """roll ทุก bucket ที่ปิดแล้ว (จบก่อน complete_until) ต่อจาก watermark"""
+    row = cur.execute(
+        "SELECT done_until FROM rollup_state WHERE device_id=? AND level=? AND tz=?",
+        (device_id, level, tz),
+    ).fetchone()
+    if row:
+        # ทำ bucket สุดท้ายซ้ำอีกรอบ เผื่อนาทีที่มาช้า
+        start = bucket_start(level, row[0] - 1, tz)
+    else:
+        src, src_tz = _SOURCE[level]
+        first = cur.execute(
+            "SELECT MIN(ts_minute) FROM minutes WHERE device_id=?" if src == "minutes" else
+            "SELECT MIN(bucket_start) FROM hours WHERE device_id=? AND tz='UTC'",
+            (device_id,),
+        ).fetchone()[0]
+        if first is None:
+            return 0
+        start = bucket_start(level, first, tz)
+
+    # bucket สุดท้ายที่ปิดแล้ว
+    end = bucket_start(level, complete_until, tz)
+    if end <= start:
+        return 0
+    n = reroll_range(cur, level, device_id, tz, start, end)
+    cur.execute(
+        """
+        INSERT INTO rollup_state(device_id, level, tz, done_until) VALUES(?,?,?,?)
+        ON CONFLICT(device_id, level, tz) DO UPDATE SET done_until = excluded.done_until
+        """,
+        (device_id, level, tz, end),
+    )
+    return n
+
+
+def update_device(cur, device_id: str) -> Dict[str, int]:
+    """เรียกหลัง minute_aggregator สรุปนาทีเสร็จ คืนจำนวน bucket ที่เขียนต่อ level"""
+    ensure_rollup_tables(cur)
+    last = cur.execute(
+        "SELECT MAX(ts_minute) FROM minutes WHERE device_id=?", (device_id,)
+    ).fetchone()[0]
+    if last is None:
+        return {}
+    out = {"hours": _roll(cur, "hours", device_id, "UTC", int(last) + MINUTE_MS)}
+    hours_done = cur.execute(
+        "SELECT done_until FROM rollup_state WHERE device_id=? AND level='hours' AND tz='UTC'",
+        (device_id,),
+    ).fetchone()
+    if hours_done:
+        for tz in ROLLUP_TZS:
+            out[f"days:{tz}"] = _roll(cur, "days", device_id, tz, hours_done[0])
+    return out
+
+
+# ---------- query ----------
+def pick_resolution(span_ms: int, min_points: int = ROLLUP_MIN_POINTS) -> str:
+    if span_ms // 86_400_000 >= min_points:
+        return "days"
+    if span_ms // HOUR_MS >= min_points:
+        return "hours"
+    return "minutes"
+
+
+def series(cur, device_id: str, start_ms: int, end_ms: int,
+           resolution: Optional[str] = None, tz: str = ROLLUP_TZ) -> Tuple[str, List[Dict]]:
+    """
+    (resolution, rows) สำหรับกราฟช่วง [start_ms, end_ms)
+    rows: dict มี ts (ต้น bucket, ms) + STAT_COLS
+    """
+    res = resolution or pick_resolution(end_ms - start_ms)
+    if res == "minutes":
+        return res, _fetch(cur, "minutes", device_id, "UTC", start_ms, end_ms)
+
+    if res == "hours":
+        tz = "UTC"
+    ensure_rollup_tables(cur)
+    first = bucket_start(res, start_ms, tz)
+    rows = _fetch(cur, res, device_id, tz, first, end_ms)
+
+    # bucket ที่ยังไม่ถูก roll (ยังไม่ปิด หรือ aggregator ยังตามไม่ทัน) -> คิดสดจาก minutes
+    tail = bucket_end(res, rows[-1]["ts"], tz) if rows else first
+    if tail < end_ms:
+        for b, s in _group(res, tz, _fetch(cur, "minutes", device_id, "UTC", tail, end_ms)):
+            s["ts"] = b
+            rows.append(s)
+    return res, rows
@@ -0,0 +1,99 @@
+# sensor/samplers.py
+import time
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class SampleStore:
+    """
+    Shared latest-value + short ring buffer per metric (thread-safe).
+    Sampler threads publish() into it, the writer loop takes snapshot().
+    """
+
+    def __init__(self, ring_size: int = 64):
+        self.ring_size = int(ring_size)
+        self._lock = threading.Lock()
+        self._latest: Dict[str, Tuple[float, Any]] = {}     # metric -> (ts monotonic, value)
+        self._rings: Dict[str, deque] = {}
+        self._max_age: Dict[str, Optional[float]] = {}
+
+    def register(self, metric: str, max_age: Optional[float] = None):
+        with self._lock:
+            self._max_age[metric] = max_age
+            self._rings.setdefault(metric, deque(maxlen=self.ring_size))
+
+    def publish(self, metric: str, value: Any, ts: Optional[float] = None):
+        ts = time.monotonic() if ts is None else ts
+        with self._lock:
+            self._latest[metric] = (ts, value)
+            ring = self._rings.get(metric)
+            if ring is None:
+                ring = self._rings[metric] = deque(maxlen=self.ring_size)
+            ring.append((ts, value))
+
+    def latest(self, metric: str) -> Tuple[Optional[Any], Optional[float]]:
+        """(value, age_sec) — value เป็น None ถ้ายังไม่เคยอ่าน หรือเก่าเกิน max_age"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._latest.get(metric)
+            max_age = self._max_age.get(metric)
+        if item is None:
+            return None, None
+        ts, value = item
+        age = now - ts
+        if max_age is not None and age > max_age:
+            return None, age
+        return value, age
+
+    def snapshot(self, metrics: Optional[List[str]] = None) -> Dict[str, Any]:
+        names = metrics if metrics is not None else list(self._max_age)
+        return {m: self.latest(m)[0] for m in names}
+
+    def ring(self, metric: str) -> List[Tuple[float, Any]]:
+        with self._lock:
+            return list(self._rings.get(metric, ()))
+
+
+class Sampler(threading.Thread):
+    """
+    Read one sensor at its own rate and publish into a SampleStore.
+    Deadlines are absolute (monotonic) so the period doesn't drift with read
+    time; if a read overruns, the missed ticks are skipped, not queued.
+    """
+
+    def __init__(self, metric: str, read_fn: Callable[[], Any], period_sec: float,
+                 store: SampleStore, max_age: Optional[float] = None):
+        super().__init__(name=f"sampler-{metric}", daemon=True)
+        self.metric = metric
+        self.read_fn = read_fn
+        self.period = max(0.001, float(period_sec))
+        self.store = store
+        # ค่าเก่ากว่านี้ถือว่า stale (sensor ค้าง) -> snapshot ได้ None
+        self.max_age = max_age if max_age is not None else self.period * 3 + 1.0
+        self.reads = 0
+        self.errors = 0
+        self.overruns = 0
+        self._stop_evt = threading.Event()
+        store.register(metric, self.max_age)
+
+    def stop(self):
+        self._stop_evt.set()
+
+    def run(self):
+        next_t = time.monotonic()
+        while not self._stop_evt.is_set():
+            try:
+                v = self.read_fn()
+            except Exception:
+                v = None
+                self.errors += 1
+            self.reads += 1
+            self.store.publish(self.metric, v)
+
+            next_t += self.period
+            now = time.monotonic()
+            if next_t < now:
+                self.overruns += 1
+                next_t = now
+            self._stop_evt.wait(next_t - now)
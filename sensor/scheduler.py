@@ -0,0 +1,149 @@
+# sensor/scheduler.py
+import os
+import time
+import threading
+from typing import Callable, Dict, List, Optional
+
+SCHED_STATS_SEC = float(os.getenv("SCHED_STATS_SEC", "300"))   # พิมพ์สถิติทุกกี่วินาที (0=ปิด)
+
+# ขอบ bucket ของ histogram เวลาทำงานต่อ tick (ms)
+HIST_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class TaskStats:
+    def __init__(self):
+        self.ticks = 0
+        self.errors = 0
+        self.overruns = 0      # งานจบหลัง deadline ถัดไป
+        self.skipped = 0       # จำนวน tick ที่ข้ามไปเพราะงานช้า
+        self.late_sum_ms = 0.0
+        self.late_max_ms = 0.0
+        self.work_max_ms = 0.0
+        self.work_hist = [0] * (len(HIST_BOUNDS_MS) + 1)
+
+    def add_work(self, ms: float):
+        self.work_max_ms = max(self.work_max_ms, ms)
+        for i, b in enumerate(HIST_BOUNDS_MS):
+            if ms <= b:
+                self.work_hist[i] += 1
+                return
+        self.work_hist[-1] += 1
+
+    def work_pct_ms(self, pct: float) -> Optional[float]:
+        """ค่าประมาณ percentile ของเวลาทำงาน (ขอบบนของ bucket)"""
+        total = sum(self.work_hist)
+        if not total:
+            return None
+        need = total * pct / 100.0
+        acc = 0
+        for i, n in enumerate(self.work_hist):
+            acc += n
+            if acc >= need:
+                return float(HIST_BOUNDS_MS[i]) if i < len(HIST_BOUNDS_MS) else float("inf")
+        return None
+
+    def as_dict(self) -> dict:
+        return {
+            "ticks": self.ticks,
+            "errors": self.errors,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "late_avg_ms": round(self.late_sum_ms / self.ticks, 3) if self.ticks else None,
+            "late_max_ms": round(self.late_max_ms, 3),
+            "work_p50_ms": self.work_pct_ms(50),
+            "work_p95_ms": self.work_pct_ms(95),
+            "work_max_ms": round(self.work_max_ms, 3),
+            "work_hist": dict(zip([f"<={b}" for b in HIST_BOUNDS_MS] + ["inf"], self.work_hist)),
+        }
+
+
+class _Task:
+    def __init__(self, name: str, period: float, fn: Callable[[float], None], next_wall: float, order: int):
+        self.name = name
+        self.period = period
+        self.fn = fn
+        self.next_wall = next_wall
+        self.order = order
+        self.stats = TaskStats()
+
+
+class DeadlineScheduler:
+    """
+    Runs periodic tasks on absolute deadlines.
+
+    Deadlines sit on a wall-clock grid (multiples of the period, plus an
+    optional offset) and are waited for with the monotonic clock, so the
+    period never stretches by the task's own work time. Each task gets the
+    grid time of its tick (epoch sec) — use it as the sample timestamp.
+    A tick that finishes after the next deadline counts as an overrun; any
+    deadlines already missed are skipped (counted, not replayed).
+    """
+
+    def __init__(self, name: str = "sched", stats_every: float = SCHED_STATS_SEC):
+        self.name = name
+        self._tasks: List[_Task] = []
+        self._wall0 = time.time()
+        self._mono0 = time.monotonic()
+        self._stop = threading.Event()
+        if stats_every and stats_every > 0:
+            self.every("stats", stats_every, lambda _ts: self.print_stats())
+
+    def every(self, name: str, period_sec: float, fn: Callable[[float], None],
+              offset_sec: float = 0.0):
+        period = max(0.001, float(period_sec))
+        now = time.time()
+        # deadline แรก = ช่องถัดไปบนกริดของ period นี้
+        k = int((now - offset_sec) // period) + 1
+        t = _Task(name, period, fn, k * period + offset_sec, len(self._tasks))
+        self._tasks.append(t)
+        return t
+
+    def stop(self):
+        self._stop.set()
+
+    def _mono(self, wall: float) -> float:
+        return self._mono0 + (wall - self._wall0)
+
+    def run(self, stop: Optional[threading.Event] = None):
+        stop = stop or self._stop
+        while not stop.is_set() and self._tasks:
+            task = min(self._tasks, key=lambda x: (x.next_wall, x.order))
+            delay = self._mono(task.next_wall) - time.monotonic()
+            if delay > 0 and stop.wait(delay):
+                break
+
+            start = time.monotonic()
+            late_ms = max(0.0, (start - self._mono(task.next_wall)) * 1000.0)
+            try:
+                task.fn(task.next_wall)
+            except Exception as e:
+                task.stats.errors += 1
+                print(f"[{self.name}] task {task.name} error: {e}", flush=True)
+            end = time.monotonic()
+
+            st = task.stats
+            st.ticks += 1
+            st.late_sum_ms += late_ms
+            st.late_max_ms = max(st.late_max_ms, late_ms)
+            st.add_work((end - start) * 1000.0)
+
+            task.next_wall += task.period
+            behind = end - self._mono(task.next_wall)
+            if behind > 0:
+                st.overruns += 1
+                missed = int(behind // task.period) + 1
+                st.skipped += missed
+                task.next_wall += missed * task.period
+
+    def stats(self) -> Dict[str, dict]:
+        return {t.name: t.stats.as_dict() for t in self._tasks if t.name != "stats"}
+
+    def print_stats(self):
+        for name, s in self.stats().items():
+            print(
+                f"[{self.name}] {name}: ticks={s['ticks']} late_avg={s['late_avg_ms']}ms "
+                f"late_max={s['late_max_ms']}ms overruns={s['overruns']} skipped={s['skipped']} "
+                f"work_p50={s['work_p50_ms']}ms p95={s['work_p95_ms']}ms max={s['work_max_ms']}ms "
+                f"errors={s['errors']}",
+                flush=True,
+            )
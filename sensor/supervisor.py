@@ -0,0 +1,422 @@
+# sensor/supervisor.py
+"""
+Whole local pipeline in one process: collector -> aggregator -> uploader,
+collector -> alerts, as cooperating asyncio stages.
+
+  collector   sampler threads (collector_local.DeviceSensors) + a deadline
+              tick; each row goes to ReadingsWriter (SQLite checkpoint)
+              and is handed to the next stages through in-memory queues
+  aggregator  MinuteTailer fed from the queue (no polling of readings);
+              closed minutes -> minutes + rollups + outbox in one
+              transaction, then wakes the uploader. Changed latest
+              values go to the outbox too (SUP_LATEST_SEC)
+  uploader    minute_uploader.run_once() as soon as the aggregator queued
+              something (SUP_UPLOAD_DEBOUNCE_SEC to batch), at least every
+              SUP_UPLOAD_MAX_SEC; outbox cursor / failover as before
+  alerts      alert_worker.evaluate() on the newest row of every device;
+              alerts.Checker too with SUP_LEGACY_ALERTS=1 (replaces the
+              HTTP polling of alerts.py)
+
+Every stage still checkpoints to SQLite (readings, minutes, outbox,
+alert_state), so a restart resumes where it left off; it just no longer
+re-reads what the previous stage wrote.
+
+Restart policy: a stage that raises, or that stops beating for longer
+than its stall limit (watchdog), is cancelled and started again after an
+exponential backoff (1s .. SUP_BACKOFF_MAX_SEC); the other stages keep
+running.
+
+Backpressure: queues are bounded (SUP_QUEUE_MAX). When the aggregator
+falls behind, the collector stops handing it rows and marks those minutes
+"spilled" — they are summarised from SQLite when they close. The alert
+queue keeps only the newest rows.
+
+Health of every stage (state, restarts, last error, last beat, processed,
+lag) and the queue depths are written to SUP_HEALTH_PATH every
+SUP_HEALTH_SEC and printed every SUP_REPORT_SEC.
+
+Run:  python -m sensor.supervisor        (SUP_STAGES=collector,aggregator,uploader,alerts)
+Cleanup jobs stay in sensor/worker.py:  WORKER_JOBS=cleanup_local,cleanup
+"""
+import os
+import json
+import time
+import signal
+import asyncio
+import sqlite3
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sensor.local_db import connect, ensure_readings_table, ensure_minutes_table
+from sensor.devices import load_devices
+from sensor.readings_writer import ReadingsWriter, WRITE_BATCH_ROWS, WRITE_BATCH_MS
+from sensor.samplers import SampleStore
+from sensor.latest_state import LatestState
+from sensor import collector_local, outbox, rollups
+from sensor import minute_aggregator as agg
+
+DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+INTERVAL_SEC = collector_local.INTERVAL_SEC
+SUP_STAGES = [s.strip() for s in os.getenv("SUP_STAGES", "collector,aggregator,uploader,alerts").split(",") if s.strip()]
+SUP_QUEUE_MAX = int(os.getenv("SUP_QUEUE_MAX", "600"))                 # แถวค้างในคิวได้เท่าไร
+SUP_UPLOAD_DEBOUNCE_SEC = float(os.getenv("SUP_UPLOAD_DEBOUNCE_SEC", "1.0"))
+SUP_UPLOAD_MAX_SEC = float(os.getenv("SUP_UPLOAD_MAX_SEC", "60"))       # ไม่มีอะไรปลุกก็ drain ทุกเท่านี้
+SUP_LATEST_SEC = float(os.getenv("SUP_LATEST_SEC", "30"))               # latest -> outbox ไม่ถี่กว่านี้ (0 = ปิด)
+SUP_LEGACY_ALERTS = os.getenv("SUP_LEGACY_ALERTS", "0") == "1"
+SUP_BACKOFF_MAX_SEC = float(os.getenv("SUP_BACKOFF_MAX_SEC", "60"))
+SUP_HEALTH_PATH = os.getenv("SUP_HEALTH_PATH", "/tmp/tempmon-supervisor.json")
+SUP_HEALTH_SEC = float(os.getenv("SUP_HEALTH_SEC", "5"))
+SUP_REPORT_SEC = float(os.getenv("SUP_REPORT_SEC", "300"))
+
+# ไม่มี beat นานเกินนี้ = ค้าง -> watchdog สั่ง restart
+STALL_SEC = {
+    "collector": max(10.0, INTERVAL_SEC * 10),
+    "aggregator": 120.0,
+    "uploader": SUP_UPLOAD_MAX_SEC + 1800.0,   # resync / backoff ของ outbox ใช้เวลานานได้
+    "alerts": 300.0,                           # Telegram / push timeout หลายรายการ
+}
+
+
+class StageHealth:
+    def __init__(self, name: str, stall_sec: float):
+        self.name = name
+        self.stall_sec = stall_sec
+        self.state = "starting"      # starting | running | backoff | stopped
+        self.restarts = 0
+        self.last_error: Optional[str] = None
+        self.beat_at = time.monotonic()
+        self.processed = 0
+        self.lag_ms: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None   # attempt ที่กำลังรัน (watchdog cancel ตัวนี้)
+
+    def beat(self, n: int = 0, lag_ms: Optional[float] = None):
+        self.beat_at = time.monotonic()
+        self.processed += n
+        if lag_ms is not None:
+            self.lag_ms = round(lag_ms, 1)
+
+    def stalled(self, now: float) -> bool:
+        return self.state == "running" and now - self.beat_at > self.stall_sec
+
+    def info(self, now: float) -> Dict:
+        return {
+            "state": self.state, "restarts": self.restarts, "last_error": self.last_error,
+            "beat_age_s": round(now - self.beat_at, 1), "processed": self.processed, "lag_ms": self.lag_ms,
+        }
+
+
+class Supervisor:
+    def __init__(self, stages: List[str] = SUP_STAGES, db_path: str = DB):
+        unknown = [s for s in stages if s not in STALL_SEC]
+        if unknown:
+            raise ValueError(f"unknown stage(s): {unknown} (known: {sorted(STALL_SEC)})")
+        self.stages = stages
+        self.db_path = db_path
+        self.devices = load_devices()
+        self.health = {s: StageHealth(s, STALL_SEC[s]) for s in stages}
+        self.writer: Optional[ReadingsWriter] = None   # ของ collector; aggregator flush ก่อนอ่าน DB
+        self.spill_keys = set()                        # (device_id, ts_ms) ที่ไม่ได้เข้าคิว aggregator
+        self.shed = {"aggregator": 0, "alerts": 0}
+        self.stopping = False
+        # สร้างใน run() (ต้องอยู่ใน event loop)
+        self.agg_q: Optional[asyncio.Queue] = None
+        self.alert_q: Optional[asyncio.Queue] = None
+        self.upload_evt: Optional[asyncio.Event] = None
+        self.stop_evt: Optional[asyncio.Event] = None
+
+    # ---------- restart policy ----------
+    async def _supervise(self, name: str, fn: Callable[[StageHealth], Awaitable[None]]):
+        h = self.health[name]
+        backoff = 1.0
+        while not self.stopping:
+            h.state = "running"
+            h.beat()
+            started = time.monotonic()
+            h.task = asyncio.ensure_future(fn(h))
+            try:
+                await asyncio.wait({h.task})
+            except asyncio.CancelledError:
+                h.task.cancel()          # supervisor หยุด -> ให้ stage ปิด resource ของตัวเอง
+                await asyncio.wait({h.task})
+                raise
+            if self.stopping:
+                break
+            if h.task.cancelled():
+                h.last_error = f"stalled > {h.stall_sec:.0f}s"
+            elif h.task.exception() is not None:
+                e = h.task.exception()
+                h.last_error = f"{type(e).__name__}: {e}"[:200]
+            else:
+                h.last_error = "stage returned"
+            h.restarts += 1
+            if time.monotonic() - started > 300:
+                backoff = 1.0   # รันได้นานแล้วค่อยล้ม -> เริ่ม backoff ใหม่
+            h.state = "backoff"
+            print(f"[supervisor] {name} failed ({h.last_error}); restart in {backoff:.0f}s", flush=True)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, SUP_BACKOFF_MAX_SEC)
+        h.state = "stopped"
+
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(min(5.0, min(h.stall_sec for h in self.health.values())))
+            now = time.monotonic()
+            for h in self.health.values():
+                if h.stalled(now) and h.task is not None and not h.task.done():
+                    print(f"[supervisor] {h.name} no progress for {now - h.beat_at:.0f}s; restarting", flush=True)
+                    h.task.cancel()
+
+    # ---------- health ----------
+    def snapshot(self) -> Dict:
+        now = time.monotonic()
+        w = self.writer
+        return {
+            "ts": time.time(),
+            "stages": {n: h.info(now) for n, h in self.health.items()},
+            "queues": {"aggregator": self.agg_q.qsize() if self.agg_q else 0,
+                       "alerts": self.alert_q.qsize() if self.alert_q else 0},
+            "shed": dict(self.shed),
+            "writer": dict(w.stats, pending=w.pending()) if w else None,
+        }
+
+    async def _health(self):
+        last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(SUP_HEALTH_SEC)
+            snap = self.snapshot()
+            try:
+                tmp = SUP_HEALTH_PATH + ".tmp"
+                with open(tmp, "w") as f:
+                    json.dump(snap, f)
+                os.replace(tmp, SUP_HEALTH_PATH)
+            except Exception:
+                pass
+            if SUP_REPORT_SEC > 0 and time.monotonic() - last_report >= SUP_REPORT_SEC:
+                last_report = time.monotonic()
+                for n, s in snap["stages"].items():
+                    print(f"[supervisor] {n}: {s}", flush=True)
+                print(f"[supervisor] queues={snap['queues']} shed={snap['shed']}", flush=True)
+
+    # ---------- handoff ----------
+    def _handoff(self, row: tuple):
+        if self.agg_q is not None and self.health.get("aggregator") is not None:
+            try:
+                self.agg_q.put_nowait(row)
+            except asyncio.QueueFull:
+                # aggregator ตามไม่ทัน: แถวอยู่ใน SQLite แล้ว -> นาทีนั้นสรุปจาก DB
+                self.spill_keys.add((row[0], row[1]))
+                self.shed["aggregator"] += 1
+        if self.alert_q is not None and self.health.get("alerts") is not None:
+            if self.alert_q.full():
+                self.alert_q.get_nowait()   # alerts สนใจแค่ค่าใหม่สุด ทิ้งตัวเก่าสุด
+                self.shed["alerts"] += 1
+            self.alert_q.put_nowait(row)
+
+    async def _drain(self, q: asyncio.Queue, timeout: float, limit: int = 5000) -> List[tuple]:
+        """รอแถวแรกไม่เกิน timeout แล้วกวาดที่ค้างในคิวทั้งหมด"""
+        try:
+            items = [await asyncio.wait_for(q.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while len(items) < limit:
+            try:
+                items.append(q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return items
+
+    # ---------- stages ----------
+    async def collector(self, h: StageHealth):
+        conn = connect(self.db_path, isolation_level=None, check_same_thread=False)
+        c = conn.cursor()
+        ensure_readings_table(c)
+        c.execute("PRAGMA synchronous=NORMAL")
+        writer = ReadingsWriter(conn, max_rows=max(WRITE_BATCH_ROWS, len(self.devices)), max_ms=WRITE_BATCH_MS)
+        store = SampleStore()
+        pollers = collector_local.open_pollers(self.devices)
+        presses = [collector_local.DeviceSensors(d, store, pollers, i) for i, d in enumerate(self.devices)]
+        shm = collector_local.open_shm()
+        self.writer = writer
+        try:
+            for p in presses:
+                p.start()
+            # tick บนกริดเวลาเหมือน DeadlineScheduler -> ts_ms ลงตรงช่อง INTERVAL_SEC
+            next_wall = (time.time() // INTERVAL_SEC + 1) * INTERVAL_SEC
+            while True:
+                await asyncio.sleep(max(0.0, next_wall - time.time()))
+                ts_ms = int(round(next_wall * 1000))
+                for p in presses:
+                    row = p.row(ts_ms)
+                    writer.add(row)        # checkpoint (group commit)
+                    collector_local.publish_row(shm, row)   # latest ใน /dev/shm (views อ่าน)
+                    self._handoff(row)     # stage ถัดไปได้ทันที ไม่ต้องรอ/อ่าน DB
+                h.beat(len(presses), lag_ms=(time.time() - next_wall) * 1000.0)
+                next_wall += INTERVAL_SEC
+                if next_wall < time.time():   # ช้าเกินหนึ่งช่อง: ข้าม ไม่ไล่ย้อน
+                    next_wall = (time.time() // INTERVAL_SEC + 1) * INTERVAL_SEC
+        finally:
+            self.writer = None
+            for p in presses:
+                p.close()
+            for poller in pollers.values():
+                poller.stop()
+            await asyncio.to_thread(writer.close)
+            conn.close()
+
+    async def aggregator(self, h: StageHealth):
+        con = sqlite3.connect(self.db_path, check_same_thread=False)
+        cur = con.cursor()
+        latest = {d["device_id"]: LatestState(d["device_id"], min_interval=SUP_LATEST_SEC)
+                  for d in self.devices} if SUP_LATEST_SEC > 0 else {}
+
+        def recover():
+            # เหมือน run_daemon: นาทีที่ขาด (เครื่องดับ / stage restart) สรุปจาก DB ก่อน
+            ensure_readings_table(cur)
+            ensure_minutes_table(cur)
+            con.commit()
+            if self.writer is not None:
+                self.writer.flush()
+            now_ms = int(time.time() * 1000)
+            target = agg.floor_to_minute_utc(now_ms) - 60000
+            known = {r[0] for r in cur.execute("SELECT DISTINCT device_id FROM minutes")}
+            dids = sorted({d["device_id"] for d in self.devices} | known)
+            for did in dids:
+                agg.backfill_device(cur, did, target)
+                rollups.update_device(cur, did)
+            agg.queue_pending_minutes(cur)
+            con.commit()
+            tailer = agg.MinuteTailer(cur)
+            tailer.start(now_ms)
+            for did in dids:
+                tailer.emitted_until[did] = target + 60000
+            # แถวที่ seed จาก DB แล้ว อาจยังอยู่ในคิว -> ข้าม (ts ต่อเครื่องเพิ่มขึ้นเสมอ)
+            seeded = {}
+            for (did, _), rows in tailer.acc.items():
+                seeded[did] = max([seeded.get(did, 0)] + [r[0] for r in rows])
+            return tailer, seeded
+
+        def work(tailer, seeded, rows, spill):
+            for did, ts, t, lvl, cyc in rows:
+                if ts > seeded.get(did, 0):
+                    tailer.feed(did, ts, t, lvl, cyc)
+            for did, ts in spill:
+                tailer.spill(did, ts)
+            if (tailer.late or tailer.spilled) and self.writer is not None:
+                self.writer.flush()   # จะสรุปจาก DB -> แถวต้องลง DB ก่อน
+            emitted = tailer.emit(int(time.time() * 1000))
+            newest = {}
+            for r in rows:
+                newest[r[0]] = r
+            items = []
+            for did, (_, ts, t, lvl, cyc) in newest.items():
+                st = latest.get(did)
+                it = st and st.item({"temp": t, "level": lvl, "cycles": cyc}, now=ts / 1000.0)
+                if it:
+                    items.append(it)
+            if items:
+                outbox.enqueue_many(cur, items)
+                con.commit()
+            return emitted, len(items)
+
+        try:
+            tailer, seeded = await asyncio.to_thread(recover)
+            print(f"[supervisor] aggregator ready open={len(tailer.acc)}", flush=True)
+            while True:
+                rows = await self._drain(self.agg_q, agg.AGG_POLL_SEC)
+                spill, self.spill_keys = self.spill_keys, set()
+                emitted, queued = await asyncio.to_thread(work, tailer, seeded, rows, spill)
+                if (emitted or queued) and self.upload_evt is not None:
+                    self.upload_evt.set()
+                h.beat(len(rows), lag_ms=tailer.stats["lag_ms_max"] if emitted else None)
+                if emitted:
+                    tailer.stats["lag_ms_max"] = 0.0
+        finally:
+            con.close()
+
+    async def uploader(self, h: StageHealth):
+        from sensor import minute_uploader
+        con = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.upload_evt.wait(), SUP_UPLOAD_MAX_SEC)
+                    await asyncio.sleep(SUP_UPLOAD_DEBOUNCE_SEC)   # รวมหลายนาที / latest เป็น batch เดียว
+                except asyncio.TimeoutError:
+                    pass
+                self.upload_evt.clear()
+                h.beat()
+                t0 = time.perf_counter()
+                stats = await asyncio.to_thread(minute_uploader.run_once, con)
+                h.beat(stats.get("sent", 0), lag_ms=(time.perf_counter() - t0) * 1000.0)
+        finally:
+            con.close()
+
+    async def alerts(self, h: StageHealth):
+        from sensor import alert_worker
+        legacy = {}
+        if SUP_LEGACY_ALERTS:
+            from sensor import alerts as legacy_alerts
+            legacy_alerts.ensure_db()
+            legacy = {d["device_id"]: legacy_alerts.Checker(d["device_id"]) for d in self.devices}
+        con = sqlite3.connect(self.db_path, check_same_thread=False)
+        tokens, tokens_at = [], 0.0
+
+        def work(newest, tokens):
+            by_dev = {did: {"ts_ms": ts, "temp": t, "current": None, "level": lvl, "cycles": cyc}
+                      for did, (_, ts, t, lvl, cyc) in newest.items()}
+            alert_worker.evaluate(con, by_dev, tokens=tokens, log=False)
+            for did, latest in by_dev.items():
+                if did in legacy:
+                    legacy[did].check(latest)
+
+        try:
+            await asyncio.to_thread(lambda: (alert_worker.ensure_tables(con.cursor()), con.commit()))
+            while True:
+                rows = await self._drain(self.alert_q, 30.0)
+                h.beat()
+                if not rows:
+                    continue
+                if time.monotonic() - tokens_at > 60:
+                    tokens, tokens_at = await asyncio.to_thread(alert_worker.push_tokens), time.monotonic()
+                newest = {}
+                for r in rows:
+                    newest[r[0]] = r
+                await asyncio.to_thread(work, newest, tokens)
+                oldest = min(r[1] for r in newest.values())
+                h.beat(len(newest), lag_ms=time.time() * 1000.0 - oldest)
+        finally:
+            con.close()
+
+    # ---------- main ----------
+    async def run(self):
+        self.agg_q = asyncio.Queue(SUP_QUEUE_MAX) if "aggregator" in self.stages else None
+        self.alert_q = asyncio.Queue(SUP_QUEUE_MAX) if "alerts" in self.stages else None
+        self.upload_evt = asyncio.Event()
+        self.stop_evt = asyncio.Event()
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop_evt.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        print(f"[supervisor] stages={self.stages} devices={[d['device_id'] for d in self.devices]} "
+              f"db={self.db_path} interval={INTERVAL_SEC}s", flush=True)
+        tasks = [asyncio.ensure_future(self._supervise(s, getattr(self, s))) for s in self.stages]
+        helpers = [asyncio.ensure_future(self._watchdog()), asyncio.ensure_future(self._health())]
+        try:
+            await self.stop_evt.wait()
+        finally:
+            self.stopping = True
+            for t in helpers + tasks:
+                t.cancel()
+            await asyncio.gather(*helpers, *tasks, return_exceptions=True)
+            print(f"[supervisor] stopped {json.dumps(self.snapshot()['stages'])}", flush=True)
+
+
+def main():
+    asyncio.run(Supervisor().run())
+
+
+if __name__ == "__main__":
+    main()
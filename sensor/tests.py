@@ -0,0 +1,270 @@
+# sensor/tests.py
+"""
+Tests for the local storage layer — SQLite, the outbox, the shared-memory
+latest segment and the latest-document write policy (no Django / Firestore
+needed; google.api_core exceptions are used when installed).
+
+Run:  python -m unittest sensor.tests
+"""
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from sensor import archive, cleanup_old_data, latest_shm, outbox, partitions, reaggregate
+from sensor import minute_aggregator as agg
+from sensor import minute_uploader as uploader
+from sensor.latest_state import LatestState
+from sensor.local_db import ensure_readings_table, ensure_minutes_table
+
+DAY1 = 1_767_225_600_000          # 2026-01-01 00:00 UTC
+DAY2 = DAY1 + partitions.DAY_MS
+
+
+class ReadingsViewAcrossMidnight(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:")
+        self.cur = self.con.cursor()
+
+    def tearDown(self):
+        self.con.close()
+
+    def _ensure_at(self, ts_ms: int):
+        with mock.patch("sensor.local_db.time.time", return_value=ts_ms / 1000.0):
+            ensure_readings_table(self.cur, "pi5-001")
+
+    def test_rows_of_new_day_visible_through_view(self):
+        self._ensure_at(DAY1 + 3_600_000)
+        partitions.insert_rows(self.cur, [("pi5-001", DAY1 + 3_600_000, 30.0, 1.0, 1)])
+        # process เริ่มใหม่หลังเที่ยงคืน: ตารางของวันที่ 2 ถูกสร้างโดย ensure_readings_table
+        self._ensure_at(DAY2 + 60_000)
+        partitions.insert_rows(self.cur, [("pi5-001", DAY2 + 60_000, 31.0, 1.0, 2)])
+
+        self.assertEqual(partitions.view_parts(self.cur),
+                         [partitions.part_name(DAY1), partitions.part_name(DAY2)])
+        self.assertEqual(self.cur.execute("SELECT count(*) FROM readings").fetchone()[0], 2)
+        self.assertEqual(partitions.latest(self.cur, "pi5-001")[0], DAY2 + 60_000)
+
+    def test_writer_crossing_midnight(self):
+        self._ensure_at(DAY1 + 86_000_000)
+        partitions.insert_rows(self.cur, [
+            ("pi5-001", DAY2 - 1_000, 30.0, 1.0, 1),
+            ("pi5-001", DAY2 + 1_000, 30.5, 1.0, 2),
+        ])
+        rows = self.cur.execute("SELECT ts_ms FROM readings ORDER BY ts_ms").fetchall()
+        self.assertEqual(rows, [(DAY2 - 1_000,), (DAY2 + 1_000,)])
+
+    def test_ids_repeat_across_partitions(self):
+        self._ensure_at(DAY1)
+        partitions.insert_rows(self.cur, [("pi5-001", DAY1, 30.0, 1.0, 1),
+                                          ("pi5-001", DAY2, 30.0, 1.0, 2)])
+        rows = self.cur.execute("SELECT part, id FROM readings ORDER BY ts_ms").fetchall()
+        self.assertEqual([i for _, i in rows], [1, 1])
+        self.assertEqual(len(set(rows)), 2)
+
+    def test_sync_view_is_noop_when_current(self):
+        self._ensure_at(DAY1)
+        self.assertFalse(partitions.sync_view(self.cur))
+
+
+class LateRowsReupload(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:")
+        self.cur = self.con.cursor()
+        with mock.patch("sensor.local_db.time.time", return_value=DAY1 / 1000.0):
+            ensure_readings_table(self.cur, "pi5-001")
+        ensure_minutes_table(self.cur)
+        self.con.commit()
+
+    def tearDown(self):
+        self.con.close()
+
+    def _minute(self, m: int):
+        return self.cur.execute(
+            "SELECT n_samples, uploaded FROM minutes WHERE device_id='pi5-001' AND ts_minute=?", (m,)
+        ).fetchone()
+
+    def test_late_row_requeues_minute(self):
+        m = DAY1 + 600_000
+        tailer = agg.MinuteTailer(self.cur, grace_ms=0)
+        tailer.start(m)
+        partitions.insert_rows(self.cur, [("pi5-001", m + 1_000, 30.0, 1.0, 1)])
+        self.con.commit()
+        tailer.poll(m + 60_000)
+        self.assertEqual(self._minute(m), (1, 1))   # เข้า outbox แล้ว
+
+        # แถวท้ายนาทีที่ writer เพิ่ง commit หลัง emit
+        partitions.insert_rows(self.cur, [("pi5-001", m + 59_000, 30.5, 1.0, 2)])
+        self.con.commit()
+        with mock.patch.object(agg, "queue_pending_minutes"):
+            tailer.poll(m + 61_000)
+        self.assertEqual(self._minute(m), (2, 0))   # ค่าใหม่ -> รอเข้า outbox อีกรอบ
+
+    def test_unchanged_recompute_keeps_uploaded(self):
+        m = DAY1 + 600_000
+        partitions.insert_rows(self.cur, [("pi5-001", m + 1_000, 30.0, 1.0, 1)])
+        agg.compute_and_upsert_one_minute(self.cur, m, "pi5-001")
+        self.cur.execute("UPDATE minutes SET uploaded=1")
+        agg.compute_and_upsert_one_minute(self.cur, m, "pi5-001", reupload=True)
+        self.assertEqual(self._minute(m), (1, 1))
+
+
+class RetentionKeepsArchive(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:", isolation_level=None)
+        self.cur = self.con.cursor()
+        ensure_readings_table(self.cur, "pi5-001")
+        ensure_minutes_table(self.cur)
+        self.old = partitions.day_start(int(time.time() * 1000)) - 30 * partitions.DAY_MS
+        # 3 ชั่วโมงที่ยังไม่เคยผ่าน sensor.archive (ไม่มี minutes ด้วย)
+        self.rows = [("pi5-001", self.old + k * 600_000, 30.0 + k / 10, 1.0, k) for k in range(18)]
+        partitions.insert_rows(self.cur, self.rows)
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_unarchived_hours_are_archived_before_drop(self):
+        with mock.patch.object(cleanup_old_data.budget, "prune"):
+            dropped = cleanup_old_data.run_once(self.con)
+        self.assertEqual(dropped, [partitions.part_name(self.old)])
+        back = list(archive.read_range(self.cur, "pi5-001", self.old, self.old + partitions.DAY_MS))
+        self.assertEqual(back, [r[1:] for r in self.rows])
+
+    def test_reaggregate_reads_archive_after_drop(self):
+        end = self.old + partitions.DAY_MS
+        before = agg.compute_range(self.cur, "pi5-001", self.old, end)
+        with mock.patch.object(cleanup_old_data.budget, "prune"):
+            cleanup_old_data.run_once(self.con)
+        self.assertEqual(agg.compute_range(self.cur, "pi5-001", self.old, end), [])
+        self.assertEqual(reaggregate.compute_archived(self.cur, None, self.old, end), before)
+
+        days = reaggregate.archived_days(self.cur, "pi5-001", end)
+        self.assertEqual(days, {self.old})
+        self.assertEqual(reaggregate.missing_ranges(days, self.old - partitions.DAY_MS, end + 3_600_000),
+                         [(self.old - partitions.DAY_MS, self.old), (end, end + 3_600_000)])
+
+
+class LatestShmSingleWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "latest")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_second_writer_of_a_device_is_refused(self):
+        a, b = latest_shm.Publisher(self.path, 4), latest_shm.Publisher(self.path, 4)
+        try:
+            self.assertTrue(a.publish("pi5-001", 1000, temp=30.0))
+            self.assertFalse(b.publish("pi5-001", 2000, temp=99.0))   # เช่น collector.py DEMO=1
+            self.assertTrue(b.publish("pi5-002", 2000, temp=40.0))
+            snap = latest_shm.Reader(self.path).get("pi5-001", max_age=None)
+            self.assertEqual((snap["ts_ms"], snap["temp"]), (1000, 30.0))
+            self.assertNotEqual(a._index["pi5-001"], b._index["pi5-002"])
+        finally:
+            a.close()
+            b.close()
+
+    def test_owner_released_on_close(self):
+        a = latest_shm.Publisher(self.path, 4)
+        a.publish("pi5-001", 1000, temp=30.0)
+        a.close()
+        b = latest_shm.Publisher(self.path, 4)
+        try:
+            self.assertTrue(b.publish("pi5-001", 2000, temp=31.0))
+            self.assertEqual(latest_shm.Reader(self.path).get("pi5-001", max_age=None)["ts_ms"], 2000)
+        finally:
+            b.close()
+
+
+class LatestHeartbeat(unittest.TestCase):
+    def test_steady_metric_is_rewritten_after_heartbeat(self):
+        st = LatestState("pi5-001", heartbeat=300)
+        st.commit(st.changes({"temp": 30.0, "level": 10.0}, 0.0), 0.0)
+        self.assertEqual(st.changes({"temp": 30.1, "level": 10.0}, 60.0), {})
+        st.commit(st.changes({"temp": 31.0, "level": 10.0}, 200.0), 200.0)   # temp ขยับ level นิ่ง
+        self.assertEqual(st.changes({"temp": 31.0, "level": 10.0}, 300.0), {"level": 10.0})
+
+
+class MinutesHourlyPaging(unittest.TestCase):
+    @staticmethod
+    def _doc(n: int = 60):
+        return {"m": {f"{mm:02d}": [30.0] * 10 for mm in range(n)}}
+
+    def _pages(self, docs, limit):
+        start, end = DAY1, DAY1 + 12 * 3_600_000
+        doc_limit = -(-limit // 60) + 1
+        got = []
+        while True:
+            # จำลอง _hour_docs: ตั้งแต่ชั่วโมงของ start ไม่เกิน doc_limit doc
+            first = start - start % 3_600_000
+            page_docs = [(h, d) for h, d in docs
+                         if DAY1 + int(h[8:]) * 3_600_000 >= first][:doc_limit]
+            mins, nxt = uploader.hour_docs_page(page_docs, start, end, limit, doc_limit)
+            got += [m["t_ms"] for m in mins]
+            if nxt is None:
+                return got
+            start = nxt + 60_000
+
+    def test_empty_hours_do_not_end_paging(self):
+        # ชั่วโมง 0-1 มีข้อมูลบางส่วน, 2-8 ว่าง (ไม่มี doc), 9 มีเต็มชั่วโมง
+        docs = [(f"20260101{h:02d}", self._doc(n)) for h, n in ((0, 5), (1, 5), (9, 60))]
+        got = self._pages(docs, limit=60)
+        self.assertEqual(len(got), 70)
+        self.assertEqual(got[-1], DAY1 + 9 * 3_600_000 + 59 * 60_000)
+        self.assertEqual(got, sorted(set(got)))
+
+try:
+    from google.api_core.exceptions import InvalidArgument, PermissionDenied
+except Exception:
+    class PermissionDenied(Exception):
+        pass
+    InvalidArgument = ValueError
+
+
+class OutboxDeadLetter(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:")
+        self.cur = self.con.cursor()
+        outbox.ensure_outbox_tables(self.cur)
+        outbox.enqueue_many(self.cur, [("minutes", f"devices/pi5-001/minutes/{i}", {"v": i})
+                                       for i in range(8)])
+        self.con.commit()
+        self.budget = mock.patch.object(outbox.budget, "try_spend", return_value=True)
+        self.budget.start()
+
+    def tearDown(self):
+        self.budget.stop()
+        self.con.close()
+
+    def _dead(self):
+        return self.cur.execute("SELECT doc_path FROM outbox_dead").fetchall()
+
+    def test_permission_denied_stops_without_dead_letter(self):
+        calls = []
+
+        def commit(fs, rows):
+            calls.append(len(rows))
+            raise PermissionDenied("Missing or insufficient permissions.")
+
+        stats = outbox.drain(None, self.con, commit=commit)
+        self.assertEqual(self._dead(), [])
+        self.assertEqual(outbox.get_cursor(self.cur), 0)
+        self.assertEqual(calls, [8])                       # ไม่ผ่าครึ่ง ไม่ลองซ้ำ
+        self.assertIsInstance(stats["error"], PermissionDenied)
+
+    def test_invalid_document_is_dead_lettered(self):
+        def commit(fs, rows):
+            if any(r[2].endswith("/5") for r in rows):
+                raise InvalidArgument("payload too large")
+
+        stats = outbox.drain(None, self.con, commit=commit)
+        self.assertEqual(self._dead(), [("devices/pi5-001/minutes/5",)])
+        self.assertEqual((stats["sent"], stats["dead"]), (7, 1))
+        self.assertEqual(outbox.get_cursor(self.cur), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,16 +6,20 @@ from .views import expo_token_api, alerts_list_api
 urlpatterns = [
     path("", views.index, name="index"),
 
-    # --- Sensors ---
+    # --- Sensors ---  (ทุก endpoint รับ ?device=<id> สำหรับ gateway หลายเครื่อง)
+    path("api/devices", views.devices_api, name="devices_api"),
     path("api/temp", views.temp_api, name="temp_api"),
     path("api/latest", views.latest_local, name="latest_local"),        # local SQLite ล่าสุด
     path("api/latest/fs", views.latest_api, name="latest_api"),         # Firestore ล่าสุด
     path("api/minutes", views.minutes_api, name="minutes_api"),
     path("api/history", views.history_api, name="history_api"),
+    path("api/history/local", views.history_local, name="history_local"),  # minutes/hours/days จาก SQLite
+    path("api/history/raw", views.history_raw, name="history_raw"),        # raw samples (archive + partition)
 
     # --- Firebase toggle ---
     path("api/firebase/active", views.firebase_active_get, name="fb_active_get"),
     path("api/firebase/active/set", views.firebase_active_set, name="fb_active_set"),
+    path("api/budget", views.budget_api, name="budget_api"),                # งบ Firestore วันนี้
 
     # --- Alerts ---
     path("api/alerts", alerts_list_api, name="alerts_list"),
@@ -7,11 +7,14 @@ from typing import Any, Dict, List, Optional
 
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render
-from django.http import JsonResponse, HttpRequest
+from django.http import JsonResponse, HttpRequest, HttpResponse
 from django.views.decorators.http import require_GET
 from django.views.decorators.cache import never_cache
 
-from .firebase_admin_init import get_fs, get_active
+from .firebase_admin_init import get_fs, get_active, health as fb_health, report as fb_report
+from .devices import device_ids
+from . import archive, budget, latest_shm, partitions, recent_cache, rollups
+from .minute_uploader import MINUTES_LAYOUT, hour_doc_minutes, hour_docs_page
 
 from pathlib import Path
 
@@ -23,6 +26,7 @@ DEVICE_ID = os.getenv("DEVICE_ID", "pi5-001")
 FB_TOGGLE_PATH = os.getenv("FB_TOGGLE_PATH", "/var/lib/tempmon/firebase-active")
 LOCAL_LAST_JSON = os.getenv("LOCAL_LAST_JSON", "/tmp/last_temp.json")
 DB_PATH = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+RAW_MAX_HOURS = int(os.getenv("RAW_MAX_HOURS", "24"))   # ช่วงสูงสุดต่อ call ของ /api/history/raw
 
 # ----- Firestore helpers / constants -----
 try:
@@ -41,6 +45,50 @@ except Exception:
     FieldFilter = None  # type: ignore
 
 
+def _stream(q, cls: str) -> list:
+    """query.stream() ผ่านงบ read (sensor/budget.py); งบหมด -> BudgetExceeded"""
+    if not budget.allowed("read", cls):
+        raise budget.BudgetExceeded("read", cls, 1)
+    try:
+        docs = list(q.stream())
+    except Exception as e:
+        fb_report(None, e)    # ให้ circuit breaker ของ project ที่ใช้อยู่รู้ (sensor/firebase_admin_init.py)
+        raise
+    fb_report(None)
+    budget.charge("read", cls, max(1, len(docs)))   # query ว่างก็คิด 1 read
+    return docs
+
+
+def _get(ref, cls: str):
+    budget.guard("read", cls)
+    try:
+        snap = ref.get()
+    except Exception as e:
+        fb_report(None, e)
+        raise
+    fb_report(None)
+    return snap
+
+
+def _legacy_latest(fs, device_id: str) -> Dict[str, Any]:
+    """series/latest รุ่นเก่า (ก่อนมี devices/{id}.latest)"""
+    try:
+        snap = _get(fs.collection("devices").document(device_id)
+                      .collection("series").document("latest"), "latest")
+        return snap.to_dict() or {}
+    except Exception:
+        return {}
+
+
+def _latest_doc(fs, device_id: str) -> Dict[str, Any]:
+    """
+    ค่าล่าสุดทุก metric จาก devices/{id}.latest (sensor/latest_state.py) — read เดียว
+    เครื่องที่ยังไม่เคยเขียน field นี้ ตกไปอ่าน series/latest รุ่นเก่า
+    """
+    data = _get(fs.collection("devices").document(device_id), "latest").to_dict() or {}
+    return data.get("latest") or _legacy_latest(fs, device_id)
+
+
 def _to_iso(ts: Any) -> Optional[str]:
     """แปลง Firestore Timestamp/datetime/int(ms)/str เป็น ISO8601"""
     if ts is None:
@@ -56,9 +104,21 @@ def _to_iso(ts: Any) -> Optional[str]:
             return None
 
 
+def _device_id(request: HttpRequest) -> str:
+    """?device=<id> เลือกเครื่องใน gateway (ไม่ส่ง = DEVICE_ID)"""
+    d = (request.GET.get("device") or "").strip()
+    return d or DEVICE_ID
+
+
 # ---------------- UI ----------------
 def index(request: HttpRequest):
-    return render(request, "sensor/index.html", {"device_id": DEVICE_ID})
+    return render(request, "sensor/index.html", {"device_id": _device_id(request)})
+
+
+@require_GET
+def devices_api(request: HttpRequest):
+    """รายชื่อเครื่องที่ gateway นี้ดูแล"""
+    return JsonResponse({"ok": True, "devices": device_ids(), "default": DEVICE_ID})
 
 
 # ------------- APIs -----------------
@@ -67,37 +127,20 @@ def index(request: HttpRequest):
 @require_GET
 def temp_api(request: HttpRequest):
     """อุณหภูมิล่าสุด (ใช้กับการ์ดบนสุด/เช็คเร็ว)"""
+    device_id = _device_id(request)
+    # ค่าสดจาก collector (shared memory) — ไม่มี I/O
+    snap = latest_shm.read(device_id)
+    if snap is not None and snap["temp"] is not None:
+        return JsonResponse({
+            "timestamp": datetime.fromtimestamp(snap["ts_ms"] / 1000, tz=timezone.utc).isoformat(),
+            "temp_c": snap["temp"],
+            "temp_f": round(snap["temp"] * 9 / 5 + 32, 2),
+        })
     try:
         fs = get_fs()
         if fs is not None:
-            # readings ล่าสุด
-            q = (
-                fs.collection("devices").document(DEVICE_ID)
-                  .collection("series").document("temp")
-                  .collection("readings")
-                  .order_by("createdAt", direction=_ORDER_DESC)
-                  .limit(1)
-            )
-            docs = list(q.stream())
-            if docs:
-                d = docs[0].to_dict() or {}
-                v = d.get("temp_c_avg", d.get("temp_c", d.get("value")))
-                if v is not None:
-                    v = float(v)
-                    return JsonResponse({
-                        "timestamp": _to_iso(d.get("createdAt")),
-                        "temp_c": v,
-                        "temp_f": round(v * 9 / 5 + 32, 2),
-                    })
-
-            # ตกมาอ่าน series/latest
-            latest = (
-                fs.collection("devices").document(DEVICE_ID)
-                  .collection("series").document("latest")
-                  .get()
-            )
-            data = latest.to_dict() or {}
-            t = (data.get("temp") or {}) if isinstance(data, dict) else {}
+            # devices/{id}.latest (sensor/latest_state.py) — อ่าน doc เดียว
+            t = (_latest_doc(fs, device_id).get("temp") or {})
             v = t.get("value", t.get("temp_c"))
             if v is not None:
                 v = float(v)
@@ -126,6 +169,7 @@ def temp_api(request: HttpRequest):
 @require_GET
 def latest_api(request: HttpRequest):
     """ล่าสุดทุก metric สำหรับหน้า Dashboard (Firestore) — schema ใหม่: ไม่มี current"""
+    device_id = _device_id(request)
     try:
         fs = get_fs()
         if fs is None:
@@ -159,30 +203,10 @@ def latest_api(request: HttpRequest):
                 ret["percent"] = d.get("percent")
             return ret
 
-        # ✅ schema ใหม่: ไม่มี current
+        # ✅ schema ใหม่: ไม่มี current — ทุก metric อยู่ใน doc เดียว
+        latest = _latest_doc(fs, device_id)
         for metric in ("temp", "level", "cycles"):
-            try:
-                q = (
-                    fs.collection("devices").document(DEVICE_ID)
-                      .collection("series").document(metric)
-                      .collection("readings")
-                      .order_by("createdAt", direction=_ORDER_DESC)
-                      .limit(1)
-                )
-                docs = list(q.stream())
-                data = docs[0].to_dict() if docs else None
-
-                # ตกมาอ่าน series/latest ถ้าไม่มี readings
-                if not data:
-                    snap = (
-                        fs.collection("devices").document(DEVICE_ID)
-                          .collection("series").document("latest").get()
-                    )
-                    data = (snap.to_dict() or {}).get(metric)
-
-                out[metric] = pick(metric, data or {})
-            except Exception as e:
-                out[metric] = {"error": str(e)}
+            out[metric] = pick(metric, latest.get(metric) or {})
 
         return JsonResponse(out, status=200)
     except Exception as e:
@@ -193,16 +217,15 @@ def latest_api(request: HttpRequest):
 @require_GET
 def latest_local(request):
     """ใช้กับหน้าเว็บที่ยิง /api/latest — schema ใหม่: ไม่มี current"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT ts_ms, temp, level, cycles
-        FROM readings
-        ORDER BY ts_ms DESC
-        LIMIT 1
-    """)
-    row = cur.fetchone()
-    conn.close()
+    device_id = _device_id(request)
+    snap = latest_shm.read(device_id)   # collector เขียนไว้ใน /dev/shm ทุก tick
+    if snap is not None:
+        row = (snap["ts_ms"], snap["temp"], snap["level"], snap["cycles"])
+    else:
+        conn = sqlite3.connect(DB_PATH)
+        cur = conn.cursor()
+        row = partitions.latest(cur, device_id)
+        conn.close()
 
     if not row:
         return JsonResponse({"ok": False, "reason": "no_data"}, status=404)
@@ -211,6 +234,7 @@ def latest_local(request):
     return JsonResponse({
         "ok": True,
         "source": "local",
+        "device_id": device_id,
         "ts_ms": ts_ms,
         "temp": t,
         "level": lvl,
@@ -218,13 +242,73 @@ def latest_local(request):
     })
 
 
+def _hour_docs(fs, device_id: str, since: datetime, until: Optional[datetime] = None,
+               limit: Optional[int] = None) -> List[tuple]:
+    """
+    อ่าน doc รายชั่วโมง (MINUTES_LAYOUT=hourly) ตั้งแต่ชั่วโมงของ since ถึงก่อน until
+    -> [(hour_id, dict), ...]; limit = จำนวน doc สูงสุด (read ตามหน้าที่ขอ ไม่ใช่ถึงตอนนี้)
+    """
+    coll = fs.collection("devices").document(device_id).collection("minutes_h")
+    iso_since = since.replace(minute=0, second=0, microsecond=0).isoformat()
+    if FieldFilter:
+        q = coll.where(filter=FieldFilter("ts_hour", ">=", iso_since))
+    else:
+        q = coll.where("ts_hour", ">=", iso_since)
+    if until is not None:
+        iso_until = until.isoformat()
+        if FieldFilter:
+            q = q.where(filter=FieldFilter("ts_hour", "<", iso_until))
+        else:
+            q = q.where("ts_hour", "<", iso_until)
+    q = q.order_by("ts_hour", direction=_ORDER_ASC)
+    if limit is not None:
+        q = q.limit(limit)
+    return [(d.id, d.to_dict() or {}) for d in _stream(q, "minutes")]
+
+
+def _readings_by_id(coll, start: datetime, end: datetime) -> list:
+    """
+    doc ใน series/{metric}/readings ที่ id (YYYYMMDDHHmm[ss] UTC) อยู่ในช่วง [start, end)
+    เรียงตาม id = เรียงตามเวลา; id สุ่มรุ่นเก่าที่บังเอิญตกในช่วงถูกกรองทิ้ง
+    """
+    lo = coll.document(start.strftime("%Y%m%d%H%M"))
+    hi = coll.document(end.strftime("%Y%m%d%H%M"))
+    if FieldFilter:
+        q = (coll.where(filter=FieldFilter("__name__", ">=", lo))
+                 .where(filter=FieldFilter("__name__", "<", hi)))
+    else:
+        q = coll.where("__name__", ">=", lo).where("__name__", "<", hi)
+    q = q.order_by("__name__", direction=_ORDER_ASC)
+    return [d for d in _stream(q, "minutes") if d.id.isdigit() and len(d.id) in (12, 14)]
+
+
+def _minute_bound(v: Optional[str]) -> Optional[datetime]:
+    """?until= / ?cursor= : minute id YYYYMMDDHHmm (UTC) หรือ epoch ms"""
+    v = (v or "").strip()
+    if not v:
+        return None
+    if len(v) == 12 and v.isdigit():
+        return datetime.strptime(v, "%Y%m%d%H%M").replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(int(v) / 1000, tz=timezone.utc)
+
+
+def _minute_row(t_ms: int, temp_avg, temp_last, level_avg, level_last, cycles) -> Dict[str, Any]:
+    return {
+        "t_ms":   t_ms,
+        "temp":   temp_avg if temp_avg is not None else temp_last,
+        "level":  level_avg if level_avg is not None else level_last,
+        "cycles": cycles,
+    }
+
+
 @require_GET
 def minutes_api(request):
-    from datetime import datetime, timedelta, timezone
-    import os
-    from django.http import JsonResponse
-
-    DEVICE_ID = os.getenv("DEVICE_ID", "pi5-001")
+    """
+    /api/minutes?hours=24[&until=<id|ms>][&cursor=<id>][&limit=N]
+    ช่วง [until - hours, until) (until ไม่ส่ง = ตอนนี้) เรียงตามเวลา
+    หน้าละ limit แถว (ค่าเริ่มต้น = ทั้งช่วง); มี "next" = ส่งเป็น cursor เพื่ออ่านหน้าถัดไป
+    """
+    device_id = _device_id(request)
 
     try:
         hours = max(1, min(int(request.GET.get("hours", "24")), 168))
@@ -232,61 +316,200 @@ def minutes_api(request):
         hours = 24
 
     try:
-        since = datetime.now(timezone.utc) - timedelta(hours=hours)
-        start_id = since.strftime("%Y%m%d%H%M")  # YYYYMMDDHHmm (UTC)
+        until = _minute_bound(request.GET.get("until"))
+        cursor = _minute_bound(request.GET.get("cursor"))
+        limit = int(request.GET.get("limit") or 0)
+    except Exception:
+        return JsonResponse({"ok": False, "reason": "bad until/cursor/limit"}, status=400)
+    # จำกัดจำนวน doc ต่อ call กันหนักเครื่อง (สูงสุด 7 วัน = 10080 นาที)
+    limit = min(limit if limit > 0 else hours * 60 + 30, 11000)
+
+    try:
+        end = until or (datetime.now(timezone.utc) + timedelta(minutes=1))
+        since = end - timedelta(hours=hours)
+        after = cursor is not None and cursor >= since   # หน้าถัดไป: เริ่มหลัง cursor
+        start = cursor + timedelta(minutes=1) if after else since
+        start_ms, end_ms = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+        def page(rows: List[Dict[str, Any]], more: Optional[bool] = None,
+                 next_ms: Optional[int] = None, **extra) -> JsonResponse:
+            if next_ms is None:
+                more = len(rows) > limit if more is None else more
+                rows = rows[:limit]
+                next_ms = rows[-1]["t_ms"] if more and rows else None
+            nxt = datetime.fromtimestamp(next_ms / 1000, tz=timezone.utc).strftime("%Y%m%d%H%M") \
+                if next_ms is not None else None
+            return JsonResponse({"ok": True, "rows": rows, "next": nxt, **extra})
+
+        # ช่วงล่าสุด (<= RECENT_CACHE_HOURS) ตอบจาก memory ไม่ต้องแตะ Firestore
+        recent = _recent_minutes(device_id, start_ms, end_ms)
+        if recent:
+            return page([_minute_row(r["ts"], r["temp_avg"], r["temp_last"], r["level_avg"],
+                                     r["level_last"], r["cycles_delta"]) for r in recent], source="recent")
 
         fs = get_fs()
         if fs is None:
             return JsonResponse({"ok": False, "reason": "firestore_not_ready"}, status=500)
 
-        coll = fs.collection("devices").document(DEVICE_ID).collection("minutes")
-
-        # --- ดึงแบบเรียง ASC แล้ว "filter ด้วย id" ฝั่ง python ชัวร์สุด ---
-        # จำกัดจำนวน doc กันหนักเครื่อง (สูงสุด 7 วัน = 10080 นาที)
-        max_docs = min(hours * 60 + 30, 11000)
-
-        q = coll.order_by("__name__", direction=_ORDER_ASC).limit(max_docs)
-        docs = list(q.stream())
+        if MINUTES_LAYOUT == "hourly":
+            # doc ละชั่วโมง: 168 reads แทน 10,080 สำหรับ 7 วัน
+            # หน้าละ limit นาที -> ไม่เกิน ceil(limit/60)+1 doc (+1 = ชั่วโมงแรกที่เริ่มกลางชั่วโมง)
+            # ครบ doc_limit แต่นาทีไม่ถึง limit (ชั่วโมงว่าง) -> next = ท้ายชั่วโมงสุดท้ายที่อ่าน
+            doc_limit = -(-limit // 60) + 1
+            mins, next_ms = hour_docs_page(_hour_docs(fs, device_id, start, end, doc_limit),
+                                           start_ms, end_ms, limit, doc_limit)
+            rows = [_minute_row(m["t_ms"], m.get("temp_avg"), m.get("temp_last"),
+                                m.get("level_avg"), m.get("level_last"), m.get("cycles_delta")) for m in mins]
+            return page(rows, next_ms=next_ms)
+
+        coll = fs.collection("devices").document(device_id).collection("minutes")
+
+        # id = YYYYMMDDHHmm (UTC) -> เรียงตาม key = เรียงตามเวลา
+        # เริ่มที่ start (หรือต่อจาก cursor) จบก่อน end: read ตามช่วงที่ขอ ไม่ขึ้นกับขนาด collection
+        def key(dt: datetime) -> Dict[str, Any]:
+            return {"__name__": coll.document(dt.strftime("%Y%m%d%H%M"))}
+
+        q = coll.order_by("__name__", direction=_ORDER_ASC)
+        q = q.start_after(key(cursor)) if after else q.start_at(key(start))
+        q = q.end_before(key(end)).limit(limit + 1)   # +1 = รู้ว่ามีหน้าถัดไปไหม
+        docs = _stream(q, "minutes")
 
         rows = []
         for d in docs:
-            if d.id < start_id:
-                continue  # ✅ filter ชัวร์ ไม่พึ่ง where(__name__)
+            if not (d.id.isdigit() and len(d.id) == 12):
+                continue
             x = d.to_dict() or {}
-
-            # id = YYYYMMDDHHmm (UTC)
             ts = datetime.strptime(d.id, "%Y%m%d%H%M").replace(tzinfo=timezone.utc)
-            t_ms = int(ts.timestamp() * 1000)
 
             # schema minutes บน Firestore (ที่ uploader จะส่งไป)
-            temp_avg = (x.get("temp") or {}).get("avg")
-            temp_last = (x.get("temp") or {}).get("last")
-            level_avg = (x.get("level") or {}).get("avg")
-            level_last = (x.get("level") or {}).get("last")
-            cycles_last = (x.get("cycles") or {}).get("last")
+            temp = x.get("temp") or {}
+            level = x.get("level") or {}
+            rows.append(_minute_row(int(ts.timestamp() * 1000), temp.get("avg"), temp.get("last"),
+                                    level.get("avg"), level.get("last"), (x.get("cycles") or {}).get("last")))
 
-            rows.append({
-                "t_ms":   t_ms,
-                "temp":   temp_avg if temp_avg is not None else temp_last,
-                "level":  level_avg if level_avg is not None else level_last,
-                "cycles": cycles_last,
-            })
+        return page(rows, more=len(docs) > limit)
 
-        return JsonResponse({"ok": True, "rows": rows})
+    except budget.BudgetExceeded:
+        return JsonResponse({"ok": False, "reason": "read_budget_exhausted"}, status=429)
+    except Exception as e:
+        return JsonResponse({"ok": False, "reason": str(e)}, status=500)
+
+
+def _recent_minutes(device_id: str, start_ms: int, end_ms: int) -> Optional[List[Dict[str, Any]]]:
+    """minutes ใน [start_ms, end_ms) จากแคชใน process (sensor/recent_cache.py); None = ช่วงเก่าเกิน/ไม่มีข้อมูล"""
+    cache = recent_cache.get()
+    if cache is None:
+        return None
+    try:
+        return cache.range(device_id, start_ms, end_ms) or None
+    except Exception:
+        return None   # ไม่มี DB / ตาราง -> ให้ทางเดิมจัดการ
+
+
+def _history_local(device_id: str, metric: str, hours: int,
+                   resolution: Optional[str] = None) -> Dict[str, Any]:
+    """ประวัติจาก SQLite: เลือก minutes / hours / days ตามความยาวช่วง (sensor/rollups.py)"""
+    end_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    start_ms = end_ms - hours * 3_600_000
+
+    # ช่วงที่อยู่ในแคช (minutes / hours) ไม่ต้องเปิด SQLite
+    cache = recent_cache.get()
+    hit = None
+    if cache is not None:
+        try:
+            hit = cache.series(device_id, start_ms, end_ms, resolution)
+        except Exception:
+            hit = None
+    if hit is not None and hit[1]:
+        res, rows = hit
+        source = "recent"
+    else:
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            res, rows = rollups.series(conn.cursor(), device_id, start_ms, end_ms, resolution)
+            conn.commit()
+        finally:
+            conn.close()
+        source = "local"
+
+    items: List[Dict[str, Any]] = []
+    for r in rows:
+        if metric == "cycles":
+            avg = mn = mx = r.get("cycles_delta")
+        else:
+            avg, mn, mx = r.get(f"{metric}_avg"), r.get(f"{metric}_min"), r.get(f"{metric}_max")
+        if avg is not None:
+            items.append({"timestamp": _to_iso(r["ts"]), "min": mn, "avg": avg, "max": mx, "value": avg})
+    return {"items": items, "count": len(items), "resolution": res, "source": source}
+
+
+@never_cache
+@require_GET
+def history_local(request: HttpRequest):
+    """/api/history/local?hours=168&metric=temp[&resolution=minutes|hours|days]"""
+    metric = (request.GET.get("metric", "temp") or "temp").lower()
+    if metric not in ("temp", "level", "cycles"):
+        return JsonResponse({"items": [], "count": 0})
+    try:
+        hours = max(1, int(request.GET.get("hours", "4") or "4"))
+    except Exception:
+        hours = 4
+    resolution = request.GET.get("resolution") or None
+    if resolution not in (None, "minutes", "hours", "days"):
+        resolution = None
+    try:
+        return JsonResponse(_history_local(_device_id(request), metric, hours, resolution))
+    except Exception as e:
+        return JsonResponse({"items": [], "count": 0, "error": str(e)}, status=500)
+
+
+@never_cache
+@require_GET
+def history_raw(request: HttpRequest):
+    """
+    /api/history/raw?start=<ms>&end=<ms>[&format=csv]  raw ทุก sample (ไม่ใช่สรุปรายนาที)
+    อ่านผ่าน archive.read_range: ชั่วโมงที่แพ็คแล้วจาก readings_archive, ที่เหลือจาก partition
+    ช่วงยาวสุด RAW_MAX_HOURS ต่อ call (export ยาวๆ ให้ไล่ start ต่อกันไป)
+    """
+    device_id = _device_id(request)
+    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    try:
+        end_ms = int(request.GET.get("end") or now_ms)
+        start_ms = int(request.GET.get("start") or end_ms - 3_600_000)
+    except Exception:
+        return JsonResponse({"ok": False, "reason": "bad start/end"}, status=400)
+    if start_ms >= end_ms:
+        return JsonResponse({"ok": False, "reason": "start >= end"}, status=400)
+    end_ms = min(end_ms, start_ms + RAW_MAX_HOURS * 3_600_000)
 
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cur = conn.cursor()
+        archive.ensure_archive_table(cur)
+        rows = list(archive.read_range(cur, device_id, start_ms, end_ms))
     except Exception as e:
         return JsonResponse({"ok": False, "reason": str(e)}, status=500)
+    finally:
+        conn.close()
+
+    if request.GET.get("format") == "csv":
+        lines = ["ts_ms,temp,level,cycles"]
+        lines += [",".join("" if v is None else str(v) for v in r) for r in rows]
+        resp = HttpResponse("\n".join(lines) + "\n", content_type="text/csv")
+        resp["Content-Disposition"] = f'attachment; filename="{device_id}-{start_ms}-{end_ms}.csv"'
+        return resp
+    return JsonResponse({"ok": True, "device_id": device_id, "start": start_ms, "end": end_ms,
+                         "rows": [{"ts_ms": ts, "temp": t, "level": lvl, "cycles": cyc}
+                                  for ts, t, lvl, cyc in rows],
+                         "count": len(rows)})
 
 
 @never_cache
 @require_GET
 def history_api(request: HttpRequest):
-    """ประวัติสำหรับกราฟ (minutes ถ้ามี, ไม่มีก็ readings) — schema ใหม่: ไม่มี current"""
+    """ประวัติสำหรับกราฟ (local rollups ถ้ามี, ไม่งั้น minutes / readings บน Firestore) — schema ใหม่: ไม่มี current"""
+    device_id = _device_id(request)
     try:
-        fs = get_fs()
-        if fs is None:
-            return JsonResponse({"items": [], "count": 0})
-
         metric = (request.GET.get("metric", "temp") or "temp").lower()
         # ✅ กันคนยิง metric=current แล้วพัง
         if metric == "current":
@@ -295,13 +518,52 @@ def history_api(request: HttpRequest):
         hours  = int(request.GET.get("hours", "4") or "4")
         if hours <= 0:
             hours = 4
+
+        # ---------- แคชใน memory (ช่วงล่าสุด) / local SQLite: hours/days สำหรับช่วงยาว (168 จุดแทน 10,080) ----------
+        if metric in ("temp", "level", "cycles"):
+            try:
+                out = _history_local(device_id, metric, hours)
+                if out["items"]:
+                    return JsonResponse(out)
+            except Exception:
+                pass
+
+        fs = get_fs()
+        if fs is None:
+            return JsonResponse({"items": [], "count": 0})
+
         since = datetime.now(timezone.utc) - timedelta(hours=hours)
 
         items: List[Dict[str, Any]] = []
 
+        # ---------- minutes_h (MINUTES_LAYOUT=hourly): ช่วงยาวใช้ summary ชั่วโมงละจุด ----------
+        if MINUTES_LAYOUT == "hourly":
+            try:
+                per_minute = rollups.pick_resolution(hours * 3_600_000) == "minutes"
+                since_ms = int(since.timestamp() * 1000)
+                for hour_id, x in _hour_docs(fs, device_id, since):
+                    if per_minute:
+                        pts = [(m["t_ms"], m) for m in hour_doc_minutes(hour_id, x) if m["t_ms"] >= since_ms]
+                    else:
+                        sm = x.get("summary") or {}
+                        flat = {f"{k}_{f}": (sm.get(k) or {}).get(f)
+                                for k in ("temp", "level") for f in ("avg", "min", "max")}
+                        flat["cycles_delta"] = (sm.get("cycles") or {}).get("sum")
+                        hs = datetime.strptime(hour_id, "%Y%m%d%H").replace(tzinfo=timezone.utc)
+                        pts = [(int(hs.timestamp() * 1000), flat)]
+                    for t_ms, m in pts:
+                        if metric == "cycles":
+                            avg = mn = mx = m.get("cycles_delta")
+                        else:
+                            avg, mn, mx = m.get(f"{metric}_avg"), m.get(f"{metric}_min"), m.get(f"{metric}_max")
+                        if avg is not None:
+                            items.append({"timestamp": _to_iso(t_ms), "min": mn, "avg": avg, "max": mx, "value": avg})
+            except Exception:
+                pass
+
         # ---------- minutes (schema: ts_minute + nested stats) ----------
         try:
-            minutes_ref = fs.collection("devices").document(DEVICE_ID).collection("minutes")
+            minutes_ref = fs.collection("devices").document(device_id).collection("minutes")
             iso_since = since.astimezone(timezone.utc).isoformat()
 
             if FieldFilter:
@@ -317,7 +579,7 @@ def history_api(request: HttpRequest):
                     .order_by("ts_minute", direction=_ORDER_ASC)
                 )
 
-            rows = [d.to_dict() for d in q.stream()]
+            rows = [d.to_dict() for d in _stream(q, "minutes")] if not items else []
             for r in rows:
                 ts = r.get("ts_minute")
                 if not ts:
@@ -343,25 +605,30 @@ def history_api(request: HttpRequest):
         if not items:
             try:
                 series_ref = (
-                    fs.collection("devices").document(DEVICE_ID)
+                    fs.collection("devices").document(device_id)
                       .collection("series").document(metric)
                       .collection("readings")
                 )
 
-                if FieldFilter:
-                    q = (
-                        series_ref
-                        .where(filter=FieldFilter("createdAt", ">=", since))
-                        .order_by("createdAt", direction=_ORDER_ASC)
-                    )
-                else:
-                    q = (
-                        series_ref
-                        .where("createdAt", ">=", since)
-                        .order_by("createdAt", direction=_ORDER_ASC)
-                    )
-
-                for d in q.stream():
+                # id = เวลาเริ่มช่วง (UTC) -> scan ตามช่วง key ไม่ต้องใช้ index ของ createdAt
+                docs = _readings_by_id(series_ref, since, datetime.now(timezone.utc) + timedelta(days=1))
+                if not docs:
+                    # doc รุ่นเก่า (id สุ่มจาก .add()) ต้อง query ด้วย createdAt
+                    if FieldFilter:
+                        q = (
+                            series_ref
+                            .where(filter=FieldFilter("createdAt", ">=", since))
+                            .order_by("createdAt", direction=_ORDER_ASC)
+                        )
+                    else:
+                        q = (
+                            series_ref
+                            .where("createdAt", ">=", since)
+                            .order_by("createdAt", direction=_ORDER_ASC)
+                        )
+                    docs = _stream(q, "minutes")
+
+                for d in docs:
                     row = d.to_dict() or {}
                     ts = _to_iso(row.get("createdAt"))
                     if metric == "temp":
@@ -468,7 +735,7 @@ def alerts_latest(request: HttpRequest):
               .order_by("ts_ms", direction=_ORDER_DESC)
               .limit(limit)
         )
-        docs = list(q.stream())
+        docs = _stream(q, "alerts")
         rows = []
         for d in docs:
             obj = d.to_dict() or {}
@@ -491,20 +758,13 @@ def status_summary(request):
         if fs is None:
             return JsonResponse({"ok": False, "error": "Firestore not ready"}, status=500)
 
-        device_id = os.getenv("DEVICE_ID", "pi5-001")
+        device_id = _device_id(request)
 
-        doc = fs.collection("devices").document(device_id).get()
+        doc = _get(fs.collection("devices").document(device_id), "latest")
         data = doc.to_dict() or {}
 
         if not data.get("latest"):
-            try:
-                latest = (
-                    fs.collection("devices").document(device_id)
-                      .collection("series").document("latest").get()
-                )
-                data["latest"] = latest.to_dict() or {}
-            except Exception:
-                pass
+            data["latest"] = _legacy_latest(fs, device_id)
 
         return JsonResponse({"ok": True, "data": data})
     except Exception as e:
@@ -540,7 +800,7 @@ def push_register(request):
 @never_cache
 def firebase_active_get(request: HttpRequest):
     try:
-        return JsonResponse({"active": get_active(), "path": FB_TOGGLE_PATH})
+        return JsonResponse({"active": get_active(), "path": FB_TOGGLE_PATH, **fb_health()})
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
@@ -572,3 +832,14 @@ def firebase_active_set(request: HttpRequest):
         return JsonResponse({"ok": True, "active": to})
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
+
+
+# -------- Firestore budget --------
+@never_cache
+@require_GET
+def budget_api(request: HttpRequest):
+    """ยอดใช้ read/write/delete ของวันนี้ แยกตามคลาส (sensor/budget.py)"""
+    try:
+        return JsonResponse({"ok": True, **budget.spend()})
+    except Exception as e:
+        return JsonResponse({"ok": False, "error": str(e)}, status=500)
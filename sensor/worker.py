@@ -0,0 +1,170 @@
+# sensor/worker.py
+"""
+One persistent process for the periodic jobs that used to be cron one-shots.
+
+Each cron run paid for Python start-up, the firebase_admin / Firestore /
+gRPC imports and credential loading before doing a few milliseconds of
+work. Here every job is a DeadlineScheduler task calling the module's
+run_once() with a SQLite connection and a Firestore client that stay
+open (warm) for the life of the process:
+
+  aggregate      minute_aggregator.run_once   every 60s  (+5s after the minute closes)
+  upload         minute_uploader.run_once     every 60s  (+8s, after aggregate)
+  upload_30m     uploader_30m.run_once        every 1800s
+  alerts         alert_worker.run_once        every 60s
+  cleanup_local  cleanup_old_data.run_once    daily 03:10 UTC
+  cleanup        cleanup.run_once             daily 03:20 UTC (Firestore)
+
+  WORKER_JOBS=aggregate,upload,alerts,cleanup_local,cleanup   which jobs to run
+  WORKER_<JOB>_SEC / WORKER_<JOB>_OFFSET                      period / grid offset
+
+A failing job is logged and counted in the scheduler stats; the others
+keep running. Drop `aggregate` when the streaming aggregator
+(AGG_DAEMON=1) runs as its own service. The modules still run standalone
+(python -m sensor.minute_uploader) — their cloud SDK imports are lazy, see
+sensor/bench_startup.py.
+
+Run:  python -m sensor.worker
+"""
+import os
+import signal
+import time
+from typing import Callable, Dict
+
+from sensor.local_db import connect
+from sensor.scheduler import DeadlineScheduler
+
+DB = os.getenv("DB", "/var/lib/tempmon/data.sqlite")
+WORKER_JOBS = [j.strip() for j in os.getenv(
+    "WORKER_JOBS", "aggregate,upload,alerts,cleanup_local,cleanup").split(",") if j.strip()]
+
+# (period, offset) ค่าเริ่มต้นต่อ job — ทับได้ด้วย WORKER_<JOB>_SEC / WORKER_<JOB>_OFFSET
+DEFAULTS = {
+    "aggregate":     (60, 5),         # หลังนาทีปิด + รอบ flush ของ ReadingsWriter (WRITE_BATCH_MS)
+    "upload":        (60, 8),         # หลัง aggregate ในนาทีเดียวกัน
+    "upload_30m":    (1800, 10),
+    "alerts":        (60, 0),
+    "cleanup_local": (86400, 3 * 3600 + 600),
+    "cleanup":       (86400, 3 * 3600 + 1200),
+}
+
+
+def _timing(job: str):
+    period, offset = DEFAULTS[job]
+    key = job.upper()
+    return (float(os.getenv(f"WORKER_{key}_SEC", period)),
+            float(os.getenv(f"WORKER_{key}_OFFSET", offset)))
+
+
+class Worker:
+    def __init__(self, db_path: str = DB):
+        self.db_path = db_path
+        self.con = None       # ใช้ร่วมทุก job (scheduler รันทีละ task อยู่แล้ว)
+        self.con_ac = None    # autocommit สำหรับ cleanup_local (BEGIN/COMMIT เอง)
+
+    # ---------- resources ----------
+    def conn(self):
+        if self.con is None:
+            self.con = connect(self.db_path, check_same_thread=False)   # resync ใช้ thread
+        return self.con
+
+    def conn_autocommit(self):
+        if self.con_ac is None:
+            self.con_ac = connect(self.db_path, isolation_level=None)
+        return self.con_ac
+
+    def warm_up(self):
+        """สร้าง Firestore client ตั้งแต่เริ่ม (โหลด SDK + credential ครั้งเดียวต่อ process)"""
+        from sensor.firebase_admin_init import get_fs_named
+        t0 = time.perf_counter()
+        try:
+            name, fs = get_fs_named()
+        except Exception as e:
+            print(f"[worker] firestore warm-up failed: {e}", flush=True)
+            return
+        print(f"[worker] firestore {name} ready={fs is not None} "
+              f"in {(time.perf_counter() - t0) * 1000:.0f}ms", flush=True)
+
+    def close(self):
+        for c in (self.con, self.con_ac):
+            if c is not None:
+                c.close()
+        self.con = self.con_ac = None
+
+    # ---------- jobs ----------
+    def _sqlite_job(self, fn: Callable):
+        con = self.conn()
+        try:
+            fn(con)
+        except Exception:
+            # อย่าปล่อย transaction ค้างไว้ให้ job ถัดไป
+            con.rollback()
+            raise
+
+    def aggregate(self, tick_ts):
+        from sensor import minute_aggregator
+        self._sqlite_job(minute_aggregator.run_once)
+
+    def upload(self, tick_ts):
+        from sensor import minute_uploader
+        self._sqlite_job(minute_uploader.run_once)
+
+    def upload_30m(self, tick_ts):
+        from sensor import uploader_30m
+        self._sqlite_job(uploader_30m.run_once)
+
+    def alerts(self, tick_ts):
+        from sensor import alert_worker
+        self._sqlite_job(alert_worker.run_once)
+
+    def cleanup_local(self, tick_ts):
+        from sensor import cleanup_old_data
+        con = self.conn_autocommit()
+        try:
+            cleanup_old_data.run_once(con)
+        except Exception:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+
+    def cleanup(self, tick_ts):
+        from sensor import cleanup
+        from sensor.firebase_admin_init import get_fs
+        fs = get_fs()
+        if fs is None:
+            raise RuntimeError("Firestore client not ready (FB_PRIMARY_CRED / FB_SECONDARY_CRED)")
+        cleanup.run_once(fs)
+
+    def jobs(self) -> Dict[str, Callable[[float], None]]:
+        return {name: getattr(self, name) for name in DEFAULTS}
+
+
+def main():
+    w = Worker()
+    jobs = w.jobs()
+    unknown = [j for j in WORKER_JOBS if j not in jobs]
+    if unknown:
+        raise SystemExit(f"[worker] unknown job(s): {unknown} (known: {sorted(jobs)})")
+
+    sched = DeadlineScheduler("worker")
+    for name in WORKER_JOBS:
+        period, offset = _timing(name)
+        sched.every(name, period, jobs[name], offset_sec=offset)
+        print(f"[worker] {name} every {period:.0f}s offset={offset:.0f}s", flush=True)
+
+    if any(j in WORKER_JOBS for j in ("upload", "upload_30m", "cleanup")):
+        w.warm_up()
+
+    # systemd stop -> ออกจาก loop หลัง task ที่กำลังรันจบ
+    signal.signal(signal.SIGTERM, lambda *_: sched.stop())
+    try:
+        sched.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        w.close()
+        sched.print_stats()
+
+
+if __name__ == "__main__":
+    main()